@@ -39,8 +39,36 @@ class Settings(BaseSettings):
     max_rpm: int = 120
     base_rpm_contributor_only: bool = Field(True, env="BASE_RPM_CONTRIBUTOR_ONLY")
     manual_global_rpm: int = Field(0, env="MANUAL_GLOBAL_RPM")
+    # auto = memory on a single node; in multi-node mode shared counters (db if the shared state is memory).
+    rate_limit_backend: str = Field("auto", env="RATE_LIMIT_BACKEND")  # auto | memory | db | shared
+    # Cross-node counters / key leases / proxy and key cooldowns: auto = memory on a single node, db in multi-node mode.
+    shared_state_backend: str = Field("auto", env="SHARED_STATE_BACKEND")  # auto | memory | db | redis
+    shared_state_redis_url: str = Field("redis://127.0.0.1:6379/0", env="SHARED_STATE_REDIS_URL")
+    shared_state_key_prefix: str = Field("nai-pool:", env="SHARED_STATE_KEY_PREFIX")
+    shared_state_timeout_ms: int = Field(200, env="SHARED_STATE_TIMEOUT_MS")  # per operation; errors fail open
+    shared_state_sync_interval_ms: int = Field(1000, env="SHARED_STATE_SYNC_INTERVAL_MS")  # cooldown push / pull
+    # Per-user key counts / RPM cache; the TTL bounds staleness for changes made on other nodes.
+    quota_cache_ttl_seconds: int = Field(30, env="QUOTA_CACHE_TTL_SECONDS")
+    # Proxy-path auth cache (token hash -> user principal); 0 disables.
+    auth_cache_ttl_seconds: int = Field(30, env="AUTH_CACHE_TTL_SECONDS")
+    auth_cache_max_entries: int = Field(10000, env="AUTH_CACHE_MAX_ENTRIES")
 
     key_cooldown_seconds: int = 3
+    # In-flight leases per upstream key (NovelAI answers 409/429 to concurrent use of one key).
+    key_max_concurrency: int = Field(1, env="KEY_MAX_CONCURRENCY")
+    # Leases not released within this time are reclaimed (should exceed the upstream timeout).
+    key_lease_ttl_seconds: int = Field(180, env="KEY_LEASE_TTL_SECONDS")
+    # Wait (weighted-fair across users) for a free key instead of an immediate 503; 0 disables.
+    admission_max_wait_ms: int = Field(5000, env="ADMISSION_MAX_WAIT_MS")
+    admission_queue_max_size: int = Field(200, env="ADMISSION_QUEUE_MAX_SIZE")
+    admission_queue_per_user_max: int = Field(4, env="ADMISSION_QUEUE_PER_USER_MAX")
+    # ApiKey usage counters are written behind in batches (status changes flush immediately).
+    key_usage_flush_interval_ms: int = Field(1000, env="KEY_USAGE_FLUSH_INTERVAL_MS")
+    # In-memory key scheduler is resynced from DB periodically (0 = only at startup).
+    key_scheduler_resync_seconds: int = Field(30, env="KEY_SCHEDULER_RESYNC_SECONDS")
+    # Decrypted upstream key cache (0 disables).
+    key_cache_ttl_seconds: int = Field(300, env="KEY_CACHE_TTL_SECONDS")
+    key_cache_max_entries: int = Field(1024, env="KEY_CACHE_MAX_ENTRIES")
     dynamic_cooldown_enabled: bool = Field(True, env="DYNAMIC_COOLDOWN_ENABLED")
     cooldown_max_seconds: int = Field(300, env="COOLDOWN_MAX_SECONDS")
     cooldown_409_base_seconds: int = Field(3, env="COOLDOWN_409_BASE_SECONDS")
@@ -57,15 +85,61 @@ class Settings(BaseSettings):
         "nai-diffusion-3,nai-diffusion-4-full,nai-diffusion-4-curated-preview,nai-diffusion-4-5-curated,nai-diffusion-4-5-full",
         env="NOVELAI_MODELS",
     )
+    # Upstream endpoints; override only to point at a local mock (tests/load_bench.py).
+    novelai_image_base_url: str = Field("https://image.novelai.net", env="NOVELAI_IMAGE_BASE_URL")
+    novelai_api_base_url: str = Field("https://api.novelai.net", env="NOVELAI_API_BASE_URL")
 
     health_check_enabled: bool = True
     health_check_interval_seconds: int = 300
     health_check_fail_threshold: int = 3
+    # Per-key scheduling: the loop ticks every health_check_tick_seconds and checks due keys only.
+    health_check_tick_seconds: int = Field(15, env="HEALTH_CHECK_TICK_SECONDS")
+    health_check_active_multiplier: int = Field(4, env="HEALTH_CHECK_ACTIVE_MULTIPLIER")
+    health_check_invalid_max_seconds: int = Field(21600, env="HEALTH_CHECK_INVALID_MAX_SECONDS")
+    health_check_concurrency: int = Field(8, env="HEALTH_CHECK_CONCURRENCY")
+    health_check_jitter_ms: int = Field(250, env="HEALTH_CHECK_JITTER_MS")
+    health_check_deadline_seconds: int = Field(240, env="HEALTH_CHECK_DEADLINE_SECONDS")  # 0 = no deadline
+    health_check_commit_batch_size: int = Field(50, env="HEALTH_CHECK_COMMIT_BATCH_SIZE")
     health_check_leader_only: bool = Field(False, env="HEALTH_CHECK_LEADER_ONLY")
     health_check_leader_node_id: str = Field("node-1", env="HEALTH_CHECK_LEADER_NODE_ID")
 
     log_retention_days: int = 30
+    # Retention job for request_logs / auth_attempts (leader node only in multi-node mode).
+    log_retention_enabled: bool = Field(True, env="LOG_RETENTION_ENABLED")
+    log_retention_interval_seconds: int = Field(3600, env="LOG_RETENTION_INTERVAL_SECONDS")
+    log_retention_batch_size: int = Field(2000, env="LOG_RETENTION_BATCH_SIZE")
+    log_retention_batch_pause_ms: int = Field(200, env="LOG_RETENTION_BATCH_PAUSE_MS")
+    log_retention_max_batches: int = Field(500, env="LOG_RETENTION_MAX_BATCHES")  # per table per run
+    log_retention_leader_node_id: str = Field("node-1", env="LOG_RETENTION_LEADER_NODE_ID")
+    auth_attempt_retention_days: int = Field(7, env="AUTH_ATTEMPT_RETENTION_DAYS")
+    # Incremental per-minute / per-day usage rollups of request_logs (one node in multi-node mode).
+    usage_rollup_enabled: bool = Field(True, env="USAGE_ROLLUP_ENABLED")
+    usage_rollup_interval_seconds: int = Field(60, env="USAGE_ROLLUP_INTERVAL_SECONDS")
+    usage_rollup_batch_size: int = Field(5000, env="USAGE_ROLLUP_BATCH_SIZE")
+    usage_rollup_max_batches: int = Field(20, env="USAGE_ROLLUP_MAX_BATCHES")  # per run
+    usage_rollup_settle_seconds: int = Field(30, env="USAGE_ROLLUP_SETTLE_SECONDS")
+    usage_rollup_minute_retention_hours: int = Field(48, env="USAGE_ROLLUP_MINUTE_RETENTION_HOURS")
+    usage_rollup_leader_node_id: str = Field("node-1", env="USAGE_ROLLUP_LEADER_NODE_ID")
+    # Postgres only: create request_logs partitioned by day (new tables only); expired days are dropped.
+    request_log_partitioning: bool = Field(False, env="REQUEST_LOG_PARTITIONING")
+    request_log_partition_days_ahead: int = Field(3, env="REQUEST_LOG_PARTITION_DAYS_AHEAD")
     log_request_ip: bool = Field(False, env="LOG_REQUEST_IP")
+    # Request logs are written by a background task in batches (size- or time-triggered).
+    request_log_async_enabled: bool = Field(True, env="REQUEST_LOG_ASYNC_ENABLED")
+    request_log_batch_size: int = Field(200, env="REQUEST_LOG_BATCH_SIZE")
+    request_log_flush_interval_ms: int = Field(500, env="REQUEST_LOG_FLUSH_INTERVAL_MS")
+    request_log_queue_max_size: int = Field(10000, env="REQUEST_LOG_QUEUE_MAX_SIZE")
+    request_log_overflow_policy: str = Field("inline", env="REQUEST_LOG_OVERFLOW_POLICY")  # inline | block | drop_newest | drop_oldest
+    request_log_flush_wait_ms: int = Field(2000, env="REQUEST_LOG_FLUSH_WAIT_MS")  # log listings' read-your-writes wait
+    # Prometheus text endpoint `/metrics` (per node); a non-empty token requires `Authorization: Bearer <token>`.
+    metrics_enabled: bool = Field(True, env="METRICS_ENABLED")
+    metrics_token: str = Field("", env="METRICS_TOKEN")
+    # Per-stage generate-image timing (histograms + Server-Timing header) and sampled traces.
+    stage_timing_enabled: bool = Field(True, env="STAGE_TIMING_ENABLED")
+    server_timing_header_enabled: bool = Field(True, env="SERVER_TIMING_HEADER_ENABLED")
+    trace_sample_rate: float = Field(0.01, env="TRACE_SAMPLE_RATE")
+    trace_slow_ms: int = Field(10000, env="TRACE_SLOW_MS")  # always kept; 0 = sampling only
+    trace_buffer_size: int = Field(200, env="TRACE_BUFFER_SIZE")
 
     require_opus_tier: bool = Field(True, env="REQUIRE_OPUS_TIER")
 
@@ -93,8 +167,21 @@ class Settings(BaseSettings):
     upstream_proxy_keepalive_leader_only: bool = Field(False, env="UPSTREAM_PROXY_KEEPALIVE_LEADER_ONLY")
     upstream_proxy_keepalive_leader_node_id: str = Field("node-1", env="UPSTREAM_PROXY_KEEPALIVE_LEADER_NODE_ID")
 
+    # Shared upstream HTTP clients (one pooled client per proxy URL + direct), created at startup.
+    upstream_http2_enabled: bool = Field(True, env="UPSTREAM_HTTP2_ENABLED")
+    upstream_max_connections: int = Field(100, env="UPSTREAM_MAX_CONNECTIONS")
+    upstream_max_keepalive_connections: int = Field(20, env="UPSTREAM_MAX_KEEPALIVE_CONNECTIONS")
+    upstream_keepalive_expiry_seconds: int = Field(30, env="UPSTREAM_KEEPALIVE_EXPIRY_SECONDS")
+    upstream_connect_timeout_seconds: int = Field(10, env="UPSTREAM_CONNECT_TIMEOUT_SECONDS")
+    # Stream successful generate-image bodies to the client instead of buffering them.
+    upstream_streaming_enabled: bool = Field(True, env="UPSTREAM_STREAMING_ENABLED")
+    # Failover for transient upstream errors (409/429/5xx/network) on another key / proxy.
+    upstream_retry_max_attempts: int = Field(3, env="UPSTREAM_RETRY_MAX_ATTEMPTS")  # 1 disables retries
+    upstream_retry_deadline_seconds: int = Field(90, env="UPSTREAM_RETRY_DEADLINE_SECONDS")
+
     # System config refresh (for multi-node consistency).
-    # When enabled, each node periodically refreshes SystemConfig from DB on incoming requests.
+    # When enabled, a background watcher applies SystemConfig changes from the shared DB: it polls
+    # the config version every interval (Postgres: woken immediately by LISTEN/NOTIFY).
     system_config_refresh_enabled: bool = Field(True, env="SYSTEM_CONFIG_REFRESH_ENABLED")
     system_config_refresh_interval_seconds: int = Field(5, env="SYSTEM_CONFIG_REFRESH_INTERVAL_SECONDS")
 
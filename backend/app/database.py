@@ -1,9 +1,34 @@
+import time
+
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from app.config import settings
+from app.services.metrics import DB_POOL_CHECKOUT_WAIT
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited for a connection."""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+
+def _engine_options(database_url: str) -> dict:
+    # Only queue pools (PostgreSQL) can make a checkout wait; SQLite keeps its static / null pool.
+    url = make_url(database_url)
+    if url.get_dialect().get_pool_class(url) is AsyncAdaptedQueuePool:
+        return {"poolclass": TimedQueuePool}
+    return {}
+
 
-engine = create_async_engine(settings.database_url, future=True, echo=False)
+engine = create_async_engine(settings.database_url, future=True, echo=False, **_engine_options(settings.database_url))
 
 AsyncSessionLocal = sessionmaker(
     bind=engine, class_=AsyncSession, expire_on_commit=False
@@ -3,97 +3,96 @@ FastAPI application entry.
 
 Notes:
 - Serves the static frontend (`/` and `/assets`) if `frontend/` exists.
-- Provides liveness/readiness endpoints (`/healthz`, `/readyz`).
+- Provides liveness/readiness endpoints (`/healthz`, `/readyz`) and Prometheus metrics (`/metrics`).
 - Adds security response headers and node id header.
-- In multi-node mode, can refresh SystemConfig from the shared DB periodically.
+- In multi-node mode, loads SystemConfig from the shared DB at startup (later changes are applied
+  by a background watcher, see services/system_config.py).
+- Owns the lifecycle of the shared upstream HTTP clients and the write-behind log / key usage
+  writers (started at startup, closed / flushed on shutdown).
 """
 
 import asyncio
 import logging
+import secrets
 from pathlib import Path
 from datetime import datetime, timezone
-import time as _time
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from sqlalchemy import text
-from starlette.middleware.base import BaseHTTPMiddleware
 from sqlalchemy import select
 
 from app.config import settings
 from app.database import engine, AsyncSessionLocal, Base
-from app.models import User
+from app.models import RequestLog, User
 from app.routers import admin, auth, keys, proxy, logs, client_keys
 from app.services.auth import get_password_hash, verify_password
-from app.services.system_config import load_system_config_into_settings, get_system_config_updated_at
-from app.tasks.scheduler import start_background_tasks, reconcile_background_tasks
+from app.services.system_config import system_config_watcher
+from app.services.upstream_http import UpstreamHttpClients
+from app.services.key_scheduler import key_scheduler
+from app.services.admission import admission_queue
+from app.services.key_pool import install_shared_leases
+from app.services.shared_state import close_shared_state
+from app.services.rate_limit import warm_rate_limiter
+from app.services.log_writer import request_log_writer
+from app.services.key_usage import key_usage
+from app.services.log_retention import create_partitioned_request_logs
+from app.services.metrics import install_db_metrics, registry as metrics_registry
+from app.services.upstream_proxy_pool import UpstreamProxyPool
+from app.tasks.scheduler import start_background_tasks
 
 logging.basicConfig(level=logging.INFO)
 
 app = FastAPI(title=settings.app_name)
+install_db_metrics(engine)
+
+
+# CSP: keep it simple. The UI uses external JS/CSS but does use inline style attributes,
+# so we allow 'unsafe-inline' for styles only.
+_SECURITY_HEADERS = (
+    (b"x-content-type-options", b"nosniff"),
+    (b"x-frame-options", b"DENY"),
+    (b"referrer-policy", b"no-referrer"),
+    (
+        b"content-security-policy",
+        b"default-src 'self'; img-src 'self' data: blob:; "
+        b"connect-src 'self'; script-src 'self'; style-src 'self' 'unsafe-inline';",
+    ),
+)
+_NODE_HEADER = b"x-novelaipool-node"
+
 
+class ResponseHeadersMiddleware:
+    """Adds the node id and security headers to `http.response.start`; bodies pass straight through."""
 
-class NodeIdHeaderMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
+    def __init__(self, app) -> None:
+        self.app = app
+        # node_id is a startup-only setting (not overridable via SystemConfig).
         node_id = getattr(settings, "node_id", None)
-        if node_id:
-            response.headers["X-NovelAIPool-Node"] = str(node_id)
-        return response
-
-
-app.add_middleware(NodeIdHeaderMiddleware)
-
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers.setdefault("X-Content-Type-Options", "nosniff")
-        response.headers.setdefault("X-Frame-Options", "DENY")
-        response.headers.setdefault("Referrer-Policy", "no-referrer")
-        # CSP: keep it simple. The UI uses external JS/CSS but does use inline style attributes,
-        # so we allow 'unsafe-inline' for styles only.
-        response.headers.setdefault(
-            "Content-Security-Policy",
-            "default-src 'self'; img-src 'self' data: blob:; "
-            "connect-src 'self'; script-src 'self'; style-src 'self' 'unsafe-inline';",
-        )
-        return response
-
-
-app.add_middleware(SecurityHeadersMiddleware)
-
-class SystemConfigRefreshMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        if settings.multi_node_enabled and getattr(settings, "system_config_refresh_enabled", True):
-            interval = max(1, int(getattr(settings, "system_config_refresh_interval_seconds", 5) or 5))
-            now = _time.time()
-            last_check = getattr(app.state, "_cfg_last_check_ts", 0.0)
-            if now - last_check >= interval:
-                lock = getattr(app.state, "_cfg_lock", None)
-                if lock is None:
-                    lock = asyncio.Lock()
-                    app.state._cfg_lock = lock
-                async with lock:
-                    last_check = getattr(app.state, "_cfg_last_check_ts", 0.0)
-                    now = _time.time()
-                    if now - last_check >= interval:
-                        try:
-                            async with AsyncSessionLocal() as db:
-                                latest = await get_system_config_updated_at(db)
-                                cached = getattr(app.state, "_cfg_last_updated_at", None)
-                                if latest and (cached is None or latest > cached):
-                                    app.state._cfg_last_updated_at = await load_system_config_into_settings(db)
-                                    reconcile_background_tasks(asyncio.get_running_loop())
-                        except Exception:
-                            pass
-                        app.state._cfg_last_check_ts = now
-
-        return await call_next(request)
-
-
-app.add_middleware(SystemConfigRefreshMiddleware)
+        self.node_header = (_NODE_HEADER, str(node_id).encode("latin-1")) if node_id else None
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", ()))
+                if self.node_header is not None:
+                    headers = [h for h in headers if h[0].lower() != _NODE_HEADER]
+                    headers.append(self.node_header)
+                present = {h[0].lower() for h in headers}
+                headers.extend(h for h in _SECURITY_HEADERS if h[0] not in present)
+                message["headers"] = headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+app.add_middleware(ResponseHeadersMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -150,6 +149,19 @@ async def readyz():
         return payload
     return JSONResponse(payload, status_code=503)
 
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if not settings.metrics_enabled:
+        return Response(status_code=404)
+    token = settings.metrics_token
+    if token:
+        auth = request.headers.get("authorization", "")
+        provided = auth[7:] if auth.lower().startswith("bearer ") else ""
+        if not secrets.compare_digest(provided.encode(), token.encode()):
+            return Response(status_code=401, headers={"WWW-Authenticate": "Bearer"})
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
 app.include_router(auth.router)
 app.include_router(client_keys.router)
 app.include_router(keys.router)
@@ -174,19 +186,28 @@ async def _ensure_sqlite_schema() -> None:
             await conn.execute(text("ALTER TABLE api_keys ADD COLUMN cooldown_until DATETIME"))
 
 
+def _ensure_indexes(conn) -> None:
+    # create_all skips existing tables, so indexes added to models later are created here.
+    for index in RequestLog.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
 @app.on_event("startup")
 async def on_startup() -> None:
     async with engine.begin() as conn:
+        await conn.run_sync(create_partitioned_request_logs)
         await conn.run_sync(Base.metadata.create_all)
 
     await _ensure_sqlite_schema()
+    async with engine.begin() as conn:
+        await conn.run_sync(_ensure_indexes)
 
     async with AsyncSessionLocal() as db:
         if settings.multi_node_enabled:
             try:
-                app.state._cfg_last_updated_at = await load_system_config_into_settings(db)
-            except Exception:
-                app.state._cfg_last_updated_at = None
+                await system_config_watcher.load_all(db)
+            except Exception as exc:
+                logging.warning("Loading SystemConfig failed: %s", exc)
 
         result = await db.execute(select(User).where(User.username == settings.admin_username))
         admin_user = result.scalar_one_or_none()
@@ -208,5 +229,23 @@ async def on_startup() -> None:
                     "Admin password mismatch. Set ADMIN_FORCE_RESET=true to reset."
                 )
 
+        await key_scheduler.load(db)
+        await warm_rate_limiter(db)
+    admission_queue.install()
+    install_shared_leases()
+
+    UpstreamHttpClients.startup(UpstreamProxyPool.proxy_urls())
+    request_log_writer.start()
+    key_usage.start()
+
     loop = asyncio.get_event_loop()
     start_background_tasks(loop)
+
+
+@app.on_event("shutdown")
+async def on_shutdown() -> None:
+    await request_log_writer.stop()
+    await key_usage.stop()
+    await UpstreamHttpClients.aclose_all()
+    await close_shared_state()
+    await system_config_watcher.close()
@@ -1,13 +1,16 @@
 from datetime import datetime
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
     Boolean,
     DateTime,
     ForeignKey,
+    Index,
     Text,
     Float,
+    UniqueConstraint,
 )
 from sqlalchemy.orm import relationship
 
@@ -61,6 +64,13 @@ class ApiKey(Base):
 
 class RequestLog(Base):
     __tablename__ = "request_logs"
+    # Keyset pagination / filters (services/log_query.py); added to existing DBs at startup.
+    __table_args__ = (
+        Index("ix_request_logs_user_created", "user_id", "created_at"),
+        Index("ix_request_logs_key_created", "api_key_id", "created_at"),
+        Index("ix_request_logs_status_created", "status", "created_at"),
+        Index("ix_request_logs_created_id", "created_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
@@ -89,6 +99,18 @@ class SystemConfig(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
+class SystemConfigChange(Base):
+    """Change log of SystemConfig: the id is the config version other nodes poll / are notified of."""
+
+    __tablename__ = "system_config_changes"
+    # AUTOINCREMENT on SQLite so ids are never reused after the older row of a key is deleted.
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(100), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class ClientAPIKey(Base):
     """Client-facing API key for calling the relay."""
 
@@ -115,3 +137,50 @@ class AuthAttempt(Base):
     action = Column(String(20), nullable=False, index=True)  # login | register
     success = Column(Boolean, default=False, index=True)
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class UsageRollup(Base):
+    """Aggregated request_logs per (granularity, bucket, user, key); see services/usage_rollup.py."""
+
+    __tablename__ = "usage_rollups"
+    __table_args__ = (
+        UniqueConstraint("granularity", "bucket_start", "user_id", "api_key_id", name="uq_usage_rollups_bucket"),
+        Index("ix_usage_rollups_granularity_bucket", "granularity", "bucket_start"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String(10), nullable=False)  # minute | day
+    bucket_start = Column(DateTime, nullable=False)
+    user_id = Column(Integer, nullable=False, index=True)
+    api_key_id = Column(Integer, nullable=False, default=0, index=True)  # 0 = no upstream key used
+    requests = Column(Integer, default=0)
+    successes = Column(Integer, default=0)
+    failures = Column(Integer, default=0)
+    rejected = Column(Integer, default=0)
+    retries = Column(Integer, default=0)
+    latency_sum_ms = Column(Float, default=0.0)
+    latency_count = Column(Integer, default=0)
+    # Comma-separated counts per usage_rollup.LATENCY_BUCKETS_MS (+ overflow), for p50/p95.
+    latency_histogram = Column(String(255), default="")
+    pixel_steps = Column(BigInteger, default=0)
+
+
+class RollupWatermark(Base):
+    """Last request_logs id folded into the rollups."""
+
+    __tablename__ = "rollup_watermarks"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+    last_id = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class SharedStateEntry(Base):
+    """Counters, leases and cooldown markers of the db shared-state backend (services/shared_state.py)."""
+
+    __tablename__ = "shared_state"
+
+    key = Column(String(200), primary_key=True)
+    value = Column(Float, nullable=False, default=0)
+    expires_at = Column(Float, nullable=False, index=True)  # epoch seconds
@@ -1,18 +1,35 @@
 import asyncio
+from datetime import datetime
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.config import settings
 from app.database import get_db
-from app.models import ApiKey, RequestLog, SystemConfig, User
+from app.models import ApiKey, SystemConfig, User
+from app.services.admission import admission_queue
 from app.services.auth import get_current_user
-from app.services.health_check import check_all_keys
+from app.services.auth_cache import auth_cache
+from app.services.health_check import check_all_keys, get_sweep_progress, start_background_sweep
+from app.services.health_schedule import health_check_planner
+from app.services.key_cache import decrypted_key_cache
+from app.services.key_scheduler import key_scheduler
+from app.services.key_usage import key_usage
+from app.services.log_query import LogFilters, export_logs, fetch_page, usernames_for
+from app.services.log_retention import get_retention_progress
+from app.services.log_writer import request_log_writer
+from app.services.rate_limit import get_rate_limiter, quota_cache
+from app.services.runtime_config import build_runtime_config, refresh_runtime_config
+from app.services.shared_state import stats as shared_state_stats
+from app.services.stage_timing import trace_sampler
 from app.services.upstream_proxy_pool import UpstreamProxyPool
+from app.services.usage_rollup import query_usage, usage_since
+from app.services.upstream_http import UpstreamHttpClients
 from app.tasks.scheduler import reconcile_background_tasks
-from app.services.system_config import is_config_key_allowed
+from app.services.system_config import is_config_key_allowed, record_config_change, system_config_watcher
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -85,6 +102,7 @@ async def list_keys(
             "fail_streak": k.fail_streak,
             "cooldown_until": k.cooldown_until,
             "last_checked_at": k.last_checked_at,
+            "in_flight": key_scheduler.in_flight(k.id),
         }
         for (k, username) in rows
     ]
@@ -103,6 +121,10 @@ async def toggle_key(
         raise HTTPException(status_code=404, detail="Key not found")
     key.is_enabled = not key.is_enabled
     await db.commit()
+    key_scheduler.upsert(key)
+    quota_cache.invalidate(key.user_id)
+    if not key.is_enabled:
+        decrypted_key_cache.invalidate(key.id)
     return {"id": key.id, "is_enabled": key.is_enabled}
 
 
@@ -116,6 +138,14 @@ async def update_config(
     key = (data.key or "").strip()
     if not is_config_key_allowed(key):
         raise HTTPException(status_code=400, detail="This config key is not allowed via API")
+    value = None
+    if hasattr(settings, key):
+        # Validate the change against a copy before anything is written or applied.
+        try:
+            value = _cast_value(data.value, getattr(settings, key))
+            build_runtime_config(settings.model_copy(update={key: value}))
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=f"Invalid value for {key}: {exc}")
     result = await db.execute(select(SystemConfig).where(SystemConfig.key == key))
     item = result.scalar_one_or_none()
     if not item:
@@ -123,10 +153,12 @@ async def update_config(
         db.add(item)
     else:
         item.value = data.value
-    if hasattr(settings, key):
-        current = getattr(settings, key)
-        setattr(settings, key, _cast_value(data.value, current))
+    await record_config_change(db, key)
     await db.commit()
+    if hasattr(settings, key):
+        setattr(settings, key, value)
+        refresh_runtime_config()
+    quota_cache.clear()
     try:
         reconcile_background_tasks(asyncio.get_running_loop())
     except RuntimeError:
@@ -186,6 +218,8 @@ async def get_config(
         "upstream_proxy_keepalive_leader_only": settings.upstream_proxy_keepalive_leader_only,
         "upstream_proxy_keepalive_leader_node_id": settings.upstream_proxy_keepalive_leader_node_id,
         "upstream_proxies_configured": bool(settings.upstream_proxies.strip()),
+        "system_config_version": system_config_watcher.version,
+        "system_config_listening": system_config_watcher.listening,
     }
 
 
@@ -200,16 +234,86 @@ async def proxy_pool_status(user: User = Depends(get_current_user)):
     }
 
 
+@router.get("/upstream-clients")
+async def upstream_clients_status(user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {
+        "http2_enabled": settings.upstream_http2_enabled,
+        "max_connections": settings.upstream_max_connections,
+        "max_keepalive_connections": settings.upstream_max_keepalive_connections,
+        "keepalive_expiry_seconds": settings.upstream_keepalive_expiry_seconds,
+        "items": UpstreamHttpClients.snapshot(),
+    }
+
+
+@router.get("/caches")
+async def cache_stats(user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {
+        "decrypted_keys": decrypted_key_cache.stats(),
+        "user_quota": quota_cache.stats(),
+        "auth": auth_cache.stats(),
+    }
+
+
+@router.get("/log-writer")
+async def log_writer_status(user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {
+        "request_logs": request_log_writer.stats(),
+        "key_usage": key_usage.stats(),
+    }
+
+
+@router.get("/log-retention")
+async def log_retention_status(user: User = Depends(get_current_user)):
+    require_admin(user)
+    # Only the node running the retention job has a last run.
+    return {
+        "node_id": settings.node_id,
+        "retention_days": settings.log_retention_days,
+        "auth_attempt_retention_days": settings.auth_attempt_retention_days,
+        "last_run": get_retention_progress(),
+    }
+
+
+@router.get("/admission")
+async def admission_status(user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {"queue": admission_queue.stats(), "scheduler": key_scheduler.snapshot()}
+
+
+@router.get("/shared-state")
+async def shared_state_status(user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {"node_id": settings.node_id, "rate_limiter": get_rate_limiter().name, **shared_state_stats()}
+
+
+@router.get("/traces")
+async def recent_traces(limit: int = 100, user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {"sampler": trace_sampler.stats(), "traces": trace_sampler.recent(min(limit, 1000))}
+
+
 @router.post("/health-check")
 async def trigger_health_check(
+    background: bool = False,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
     require_admin(user)
+    if background:
+        return start_background_sweep()
     total = await check_all_keys(db)
     return {"checked": total}
 
 
+@router.get("/health-check")
+async def health_check_progress(user: User = Depends(get_current_user)):
+    require_admin(user)
+    return {"sweep": get_sweep_progress(), "schedule": health_check_planner.snapshot()}
+
+
 @router.patch("/users/{user_id}")
 async def update_user(
     user_id: int,
@@ -227,27 +331,106 @@ async def update_user(
     if data.is_active is not None:
         target.is_active = data.is_active
     await db.commit()
+    quota_cache.invalidate(target.id)
+    auth_cache.invalidate_user(target.id)
     return {"id": target.id, "manual_rpm": target.manual_rpm, "is_active": target.is_active}
 
 
+@router.get("/usage")
+async def usage_stats(
+    granularity: str = "day",
+    days: int = 30,
+    hours: int = 24,
+    group_by: str = "bucket",
+    user_id: int | None = None,
+    api_key_id: int | None = None,
+    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    require_admin(user)
+    if group_by not in ("bucket", "user", "key"):
+        raise HTTPException(status_code=400, detail="group_by must be bucket, user or key")
+    try:
+        since = usage_since(granularity, days, hours)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    items = await query_usage(
+        db, granularity, since, group_by=group_by, user_id=user_id, api_key_id=api_key_id
+    )
+    if group_by == "user" and items:
+        result = await db.execute(
+            select(User.id, User.username).where(User.id.in_([item["user_id"] for item in items]))
+        )
+        names = dict(result.all())
+        for item in items:
+            item["username"] = names.get(item["user_id"])
+    return items
+
+
+async def _admin_log_filters(
+    db: AsyncSession,
+    user_id: int | None,
+    username: str | None,
+    api_key_id: int | None,
+    status: str | None,
+    status_code: int | None,
+    action: str | None,
+    since: datetime | None,
+    until: datetime | None,
+) -> LogFilters | None:
+    """None when `username` matches no user (empty result)."""
+    if username:
+        result = await db.execute(select(User.id).where(User.username == username))
+        found = result.scalar_one_or_none()
+        if found is None or (user_id is not None and user_id != found):
+            return None
+        user_id = found
+    return LogFilters(
+        user_id=user_id,
+        api_key_id=api_key_id,
+        status=status,
+        status_code=status_code,
+        action=action,
+        since=since,
+        until=until,
+    )
+
+
 @router.get("/logs")
 async def list_logs(
+    response: Response,
+    limit: int = 200,
+    cursor: str | None = None,
+    user_id: int | None = None,
+    username: str | None = None,
+    api_key_id: int | None = None,
+    status: str | None = None,
+    status_code: int | None = None,
+    action: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
     require_admin(user)
-    result = await db.execute(
-        select(RequestLog, User.username)
-        .join(User, User.id == RequestLog.user_id)
-        .order_by(RequestLog.created_at.desc())
-        .limit(200)
-    )
-    rows = result.all()
+    # Keyset pagination: pass the X-Next-Cursor response header back as `cursor`.
+    if not cursor:
+        await request_log_writer.flush()
+    filters = await _admin_log_filters(db, user_id, username, api_key_id, status, status_code, action, since, until)
+    if filters is None:
+        return []
+    try:
+        logs, next_cursor = await fetch_page(db, filters, cursor, min(max(1, limit), 1000))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    names = await usernames_for(db, logs)
     include_ip = settings.log_request_ip
     return [
         {
             "id": log.id,
-            "username": username,
+            "username": names.get(log.user_id),
             "action": log.action,
             "status": log.status,
             "status_code": log.status_code,
@@ -257,5 +440,35 @@ async def list_logs(
             "created_at": log.created_at,
             "ip_address": log.ip_address if include_ip else None,
         }
-        for (log, username) in rows
+        for log in logs
     ]
+
+
+@router.get("/logs/export")
+async def export_logs_endpoint(
+    format: str = "ndjson",
+    limit: int | None = None,
+    user_id: int | None = None,
+    username: str | None = None,
+    api_key_id: int | None = None,
+    status: str | None = None,
+    status_code: int | None = None,
+    action: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    require_admin(user)
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    await request_log_writer.flush()
+    # None for an unknown username: the export is empty (CSV header only), as /logs returns [].
+    filters = await _admin_log_filters(db, user_id, username, api_key_id, status, status_code, action, since, until)
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"request_logs_{datetime.utcnow():%Y%m%d%H%M%S}.{'csv' if format == 'csv' else 'ndjson'}"
+    return StreamingResponse(
+        export_logs(filters, format, settings.log_request_ip, max_rows=limit if limit and limit > 0 else None),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
@@ -6,6 +6,7 @@ from sqlalchemy import select, update, delete
 from app.database import get_db
 from app.models import ClientAPIKey, User
 from app.services.auth import get_current_user, generate_client_api_key, hash_client_api_key, mask_api_key
+from app.services.auth_cache import auth_cache
 
 router = APIRouter(prefix="/client-keys", tags=["client-keys"])
 
@@ -63,6 +64,8 @@ async def create_key(
     )
     db.add(obj)
     await db.commit()
+    if data.rotate:
+        auth_cache.invalidate_user(user.id)
     await db.refresh(obj)
     return {"api_key": raw, "api_key_masked": mask_api_key(raw), "id": obj.id}
 
@@ -82,6 +85,7 @@ async def update_key(
         raise HTTPException(status_code=404, detail="Key not found")
     obj.is_active = bool(data.is_active)
     await db.commit()
+    auth_cache.invalidate_token(obj.key_hash)
     return {"id": obj.id, "is_active": obj.is_active}
 
 
@@ -98,8 +102,10 @@ async def delete_key(
     if not obj:
         raise HTTPException(status_code=404, detail="Key not found")
 
+    key_hash = obj.key_hash
     await db.execute(
         delete(ClientAPIKey).where(ClientAPIKey.id == key_id, ClientAPIKey.user_id == user.id)
     )
     await db.commit()
+    auth_cache.invalidate_token(key_hash)
     return {"message": "deleted"}
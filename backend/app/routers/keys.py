@@ -9,6 +9,9 @@ from app.models import ApiKey, User
 from app.services.auth import get_current_user
 from app.services.crypto import encrypt_text
 from app.services.health_check import check_key_health
+from app.services.key_cache import decrypted_key_cache
+from app.services.key_scheduler import key_scheduler
+from app.services.rate_limit import quota_cache
 
 router = APIRouter(prefix="/keys", tags=["keys"])
 
@@ -41,10 +44,12 @@ async def upload_key(
     db.add(key)
     await db.commit()
     await db.refresh(key)
+    quota_cache.invalidate(user.id)
 
     if data.verify_now:
         await check_key_health(db, key)
         await db.commit()
+    key_scheduler.upsert(key)
 
     return {"id": key.id, "status": key.status}
 
@@ -84,4 +89,7 @@ async def delete_key(
         raise HTTPException(status_code=404, detail="Key not found")
     await db.delete(key)
     await db.commit()
+    key_scheduler.remove(key_id)
+    decrypted_key_cache.invalidate(key_id)
+    quota_cache.invalidate(user.id)
     return {"message": "deleted"}
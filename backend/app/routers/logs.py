@@ -1,26 +1,43 @@
-from fastapi import APIRouter, Depends
+from datetime import datetime
+
+from fastapi import APIRouter, Depends, HTTPException, Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select
 
 from app.database import get_db
-from app.models import RequestLog, User
+from app.models import User
 from app.services.auth import get_current_user
+from app.services.log_query import LogFilters, fetch_page
+from app.services.log_writer import request_log_writer
+from app.services.usage_rollup import query_usage, usage_since
 
 router = APIRouter(prefix="/logs", tags=["logs"])
 
 
 @router.get("")
 async def list_my_logs(
+    response: Response,
+    limit: int = 50,
+    cursor: str | None = None,
+    api_key_id: int | None = None,
+    status: str | None = None,
+    status_code: int | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
     user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
-    result = await db.execute(
-        select(RequestLog)
-        .where(RequestLog.user_id == user.id)
-        .order_by(RequestLog.created_at.desc())
-        .limit(50)
+    # Keyset pagination: pass the X-Next-Cursor response header back as `cursor`.
+    if not cursor:
+        await request_log_writer.flush()
+    filters = LogFilters(
+        user_id=user.id, api_key_id=api_key_id, status=status, status_code=status_code, since=since, until=until
     )
-    logs = result.scalars().all()
+    try:
+        logs, next_cursor = await fetch_page(db, filters, cursor, min(max(1, limit), 200))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [
         {
             "id": log.id,
@@ -38,3 +55,22 @@ async def list_my_logs(
         }
         for log in logs
     ]
+
+
+@router.get("/usage")
+async def my_usage(
+    granularity: str = "day",
+    days: int = 30,
+    hours: int = 24,
+    group_by: str = "bucket",
+    user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    # Served from the usage rollups (lag: USAGE_ROLLUP_SETTLE_SECONDS + one rollup interval).
+    if group_by not in ("bucket", "key"):
+        raise HTTPException(status_code=400, detail="group_by must be bucket or key")
+    try:
+        since = usage_since(granularity, days, hours)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return await query_usage(db, granularity, since, group_by=group_by, user_id=user.id)
@@ -1,21 +1,39 @@
 import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Mapping
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse, Response
-from sqlalchemy.ext.asyncio import AsyncSession
-
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import anyio
 import httpx
 
-from app.config import settings
-from app.database import get_db
-from app.models import ApiKey, RequestLog, User
-from sqlalchemy import select, func
+from app.database import AsyncSessionLocal
+from app.models import ApiKey, RequestLog
+from app.services.admission import AdmissionRejected, admission_queue
 from app.services.auth import get_current_user_any
-from app.services.key_pool import select_healthy_key
-from app.services.rate_limit import enforce_rate_limit
+from app.services.auth_cache import AuthPrincipal
+from app.services.key_pool import (
+    claim_shared_key,
+    lease_renew_interval,
+    publish_key_cooldown,
+    renew_lease,
+)
+from app.services.key_scheduler import KeyEntry, KeyLease, key_scheduler
+from app.services.key_usage import key_usage
+from app.services import metrics
+from app.services.log_writer import request_log_writer
+from app.services.rate_limit import (
+    RETRY_LOG_ACTION,
+    enforce_rate_limit,
+    get_user_quota,
+    quota_cache,
+    record_request,
+)
+from app.services.runtime_config import RuntimeConfig, backoff, runtime_config
 from app.services.upstream_proxy_pool import UpstreamProxyPool
+from app.services.upstream_http import UpstreamHttpClients
 from app.services.request_meta import get_client_ip
+from app.services.stage_timing import request_timer
 
 router = APIRouter(prefix="/v1/novelai", tags=["proxy"])
 
@@ -34,7 +52,7 @@ def _parse_retry_after(headers: Mapping[str, str] | None) -> int | None:
         return None
 
 
-def _set_key_cooldown(key: ApiKey, seconds: int) -> None:
+def _set_key_cooldown(key: ApiKey | KeyEntry, seconds: int) -> None:
     if seconds <= 0:
         return
     until = datetime.utcnow() + timedelta(seconds=seconds)
@@ -42,18 +60,8 @@ def _set_key_cooldown(key: ApiKey, seconds: int) -> None:
         key.cooldown_until = until
 
 
-def _compute_backoff(base_seconds: int, fail_streak: int, max_seconds: int) -> int:
-    # Exponential backoff: base * 2^(fail_streak-1), capped.
-    if base_seconds <= 0:
-        return 0
-    streak = max(1, int(fail_streak or 1))
-    factor = 2 ** min(streak - 1, 4)
-    seconds = base_seconds * factor
-    return min(seconds, max_seconds) if max_seconds > 0 else seconds
-
-
 def _update_key_from_upstream(
-    key: ApiKey, status_code: int, message: str | None, headers: Mapping[str, str] | None = None
+    key: ApiKey | KeyEntry, status_code: int, message: str | None, headers: Mapping[str, str] | None = None
 ) -> None:
     """
     Update key health hints from upstream results.
@@ -64,7 +72,19 @@ def _update_key_from_upstream(
     - 5xx/502/504: transient, increase streak; mark unhealthy if persistent
     """
     msg = message or ""
+    previous_status = key.status
+    _apply_upstream_failure(key, status_code, msg, headers)
+    if key.status != previous_status:
+        quota_cache.invalidate(key.user_id)
+
+
+def _apply_upstream_failure(
+    key: ApiKey | KeyEntry, status_code: int, msg: str, headers: Mapping[str, str] | None
+) -> None:
     key.last_error = f"{status_code}: {msg}"[:1000] if msg else f"{status_code}"
+    cfg = runtime_config()
+    # Exponential backoff tables (base * 2^(fail_streak-1), capped) are precompiled per status class.
+    tables = cfg.key_backoff
 
     if status_code in (401, 403):
         key.status = "invalid"
@@ -73,25 +93,17 @@ def _update_key_from_upstream(
 
     if status_code == 402:
         key.fail_streak += 1
-        if settings.dynamic_cooldown_enabled:
-            _set_key_cooldown(
-                key,
-                _compute_backoff(
-                    settings.cooldown_402_base_seconds,
-                    key.fail_streak,
-                    settings.cooldown_max_seconds,
-                ),
-            )
-        if key.fail_streak >= settings.health_check_fail_threshold:
+        if cfg.dynamic_cooldown:
+            _set_key_cooldown(key, backoff(tables["402"], key.fail_streak))
+        if key.fail_streak >= cfg.health_check_fail_threshold:
             key.status = "unhealthy"
         return
 
     if status_code in (409, 429):
         # Likely concurrency/rate-limit; avoid quickly kicking the key out of the pool.
-        key.fail_streak = min(key.fail_streak + 1, settings.health_check_fail_threshold)
-        if settings.dynamic_cooldown_enabled:
-            base = settings.cooldown_429_base_seconds if status_code == 429 else settings.cooldown_409_base_seconds
-            cooldown = _compute_backoff(base, key.fail_streak, settings.cooldown_max_seconds)
+        key.fail_streak = min(key.fail_streak + 1, cfg.health_check_fail_threshold)
+        if cfg.dynamic_cooldown:
+            cooldown = backoff(tables["429"] if status_code == 429 else tables["409"], key.fail_streak)
             if status_code == 429:
                 retry_after = _parse_retry_after(headers)
                 if retry_after is not None:
@@ -101,37 +113,39 @@ def _update_key_from_upstream(
 
     if status_code >= 500 or status_code in (502, 504):
         key.fail_streak += 1
-        if settings.dynamic_cooldown_enabled:
-            _set_key_cooldown(
-                key,
-                _compute_backoff(
-                    settings.cooldown_5xx_base_seconds,
-                    key.fail_streak,
-                    settings.cooldown_max_seconds,
-                ),
-            )
-        if key.fail_streak >= settings.health_check_fail_threshold:
+        if cfg.dynamic_cooldown:
+            _set_key_cooldown(key, backoff(tables["5xx"], key.fail_streak))
+        if key.fail_streak >= cfg.health_check_fail_threshold:
             key.status = "unhealthy"
         return
 
     # Other 4xx: treat as transient/unknown; track streak and only mark unhealthy after threshold.
     if status_code >= 400:
         key.fail_streak += 1
-        if settings.dynamic_cooldown_enabled:
+        if cfg.dynamic_cooldown:
             # For unknown 4xx, apply a small backoff to reduce repeated failures.
-            _set_key_cooldown(
-                key,
-                _compute_backoff(
-                    settings.cooldown_409_base_seconds,
-                    key.fail_streak,
-                    settings.cooldown_max_seconds,
-                ),
-            )
-        if key.fail_streak >= settings.health_check_fail_threshold:
+            _set_key_cooldown(key, backoff(tables["409"], key.fail_streak))
+        if key.fail_streak >= cfg.health_check_fail_threshold:
             key.status = "unhealthy"
 
 
-def _validate_opus_limits(payload: dict) -> tuple[int, int, int, int]:
+def _model_label(model) -> str:
+    if not isinstance(model, str):
+        return ""
+    # Keep metric label cardinality bounded to configured models.
+    return model if model in runtime_config().model_set else "other"
+
+
+async def _write_log(log: RequestLog, reason: str | None = None, model=None) -> None:
+    """Write a final request log; `reason` is a short metrics code for rejections / failures."""
+    record_request(log.user_id)
+    metrics.GENERATE_REQUESTS.inc(status=log.status, status_code=str(log.status_code), model=_model_label(model))
+    if reason:
+        metrics.GENERATE_REJECTIONS.inc(reason=reason)
+    await request_log_writer.submit(log)
+
+
+def _validate_opus_limits(payload: dict, cfg: RuntimeConfig) -> tuple[int, int, int, int]:
     if not isinstance(payload, dict):
         raise HTTPException(status_code=400, detail="Invalid JSON payload")
 
@@ -151,60 +165,362 @@ def _validate_opus_limits(payload: dict) -> tuple[int, int, int, int]:
         raise HTTPException(status_code=400, detail="Width/height must be > 0")
     if steps <= 0:
         raise HTTPException(status_code=400, detail="Steps must be > 0")
-    if width * height > settings.opus_max_pixels:
+    if width * height > cfg.opus_max_pixels:
         raise HTTPException(status_code=400, detail="Pixel limit exceeded")
-    if steps > settings.opus_max_steps:
+    if steps > cfg.opus_max_steps:
         raise HTTPException(status_code=400, detail="Steps limit exceeded")
-    if n_samples != settings.opus_max_samples:
+    if n_samples != cfg.opus_max_samples:
         raise HTTPException(status_code=400, detail="n_samples must be 1")
     return width, height, steps, n_samples
 
 
+# Upstream headers forwarded unchanged on streamed responses (bytes are passed through raw).
+_STREAM_FORWARD_HEADERS = ("content-type", "content-length", "content-encoding", "content-disposition")
+
+
+def _upstream_error_reason(resp: httpx.Response) -> str:
+    try:
+        content_type = resp.headers.get("content-type", "")
+        if "application/json" in content_type:
+            data = resp.json()
+            if isinstance(data, dict):
+                return data.get("message") or data.get("detail") or data.get("error") or str(data)[:200]
+            return str(data)[:200]
+        return resp.text[:200]
+    except Exception:
+        return f"HTTP {resp.status_code}"
+
+
+class _GenerationAttempt:
+    """Key / proxy bookkeeping and the request log for one upstream generate-image call."""
+
+    def __init__(
+        self,
+        request: Request,
+        user_id: int,
+        lease: KeyLease,
+        upstream_proxy: str | None,
+        dims: tuple[int, int, int, int],
+        cfg: RuntimeConfig,
+        model=None,
+    ) -> None:
+        self.request = request
+        self.timer = request_timer(request)
+        self.user_id = user_id
+        self.lease = lease
+        self.upstream_proxy = upstream_proxy
+        self.dims = dims
+        self.cfg = cfg
+        self.model = model
+        self.started = time.time()
+        self.handed_off = False
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            key_scheduler.release(self.lease)
+
+    async def finish(
+        self,
+        status: str,
+        status_code: int,
+        reject_reason: str | None,
+        headers: Mapping[str, str] | None = None,
+        *,
+        key_failed: bool | None = None,
+        final: bool = True,
+    ) -> None:
+        """
+        `key_failed` defaults to `status != "success"`; a client abort is not the key's fault.
+        Non-final (retried) attempts are logged as RETRY_LOG_ACTION and not rate-limit counted.
+        """
+        with self.timer.stage("log"):
+            await self._finish(status, status_code, reject_reason, headers, key_failed, final)
+
+    async def _finish(
+        self,
+        status: str,
+        status_code: int,
+        reject_reason: str | None,
+        headers: Mapping[str, str] | None,
+        key_failed: bool | None,
+        final: bool,
+    ) -> None:
+        latency = (time.time() - self.started) * 1000
+        metrics.UPSTREAM_DURATION.observe(latency / 1000, status_code=str(status_code))
+        if key_failed is None:
+            key_failed = status != "success"
+        # Apply the result to the in-memory key state; counters are written behind in batches.
+        # The entry is gone if the key was deleted while the upstream call was in flight.
+        key = key_scheduler.get(self.lease.key_id)
+        if key is not None:
+            previous_status = key.status
+            key.last_used_at = datetime.utcnow()
+            if not key_failed:
+                key.fail_streak = 0
+                key.last_error = None
+                key.cooldown_until = None
+            else:
+                _update_key_from_upstream(key, status_code, reject_reason, headers)
+                if key.cooldown_until is not None and key.cooldown_until > datetime.utcnow():
+                    publish_key_cooldown(key.id, key.cooldown_until)
+            key_usage.record(key, success=not key_failed, status_changed=key.status != previous_status)
+        if not key_failed:
+            UpstreamProxyPool.report_result(self.upstream_proxy, status_code=status_code)
+        else:
+            UpstreamProxyPool.report_result(self.upstream_proxy, status_code=status_code, error=reject_reason)
+
+        width, height, steps, samples = self.dims
+        log = RequestLog(
+            user_id=self.user_id,
+            api_key_id=key.id if key is not None else None,
+            ip_address=get_client_ip(self.request) if self.cfg.log_request_ip else None,
+            width=width,
+            height=height,
+            steps=steps,
+            samples=samples,
+            status=status,
+            status_code=status_code,
+            latency_ms=latency,
+            reject_reason=reject_reason,
+        )
+        if final:
+            reason = None
+            if status != "success":
+                reason = "client_closed" if status_code == 499 else f"upstream_{status_code}"
+            await _write_log(log, reason=reason, model=self.model)
+        else:
+            metrics.UPSTREAM_RETRIES.inc(status_code=str(status_code))
+            log.action = RETRY_LOG_ACTION
+            await request_log_writer.submit(log)
+
+
+@dataclass
+class _UpstreamFailure:
+    status_code: int
+    reason: str | None
+    headers: Mapping[str, str] | None
+    network_error: bool
+    response: Response
+
+    @property
+    def retryable(self) -> bool:
+        # Never 400/401/402/403 (or other 4xx): another key would fail the same way.
+        return self.network_error or self.status_code in (409, 429) or self.status_code >= 500
+
+    @property
+    def proxy_related(self) -> bool:
+        return (
+            self.network_error
+            or self.status_code >= 500
+            or (self.status_code == 429 and runtime_config().proxy_handle_429)
+        )
+
+
+async def _send_upstream(
+    attempt: _GenerationAttempt, raw_key: str, payload: dict, timeout: float
+) -> Response | _UpstreamFailure:
+    """
+    One upstream call. Successes are finished here (or handed to the streaming response);
+    failures are returned unfinished so the caller can decide whether to retry.
+    """
+    client = UpstreamHttpClients.get(attempt.upstream_proxy)
+    upstream_request = client.build_request(
+        "POST",
+        attempt.cfg.generate_image_url,
+        headers={"Authorization": f"Bearer {raw_key}"},
+        json=payload,
+        timeout=timeout,
+    )
+    try:
+        with attempt.timer.stage("upstream"):
+            resp = await client.send(upstream_request, stream=True)
+    except httpx.HTTPError as exc:
+        UpstreamProxyPool.report_result(attempt.upstream_proxy, status_code=None, error=str(exc))
+        return _UpstreamFailure(
+            502, str(exc), None, True, JSONResponse(status_code=502, content={"detail": "Upstream error"})
+        )
+
+    if resp.status_code < 400 and attempt.cfg.streaming_enabled:
+        # The response now owns the lease and the upstream stream; it finishes the attempt.
+        return _UpstreamStreamResponse(resp, attempt)
+
+    # Errors (small bodies we need to inspect) and the non-streaming mode are buffered.
+    try:
+        with attempt.timer.stage("upstream"):
+            await resp.aread()
+    except httpx.HTTPError as exc:
+        UpstreamProxyPool.report_result(attempt.upstream_proxy, status_code=None, error=str(exc))
+        return _UpstreamFailure(
+            502, str(exc), None, True, JSONResponse(status_code=502, content={"detail": "Upstream error"})
+        )
+    finally:
+        await resp.aclose()
+    response = Response(
+        content=resp.content,
+        status_code=resp.status_code,
+        media_type=resp.headers.get("content-type", "application/json"),
+    )
+    if resp.status_code >= 400:
+        return _UpstreamFailure(resp.status_code, _upstream_error_reason(resp), resp.headers, False, response)
+    await attempt.finish("success", resp.status_code, None)
+    return response
+
+
+class _UpstreamStreamResponse(StreamingResponse):
+    """
+    Forwards upstream bytes as they arrive. The attempt is finished (and the key lease released)
+    once the stream completes, the upstream aborts, or the client goes away.
+    """
+
+    def __init__(self, upstream: httpx.Response, attempt: _GenerationAttempt) -> None:
+        self.upstream = upstream
+        self.attempt = attempt
+        attempt.handed_off = True
+        # Body streaming and the log happen after the headers are sent; the response finishes the timer.
+        attempt.timer.deferred = True
+        self._completed = False
+        self._stream_error: str | None = None
+        headers = {k: upstream.headers[k] for k in _STREAM_FORWARD_HEADERS if k in upstream.headers}
+        super().__init__(
+            self._iter_upstream(),
+            status_code=upstream.status_code,
+            headers=headers,
+            media_type=upstream.headers.get("content-type"),
+        )
+
+    async def _iter_upstream(self):
+        started = time.perf_counter()
+        renew_every = lease_renew_interval()
+        renewed = started
+        try:
+            async for chunk in self.upstream.aiter_raw():
+                yield chunk
+                # A slow stream still holds the key: keep its lease from being reclaimed.
+                now = time.perf_counter()
+                if now - renewed >= renew_every:
+                    renewed = now
+                    renew_lease(self.attempt.lease)
+        except httpx.HTTPError as exc:
+            self._stream_error = str(exc)
+            raise
+        finally:
+            self.attempt.timer.add("stream", time.perf_counter() - started)
+        self._completed = True
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Shielded: on client disconnect the surrounding scope is already cancelled.
+            with anyio.CancelScope(shield=True):
+                await self._finish()
+
+    async def _finish(self) -> None:
+        status_code = self.upstream.status_code
+        try:
+            await self.upstream.aclose()
+            if self._completed:
+                await self.attempt.finish("success", status_code, None)
+            elif self._stream_error is not None:
+                status_code = 502
+                UpstreamProxyPool.report_result(self.attempt.upstream_proxy, status_code=None, error=self._stream_error)
+                await self.attempt.finish("failed", 502, self._stream_error)
+            else:
+                status_code = 499
+                await self.attempt.finish("failed", 499, "Client closed request", key_failed=False)
+        finally:
+            self.attempt.release()
+            self.attempt.timer.finish(status_code)
+
+
+async def _next_key(
+    user_id: int, weight: int, tried_keys: set[int], deadline: float
+) -> tuple[KeyLease, str] | None:
+    """Key for a failover retry: waits in the admission queue (at most until the deadline)."""
+    try:
+        selected = await admission_queue.acquire(
+            user_id, weight=weight, exclude=tried_keys, max_wait=deadline - time.monotonic()
+        )
+    except AdmissionRejected:
+        return None
+    return await claim_shared_key(selected, exclude=tried_keys)
+
+
 @router.get("/models")
-async def list_models(user: User = Depends(get_current_user_any)):
-    models = [m.strip() for m in settings.novelai_models.split(",") if m.strip()]
-    return {"models": models}
+async def list_models(user: AuthPrincipal = Depends(get_current_user_any)):
+    return {"models": list(runtime_config().models)}
 
 
 @router.post("/generate-image")
 async def generate_image(
     request: Request,
-    user: User = Depends(get_current_user_any),
-    db: AsyncSession = Depends(get_db),
+    user: AuthPrincipal = Depends(get_current_user_any),
 ):
+    started = time.perf_counter()
+    timer = request_timer(request)
+    status_code = 500
     try:
-        await enforce_rate_limit(db, user)
-    except PermissionError as exc:
+        response = await _generate_image(request, user)
+        status_code = response.status_code
+        if timer.enabled and runtime_config().server_timing_header:
+            response.headers["Server-Timing"] = timer.server_timing()
+        return response
+    except HTTPException as exc:
+        status_code = exc.status_code
+        if timer.enabled and runtime_config().server_timing_header:
+            exc.headers = {**(exc.headers or {}), "Server-Timing": timer.server_timing()}
+        raise
+    finally:
+        metrics.GENERATE_DURATION.observe(time.perf_counter() - started, status_code=str(status_code))
+        if not timer.deferred:
+            timer.finish(status_code)
+
+
+async def _generate_image(request: Request, user: AuthPrincipal) -> Response:
+    timer = request_timer(request)
+    # One config snapshot for the whole request, however the settings change meanwhile.
+    cfg = runtime_config()
+    # The only DB work on this path, in one short session: its connection is back in the pool
+    # before the upstream call. Logs and key usage are written behind in their own sessions.
+    async with AsyncSessionLocal() as db:
+        try:
+            with timer.stage("rate_limit"):
+                await enforce_rate_limit(db, user)
+        except PermissionError as exc:
+            rate_limited = exc
+        else:
+            rate_limited = None
+            with timer.stage("quota"):
+                quota = await get_user_quota(db, user.id)
+
+    if rate_limited is not None:
         log = RequestLog(
             user_id=user.id,
             status="rejected",
             status_code=429,
-            reject_reason=str(exc),
-            ip_address=get_client_ip(request) if settings.log_request_ip else None,
+            reject_reason=str(rate_limited),
+            ip_address=get_client_ip(request) if cfg.log_request_ip else None,
         )
-        db.add(log)
-        await db.commit()
-        raise HTTPException(status_code=429, detail=str(exc))
+        with timer.stage("log"):
+            await _write_log(log, reason="rate_limited")
+        raise HTTPException(status_code=429, detail=str(rate_limited))
 
     # Must contribute at least one key to use generation.
-    result = await db.execute(
-        select(func.count(ApiKey.id))
-        .where(ApiKey.user_id == user.id)
-        .where(ApiKey.is_enabled == True)
-    )
-    key_count = result.scalar() or 0
-    if key_count <= 0:
+    if quota.contributed_count <= 0:
         log = RequestLog(
             user_id=user.id,
             status="rejected",
             status_code=403,
             reject_reason="未贡献密钥，无法使用生图功能",
-            ip_address=get_client_ip(request) if settings.log_request_ip else None,
+            ip_address=get_client_ip(request) if cfg.log_request_ip else None,
         )
-        db.add(log)
-        await db.commit()
+        with timer.stage("log"):
+            await _write_log(log, reason="no_contribution")
         raise HTTPException(status_code=403, detail="未贡献密钥，无法使用生图功能")
 
+    validate_started = time.perf_counter()
     try:
         payload = await request.json()
     except Exception:
@@ -213,29 +529,28 @@ async def generate_image(
             status="rejected",
             status_code=400,
             reject_reason="Invalid JSON body",
-            ip_address=get_client_ip(request) if settings.log_request_ip else None,
+            ip_address=get_client_ip(request) if cfg.log_request_ip else None,
         )
-        db.add(log)
-        await db.commit()
+        with timer.stage("log"):
+            await _write_log(log, reason="invalid_json")
         raise HTTPException(status_code=400, detail="Invalid JSON body")
     if isinstance(payload, dict) and "model" not in payload:
-        payload["model"] = settings.novelai_default_model
+        payload["model"] = cfg.default_model
     if isinstance(payload, dict):
-        allowed_models = {m.strip() for m in settings.novelai_models.split(",") if m.strip()}
         model = payload.get("model")
-        if allowed_models and model not in allowed_models:
+        if cfg.model_set and model not in cfg.model_set:
             log = RequestLog(
                 user_id=user.id,
                 status="rejected",
                 status_code=400,
                 reject_reason=f"不支持的模型: {model}",
-                ip_address=get_client_ip(request) if settings.log_request_ip else None,
+                ip_address=get_client_ip(request) if cfg.log_request_ip else None,
             )
-            db.add(log)
-            await db.commit()
+            with timer.stage("log"):
+                await _write_log(log, reason="unsupported_model", model=model)
             raise HTTPException(status_code=400, detail=f"不支持的模型: {model}")
     try:
-        width, height, steps, samples = _validate_opus_limits(payload)
+        width, height, steps, samples = _validate_opus_limits(payload, cfg)
     except HTTPException as exc:
         log = RequestLog(
             user_id=user.id,
@@ -246,95 +561,69 @@ async def generate_image(
             status="rejected",
             status_code=exc.status_code,
             reject_reason=str(exc.detail),
-            ip_address=get_client_ip(request) if settings.log_request_ip else None,
+            ip_address=get_client_ip(request) if cfg.log_request_ip else None,
         )
-        db.add(log)
-        await db.commit()
+        with timer.stage("log"):
+            await _write_log(
+                log, reason="invalid_params", model=payload.get("model") if isinstance(payload, dict) else None
+            )
         raise
+    timer.add("validate", time.perf_counter() - validate_started)
 
-    selected = await select_healthy_key(db)
+    weight = max(1, quota.healthy_count)
+    try:
+        # Queue wait plus lease and (cached) key decryption.
+        with timer.stage("key"):
+            selected = await admission_queue.acquire(user.id, weight=weight)
+            selected = await claim_shared_key(selected)
+    except AdmissionRejected as exc:
+        metrics.GENERATE_REJECTIONS.inc(reason="queue_full" if exc.status_code == 503 else "queue_user_limit")
+        raise HTTPException(status_code=exc.status_code, detail=str(exc))
     if not selected:
+        metrics.GENERATE_REJECTIONS.inc(reason="no_key")
         raise HTTPException(status_code=503, detail="No healthy keys available")
-    key, raw_key = selected
-    upstream_proxy = UpstreamProxyPool.get_proxy_for_user(user.id)
-
-    start = time.time()
-    status = "success"
-    status_code = 200
-    reject_reason = None
 
-    try:
-        headers = {"Authorization": f"Bearer {raw_key}"}
-        async with httpx.AsyncClient(timeout=60.0, proxy=upstream_proxy) as client:
-            resp = await client.post(
-                "https://image.novelai.net/ai/generate-image",
-                headers=headers,
-                json=payload,
-            )
-        status_code = resp.status_code
-        if resp.status_code >= 400:
-            status = "failed"
-            try:
-                content_type = resp.headers.get("content-type", "")
-                if "application/json" in content_type:
-                    data = resp.json()
-                    if isinstance(data, dict):
-                        reject_reason = (
-                            data.get("message")
-                            or data.get("detail")
-                            or data.get("error")
-                            or str(data)[:200]
-                        )
-                    else:
-                        reject_reason = str(data)[:200]
-                else:
-                    reject_reason = resp.text[:200]
-            except Exception:
-                reject_reason = f"HTTP {resp.status_code}"
-        content_type = resp.headers.get("content-type", "application/json")
-        if "application/json" in content_type:
-            response = JSONResponse(content=resp.json(), status_code=resp.status_code)
-        else:
-            response = Response(
-                content=resp.content,
-                status_code=resp.status_code,
-                media_type=content_type,
+    # Failover loop: transient failures are retried on another key (and proxy) until the
+    # attempt limit or deadline. Only the final attempt counts against the user's RPM.
+    max_attempts = cfg.retry_max_attempts
+    deadline = time.monotonic() + cfg.retry_deadline_seconds
+    tried_keys: set[int] = set()
+    tried_proxies: set[str] = set()
+    attempt_no = 0
+    while True:
+        attempt_no += 1
+        timer.attempts = attempt_no
+        lease, raw_key = selected
+        selected = None
+        tried_keys.add(lease.key_id)
+        upstream_proxy = UpstreamProxyPool.get_proxy_for_user(user.id, exclude=tried_proxies)
+        attempt = _GenerationAttempt(
+            request=request,
+            user_id=user.id,
+            lease=lease,
+            upstream_proxy=upstream_proxy,
+            dims=(width, height, steps, samples),
+            cfg=cfg,
+            model=payload.get("model"),
+        )
+        try:
+            timeout = max(1.0, min(60.0, deadline - time.monotonic()))
+            result = await _send_upstream(attempt, raw_key, payload, timeout)
+            if not isinstance(result, _UpstreamFailure):
+                return result
+            if result.proxy_related and upstream_proxy:
+                tried_proxies.add(upstream_proxy)
+            if result.retryable and attempt_no < max_attempts and time.monotonic() < deadline:
+                selected = await _next_key(user.id, weight, tried_keys, deadline)
+            await attempt.finish(
+                "failed", result.status_code, result.reason, result.headers, final=selected is None
             )
-    except httpx.HTTPError as exc:
-        status = "failed"
-        status_code = 502
-        reject_reason = str(exc)
-        response = JSONResponse(status_code=502, content={"detail": "Upstream error"})
-        UpstreamProxyPool.report_result(upstream_proxy, status_code=None, error=str(exc))
-
-    latency = (time.time() - start) * 1000
-    key.total_requests += 1
-    key.last_used_at = datetime.utcnow()
-    if status == "success":
-        key.success_requests += 1
-        key.fail_streak = 0
-        key.last_error = None
-        key.cooldown_until = None
-        UpstreamProxyPool.report_result(upstream_proxy, status_code=status_code)
-    else:
-        key.fail_requests += 1
-        _update_key_from_upstream(key, status_code, reject_reason, resp.headers if "resp" in locals() else None)
-        UpstreamProxyPool.report_result(upstream_proxy, status_code=status_code, error=reject_reason)
-
-    log = RequestLog(
-        user_id=user.id,
-        api_key_id=key.id,
-        ip_address=get_client_ip(request) if settings.log_request_ip else None,
-        width=width,
-        height=height,
-        steps=steps,
-        samples=samples,
-        status=status,
-        status_code=status_code,
-        latency_ms=latency,
-        reject_reason=reject_reason,
-    )
-    db.add(log)
-    await db.commit()
-
-    return response
+            if selected is None:
+                return result.response
+        except BaseException:
+            if selected is not None:
+                key_scheduler.release(selected[0])
+            raise
+        finally:
+            if not attempt.handed_off:
+                attempt.release()
@@ -0,0 +1,217 @@
+"""
+Fair-share admission queue for upstream keys.
+
+When no key is free, `generate_image` used to answer 503 immediately, even if a key would leave
+its cooldown a moment later. Requests now wait (up to ADMISSION_MAX_WAIT_MS) in a weighted-fair
+queue: each waiter gets a virtual finish tag `max(virtual_time, user's last tag) + 1/weight`, and
+free keys go to the smallest tag, so a user with many queued requests cannot starve others.
+
+Waiters are served when the key scheduler reports a released / updated key, or by a timer set
+to the next cooldown expiry. Queue length is bounded in total and per user. A failover retry
+waits here too, with the keys it already tried excluded: such a waiter is passed over (keeping
+its place) while only keys it excludes are free.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
+
+from app.config import settings
+from app.services.key_pool import select_healthy_key
+from app.services.key_scheduler import KeyLease, key_scheduler
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str) -> None:
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+@dataclass(order=True)
+class _Waiter:
+    tag: float
+    seq: int
+    user_id: int = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    exclude: frozenset[int] = field(default=frozenset(), compare=False)
+
+
+class AdmissionQueue:
+    def __init__(self) -> None:
+        self._heap: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_tag: dict[int, float] = {}
+        self._per_user: dict[int, int] = {}
+        self._size = 0
+        self._dispatch_scheduled = False
+        self._timer: asyncio.TimerHandle | None = None
+        self.admitted_direct = 0
+        self.admitted_queued = 0
+        self.timeouts = 0
+        self.rejected_full = 0
+        self.rejected_user = 0
+        self.max_depth = 0
+        self.max_wait_ms = 0.0
+        self._wait_ms_total = 0.0
+
+    def install(self) -> None:
+        key_scheduler.on_available = self.notify
+
+    @property
+    def depth(self) -> int:
+        return self._size
+
+    def notify(self) -> None:
+        """A key may be free: dispatch on the next loop iteration (coalesced)."""
+        if not self._size or self._dispatch_scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._dispatch_scheduled = True
+        loop.call_soon(self._dispatch)
+
+    def _dispatch(self) -> None:
+        self._dispatch_scheduled = False
+        passed_over: list[_Waiter] = []
+        while self._heap:
+            waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue
+            try:
+                selected = select_healthy_key(exclude=waiter.exclude)
+            except Exception as exc:
+                self._leave(waiter)
+                waiter.future.set_exception(exc)
+                continue
+            if selected is None:
+                passed_over.append(waiter)
+                if not waiter.exclude:
+                    # No free key at all: later waiters cannot be served either.
+                    break
+                continue
+            self._leave(waiter)
+            self._virtual_time = max(self._virtual_time, waiter.tag)
+            waiter.future.set_result(selected)
+        for waiter in passed_over:
+            heapq.heappush(self._heap, waiter)
+        self._arm_timer()
+
+    def _arm_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._size:
+            # Idle: restart virtual time so tags do not grow without bound.
+            self._virtual_time = 0.0
+            self._last_tag.clear()
+            return
+        at = key_scheduler.next_eligible_at()
+        if at is None:
+            return
+        delay = max(0.02, (at - datetime.utcnow()).total_seconds())
+        self._timer = asyncio.get_running_loop().call_later(delay, self.notify)
+
+    def _leave(self, waiter: _Waiter) -> None:
+        self._size -= 1
+        remaining = self._per_user.get(waiter.user_id, 1) - 1
+        if remaining > 0:
+            self._per_user[waiter.user_id] = remaining
+        else:
+            self._per_user.pop(waiter.user_id, None)
+
+    async def acquire(
+        self,
+        user_id: int,
+        weight: float = 1.0,
+        exclude: Iterable[int] = (),
+        max_wait: float | None = None,
+    ) -> Optional[Tuple[KeyLease, str]]:
+        """
+        Lease a key other than `exclude`, waiting in the fair queue if none is free. None when the
+        wait (ADMISSION_MAX_WAIT_MS, or `max_wait` seconds if shorter) times out.
+        """
+        exclude = frozenset(exclude)
+        configured = max(0, int(settings.admission_max_wait_ms)) / 1000
+        max_wait = configured if max_wait is None else max(0.0, min(configured, max_wait))
+        # Fast path only when nobody is queued, so waiters keep their place.
+        if not self._size or max_wait <= 0:
+            selected = select_healthy_key(exclude=exclude)
+            if selected is not None:
+                self.admitted_direct += 1
+                return selected
+            if max_wait <= 0:
+                return None
+
+        if self._size >= max(1, int(settings.admission_queue_max_size)):
+            self.rejected_full += 1
+            raise AdmissionRejected(503, "Admission queue full")
+        if self._per_user.get(user_id, 0) >= max(1, int(settings.admission_queue_per_user_max)):
+            self.rejected_user += 1
+            raise AdmissionRejected(429, "Too many queued requests")
+
+        tag = max(self._virtual_time, self._last_tag.get(user_id, 0.0)) + 1.0 / max(weight, 0.01)
+        self._last_tag[user_id] = tag
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(tag=tag, seq=next(self._seq), user_id=user_id, future=future, exclude=exclude)
+        heapq.heappush(self._heap, waiter)
+        self._size += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self.max_depth = max(self.max_depth, self._size)
+        start = time.monotonic()
+        self._dispatch()
+
+        try:
+            await asyncio.wait({waiter.future}, timeout=max_wait)
+        except BaseException:
+            # Cancelled (client went away): give back a key handed over in the meantime.
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                key_scheduler.release(waiter.future.result()[0])
+            elif not waiter.future.done():
+                waiter.future.cancel()
+                self._leave(waiter)
+            raise
+        finally:
+            self._record_wait((time.monotonic() - start) * 1000)
+
+        if not waiter.future.done():
+            # Cancelling makes the dispatcher skip it; nothing can resolve it afterwards.
+            waiter.future.cancel()
+            self._leave(waiter)
+            self.timeouts += 1
+            return None
+        self.admitted_queued += 1
+        return waiter.future.result()
+
+    def _record_wait(self, wait_ms: float) -> None:
+        self._wait_ms_total += wait_ms
+        self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+    def stats(self) -> dict:
+        waited = self.admitted_queued + self.timeouts
+        return {
+            "depth": self._size,
+            "max_depth": self.max_depth,
+            "users_waiting": len(self._per_user),
+            "max_size": settings.admission_queue_max_size,
+            "per_user_max": settings.admission_queue_per_user_max,
+            "max_wait_ms": settings.admission_max_wait_ms,
+            "admitted_direct": self.admitted_direct,
+            "admitted_queued": self.admitted_queued,
+            "timeouts": self.timeouts,
+            "rejected_full": self.rejected_full,
+            "rejected_user": self.rejected_user,
+            "avg_wait_ms": round(self._wait_ms_total / waited, 2) if waited else None,
+            "max_observed_wait_ms": round(self.max_wait_ms, 2),
+        }
+
+
+admission_queue = AdmissionQueue()
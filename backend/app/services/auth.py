@@ -3,6 +3,7 @@ from typing import Optional
 
 import hashlib
 import secrets
+import time
 from fastapi import Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
@@ -11,8 +12,10 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.config import settings
-from app.database import get_db
+from app.database import AsyncSessionLocal, get_db
 from app.models import ClientAPIKey, User
+from app.services.auth_cache import AuthPrincipal, auth_cache
+from app.services.stage_timing import request_timer
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -49,35 +52,70 @@ def mask_api_key(api_key: str) -> str:
 async def get_user_by_client_api_key(db: AsyncSession, api_key: str) -> User | None:
     key_hash = hash_client_api_key(api_key)
     result = await db.execute(
-        select(ClientAPIKey).where(
-            ClientAPIKey.key_hash == key_hash, ClientAPIKey.is_active == True
-        )
+        select(User)
+        .join(ClientAPIKey, ClientAPIKey.user_id == User.id)
+        .where(ClientAPIKey.key_hash == key_hash, ClientAPIKey.is_active == True)
     )
-    key_obj = result.scalar_one_or_none()
-    if not key_obj:
-        return None
-    result = await db.execute(select(User).where(User.id == key_obj.user_id))
     return result.scalar_one_or_none()
 
 
+def _decode_token(token: str) -> tuple[str, int | None]:
+    """Return (username, exp) from a JWT."""
+    try:
+        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.jwt_algorithm])
+        username: Optional[str] = payload.get("sub")
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if not username:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    exp = payload.get("exp")
+    return username, int(exp) if isinstance(exp, (int, float)) else None
+
+
 async def get_current_user_any(
     request: Request,
     token: str = Depends(oauth2_scheme),
-    db: AsyncSession = Depends(get_db),
-) -> User:
+) -> AuthPrincipal:
+    """
+    Proxy-path auth (client API key or JWT), served from the auth cache when possible.
+    A cache miss uses its own session, closed before the handler runs, so no connection is
+    held across the upstream call.
+    """
+    timer = request_timer(request)
+    with timer.stage("auth"):
+        async with AsyncSessionLocal() as db:
+            principal = await _resolve_principal(token, db)
+    timer.user_id = principal.id
+    return principal
+
+
+async def _resolve_principal(token: str | None, db: AsyncSession) -> AuthPrincipal:
     if not token:
         raise HTTPException(status_code=401, detail="Missing token")
 
-    # Heuristic: JWT contains 2 dots; client API key starts with np-
-    if token.startswith("np-") and token.count(".") < 2:
-        user = await get_user_by_client_api_key(db, token)
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        if not user.is_active:
-            raise HTTPException(status_code=403, detail="User disabled")
-        return user
-
-    return await get_current_user(token=token, db=db)
+    # Same digest for both token kinds; for client API keys it equals ClientAPIKey.key_hash.
+    token_hash = hash_client_api_key(token)
+    principal = auth_cache.get(token_hash)
+    if principal is None:
+        # Heuristic: JWT contains 2 dots; client API key starts with np-
+        if token.startswith("np-") and token.count(".") < 2:
+            user = await get_user_by_client_api_key(db, token)
+            if not user:
+                raise HTTPException(status_code=401, detail="Invalid API key")
+            principal = AuthPrincipal.from_user(user)
+            auth_cache.set(token_hash, principal)
+        else:
+            username, exp = _decode_token(token)
+            result = await db.execute(select(User).where(User.username == username))
+            user = result.scalar_one_or_none()
+            if not user:
+                raise HTTPException(status_code=403, detail="User disabled")
+            principal = AuthPrincipal.from_user(user)
+            auth_cache.set(token_hash, principal, max_age=exp - time.time() if exp is not None else None)
+
+    if not principal.is_active:
+        raise HTTPException(status_code=403, detail="User disabled")
+    return principal
 
 
 async def get_current_user(
@@ -86,13 +124,7 @@ async def get_current_user(
 ) -> User:
     if not token:
         raise HTTPException(status_code=401, detail="Missing token")
-    try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.jwt_algorithm])
-        username: Optional[str] = payload.get("sub")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
-    if not username:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    username, _ = _decode_token(token)
     result = await db.execute(select(User).where(User.username == username))
     user = result.scalar_one_or_none()
     if not user or not user.is_active:
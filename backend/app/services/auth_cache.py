@@ -0,0 +1,116 @@
+"""
+Authentication result cache for the proxy path.
+
+Every proxied request used to hash the client API key, SELECT the `ClientAPIKey` and then
+SELECT the `User` (JWT callers: decode + username lookup). Resolved callers are now kept as a
+small `AuthPrincipal` in a TTL LRU keyed by the SHA-256 of the bearer token (for client API
+keys this is exactly `ClientAPIKey.key_hash`, so a single key can be revoked).
+
+Invalidated when a client key is rotated / deactivated / deleted and when an admin updates a
+user; the TTL bounds staleness for changes made on other nodes.
+"""
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from app.config import settings
+from app.models import User
+
+
+@dataclass(frozen=True)
+class AuthPrincipal:
+    """What the proxy needs from a user; not an ORM object, so it is safe to share."""
+
+    id: int
+    username: str
+    role: str | None
+    is_active: bool
+    manual_rpm: int | None
+
+    @classmethod
+    def from_user(cls, user: User) -> "AuthPrincipal":
+        return cls(
+            id=user.id,
+            username=user.username,
+            role=user.role,
+            is_active=bool(user.is_active),
+            manual_rpm=user.manual_rpm,
+        )
+
+
+class AuthCache:
+    def __init__(self) -> None:
+        self._items: OrderedDict[str, tuple[AuthPrincipal, float]] = OrderedDict()
+        self._by_user: dict[int, set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, token_hash: str) -> AuthPrincipal | None:
+        item = self._items.get(token_hash)
+        if item is None:
+            self.misses += 1
+            return None
+        if item[1] <= time.monotonic():
+            self._drop(token_hash)
+            self.misses += 1
+            return None
+        self._items.move_to_end(token_hash)
+        self.hits += 1
+        return item[0]
+
+    def set(self, token_hash: str, principal: AuthPrincipal, max_age: float | None = None) -> None:
+        """Cache `principal`; `max_age` caps the TTL (e.g. seconds until a JWT expires)."""
+        ttl = float(max(0, int(settings.auth_cache_ttl_seconds)))
+        max_entries = int(settings.auth_cache_max_entries)
+        if max_age is not None:
+            ttl = min(ttl, max_age)
+        if ttl <= 0 or max_entries <= 0:
+            return
+        self._drop(token_hash)
+        self._items[token_hash] = (principal, time.monotonic() + ttl)
+        self._by_user.setdefault(principal.id, set()).add(token_hash)
+        while len(self._items) > max_entries:
+            self._drop(next(iter(self._items)))
+
+    def _drop(self, token_hash: str) -> None:
+        item = self._items.pop(token_hash, None)
+        if item is None:
+            return
+        hashes = self._by_user.get(item[0].id)
+        if hashes is not None:
+            hashes.discard(token_hash)
+            if not hashes:
+                self._by_user.pop(item[0].id, None)
+
+    def invalidate_token(self, token_hash: str) -> None:
+        self.invalidations += 1
+        self._drop(token_hash)
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.invalidations += 1
+        for token_hash in list(self._by_user.get(user_id, ())):
+            self._drop(token_hash)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._by_user.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "users": len(self._by_user),
+            "max_entries": settings.auth_cache_max_entries,
+            "ttl_seconds": settings.auth_cache_ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+auth_cache = AuthCache()
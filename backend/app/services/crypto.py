@@ -18,9 +18,20 @@ def _get_key_bytes() -> bytes:
     return key
 
 
+_AESGCM: tuple[str, AESGCM] | None = None
+
+
+def _get_aesgcm() -> AESGCM:
+    # Build the cipher once per process (re-built only if ENCRYPTION_KEY changes).
+    global _AESGCM
+    raw = settings.encryption_key
+    if _AESGCM is None or _AESGCM[0] != raw:
+        _AESGCM = (raw, AESGCM(_get_key_bytes()))
+    return _AESGCM[1]
+
+
 def encrypt_text(plaintext: str) -> str:
-    key = _get_key_bytes()
-    aesgcm = AESGCM(key)
+    aesgcm = _get_aesgcm()
     nonce = os.urandom(12)
     ciphertext = aesgcm.encrypt(nonce, plaintext.encode("utf-8"), None)
     payload = nonce + ciphertext
@@ -28,11 +39,10 @@ def encrypt_text(plaintext: str) -> str:
 
 
 def decrypt_text(ciphertext_b64: str) -> str:
-    key = _get_key_bytes()
     raw = base64.urlsafe_b64decode(ciphertext_b64)
     nonce = raw[:12]
     ciphertext = raw[12:]
-    aesgcm = AESGCM(key)
+    aesgcm = _get_aesgcm()
     plaintext = aesgcm.decrypt(nonce, ciphertext, None)
     return plaintext.decode("utf-8")
 
@@ -1,61 +1,227 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import Optional
 
-import httpx
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from app.config import settings
+from app.database import AsyncSessionLocal
 from app.models import ApiKey
-from app.services.crypto import decrypt_text
+from app.services.health_schedule import health_check_planner
+from app.services.key_cache import decrypted_key_cache
+from app.services.key_scheduler import key_scheduler
+from app.services.key_usage import key_usage
+from app.services.rate_limit import quota_cache
+from app.services.upstream_http import UpstreamHttpClients
 
+log = logging.getLogger(__name__)
 
-SUBSCRIPTION_URL = "https://api.novelai.net/user/subscription"
+
+def _subscription_url() -> str:
+    return settings.novelai_api_base_url.rstrip("/") + "/user/subscription"
 
 
 def _mark_status(key: ApiKey, status: str, tier: Optional[int], error: Optional[str]) -> None:
+    if key.status != status:
+        quota_cache.invalidate(key.user_id)
     key.status = status
     key.tier = tier
     key.last_checked_at = datetime.utcnow()
     key.last_error = error
 
 
-async def check_key_health(db: AsyncSession, key: ApiKey) -> None:
-    raw_key = decrypt_text(key.key_encrypted)
-    headers = {"Authorization": f"Bearer {raw_key}"}
+@dataclass
+class ProbeResult:
+    status_code: int | None = None
+    tier: int | None = None
+    error: str | None = None
+
+
+@dataclass
+class HealthSweepProgress:
+    started_at: datetime = field(default_factory=datetime.utcnow)
+    finished_at: datetime | None = None
+    total: int = 0
+    checked: int = 0
+    skipped: int = 0
+    running: bool = True
+    deadline_hit: bool = False
+    error: str | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "total": self.total,
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "deadline_hit": self.deadline_hit,
+            "error": self.error,
+        }
+
+
+_last_sweep: HealthSweepProgress | None = None
+_sweep_task: asyncio.Task | None = None
+
+
+async def _probe_key(key_id: int, key_encrypted: str) -> ProbeResult:
+    """Upstream call only; results are applied to the row by `_apply_probe_result`."""
     try:
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            resp = await client.get(SUBSCRIPTION_URL, headers=headers)
-        if resp.status_code == 401:
-            _mark_status(key, "invalid", None, "Unauthorized")
-            key.fail_streak += 1
-        elif resp.status_code >= 400:
-            key.fail_streak += 1
-            if key.fail_streak >= settings.health_check_fail_threshold:
-                _mark_status(key, "unhealthy", key.tier, f"HTTP {resp.status_code}")
-            else:
-                _mark_status(key, key.status, key.tier, f"HTTP {resp.status_code}")
-        else:
-            data = resp.json()
-            tier = data.get("tier")
-            # NovelAI Opus is tier=3
-            if settings.require_opus_tier and tier != 3:
-                _mark_status(key, "unhealthy", tier, "Not Opus tier")
-            else:
-                _mark_status(key, "healthy", tier, None)
-                key.fail_streak = 0
+        raw_key = decrypted_key_cache.get(key_id, key_encrypted)
+        headers = {"Authorization": f"Bearer {raw_key}"}
+        client = UpstreamHttpClients.get(None)
+        resp = await client.get(_subscription_url(), headers=headers, timeout=15.0)
+        if resp.status_code >= 400:
+            return ProbeResult(status_code=resp.status_code)
+        data = resp.json()
+        return ProbeResult(status_code=resp.status_code, tier=data.get("tier"))
     except Exception as exc:
+        return ProbeResult(error=str(exc))
+
+
+def _apply_probe_result(key: ApiKey, result: ProbeResult) -> None:
+    if result.error is not None:
+        key.fail_streak += 1
+        if key.fail_streak >= settings.health_check_fail_threshold:
+            _mark_status(key, "unhealthy", key.tier, f"Error: {result.error}")
+        else:
+            _mark_status(key, key.status, key.tier, f"Error: {result.error}")
+    elif result.status_code == 401:
+        _mark_status(key, "invalid", None, "Unauthorized")
+        key.fail_streak += 1
+    elif result.status_code >= 400:
         key.fail_streak += 1
         if key.fail_streak >= settings.health_check_fail_threshold:
-            _mark_status(key, "unhealthy", key.tier, f"Error: {exc}")
+            _mark_status(key, "unhealthy", key.tier, f"HTTP {result.status_code}")
         else:
-            _mark_status(key, key.status, key.tier, f"Error: {exc}")
+            _mark_status(key, key.status, key.tier, f"HTTP {result.status_code}")
+    # NovelAI Opus is tier=3
+    elif settings.require_opus_tier and result.tier != 3:
+        _mark_status(key, "unhealthy", result.tier, "Not Opus tier")
+    else:
+        _mark_status(key, "healthy", result.tier, None)
+        key.fail_streak = 0
 
 
-async def check_all_keys(db: AsyncSession) -> int:
-    result = await db.execute(select(ApiKey).where(ApiKey.is_enabled == True))
-    keys = result.scalars().all()
+async def check_key_health(db: AsyncSession, key: ApiKey) -> None:
+    _apply_probe_result(key, await _probe_key(key.id, key.key_encrypted))
+
+
+async def _commit_checked(db: AsyncSession, keys: list[ApiKey]) -> None:
+    if not keys:
+        return
+    try:
+        await db.commit()
+    except Exception as exc:
+        # e.g. a key deleted mid-sweep; the scheduler resync will catch up.
+        await db.rollback()
+        log.warning("Health check batch commit failed (%s keys): %s", len(keys), exc)
+        return
     for key in keys:
-        await check_key_health(db, key)
-    await db.commit()
-    return len(keys)
+        key_usage.forget_state(key.id)
+    key_scheduler.apply_health(keys)
+    health_check_planner.mark_checked(keys)
+
+
+async def check_keys(
+    db: AsyncSession, keys: list[ApiKey], progress: HealthSweepProgress | None = None
+) -> int:
+    """
+    Check `keys` concurrently (bounded by HEALTH_CHECK_CONCURRENCY) with per-key jitter and an
+    overall deadline. Probes run in parallel; row updates and commits stay on this coroutine
+    (an AsyncSession is not safe for concurrent use) and are committed in batches.
+    """
+    progress = progress or HealthSweepProgress()
+    progress.total += len(keys)
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(1, int(settings.health_check_concurrency)))
+    jitter_s = max(0, int(settings.health_check_jitter_ms)) / 1000
+    deadline_s = max(0, int(settings.health_check_deadline_seconds))
+    deadline = loop.time() + deadline_s if deadline_s else None
+    batch_size = max(1, int(settings.health_check_commit_batch_size))
+
+    async def probe(key: ApiKey) -> tuple[ApiKey, ProbeResult | None]:
+        async with semaphore:
+            if jitter_s:
+                await asyncio.sleep(random.uniform(0, jitter_s))
+            if deadline is None:
+                return key, await _probe_key(key.id, key.key_encrypted)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return key, None
+            try:
+                return key, await asyncio.wait_for(_probe_key(key.id, key.key_encrypted), remaining)
+            except asyncio.TimeoutError:
+                return key, None
+
+    tasks = [asyncio.create_task(probe(key)) for key in keys]
+    batch: list[ApiKey] = []
+    try:
+        for future in asyncio.as_completed(tasks):
+            key, result = await future
+            if result is None:
+                progress.skipped += 1
+                progress.deadline_hit = True
+                continue
+            _apply_probe_result(key, result)
+            batch.append(key)
+            progress.checked += 1
+            if len(batch) >= batch_size:
+                await _commit_checked(db, batch)
+                batch = []
+        await _commit_checked(db, batch)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return progress.checked
+
+
+async def check_all_keys(db: AsyncSession, progress: HealthSweepProgress | None = None) -> int:
+    # Persist pending usage first so checks start from the latest fail_streak / status.
+    await key_usage.flush()
+    result = await db.execute(select(ApiKey).where(ApiKey.is_enabled == True))
+    keys = list(result.scalars().all())
+    return await check_keys(db, keys, progress)
+
+
+async def check_due_keys(db: AsyncSession) -> tuple[int, int]:
+    """One scheduler tick: check only the keys whose next-check time has come."""
+    await key_usage.flush()
+    result = await db.execute(select(ApiKey).where(ApiKey.is_enabled == True))
+    keys = list(result.scalars().all())
+    due = health_check_planner.select_due(keys)
+    if not due:
+        return 0, len(keys)
+    return await check_keys(db, due), len(keys)
+
+
+def get_sweep_progress() -> dict | None:
+    return _last_sweep.as_dict() if _last_sweep is not None else None
+
+
+def start_background_sweep() -> dict:
+    """Start a full sweep in the background (no-op if one is running) and return its progress."""
+    global _last_sweep, _sweep_task
+    if _sweep_task is not None and not _sweep_task.done() and _last_sweep is not None:
+        return _last_sweep.as_dict()
+    progress = HealthSweepProgress()
+    _last_sweep = progress
+
+    async def run() -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                await check_all_keys(db, progress)
+        except Exception as exc:
+            progress.error = str(exc)[:300]
+            log.warning("Background health sweep failed: %s", exc)
+        finally:
+            progress.running = False
+            progress.finished_at = datetime.utcnow()
+
+    _sweep_task = asyncio.get_running_loop().create_task(run())
+    return progress.as_dict()
@@ -0,0 +1,101 @@
+"""
+Incremental, prioritized health-check scheduling.
+
+Instead of re-checking every enabled key every `health_check_interval_seconds`, each key gets
+its own next-check time based on its state:
+- pending: as soon as possible
+- unhealthy / failing / cooling down: after a quarter of the interval
+- invalid: exponential backoff up to `health_check_invalid_max_seconds`
+- healthy and recently successful in real traffic: `health_check_active_multiplier` x interval
+- other healthy keys: every interval
+
+Each tick checks at most a proportional share of the keys (most overdue first), so the work is
+spread across the interval instead of bursting.
+"""
+
+from __future__ import annotations
+
+import math
+import random
+from datetime import datetime, timedelta
+
+from app.config import settings
+from app.models import ApiKey
+
+
+class HealthCheckPlanner:
+    def __init__(self) -> None:
+        self._next_check: dict[int, datetime] = {}
+
+    @staticmethod
+    def interval_for(key: ApiKey, now: datetime) -> float:
+        interval = max(1, int(settings.health_check_interval_seconds))
+        status = key.status or "pending"
+        fail_streak = key.fail_streak or 0
+        if status == "pending":
+            return 0
+        if status == "invalid":
+            factor = 2 ** min(max(0, fail_streak - 1), 10)
+            max_seconds = max(interval, int(settings.health_check_invalid_max_seconds))
+            return min(interval * factor, max_seconds)
+        cooling = key.cooldown_until is not None and key.cooldown_until > now
+        if status != "healthy" or fail_streak > 0 or cooling:
+            return max(1, interval / 4)
+        recently_used = key.last_used_at is not None and (now - key.last_used_at).total_seconds() < interval
+        if recently_used:
+            return interval * max(1, int(settings.health_check_active_multiplier))
+        return interval
+
+    def _initial_next_check(self, key: ApiKey, now: datetime) -> datetime:
+        interval = self.interval_for(key, now)
+        if interval <= 0:
+            return now
+        if key.last_checked_at is not None:
+            return key.last_checked_at + timedelta(seconds=interval)
+        # Never checked (e.g. verify_now=false): spread first checks across the interval.
+        return now + timedelta(seconds=random.uniform(0, interval))
+
+    def select_due(self, keys: list[ApiKey], now: datetime | None = None) -> list[ApiKey]:
+        now = now or datetime.utcnow()
+        live = {key.id for key in keys}
+        for key_id in [k for k in self._next_check if k not in live]:
+            self._next_check.pop(key_id, None)
+
+        due: list[tuple[datetime, ApiKey]] = []
+        for key in keys:
+            at = self._next_check.get(key.id)
+            if at is None:
+                at = self._initial_next_check(key, now)
+                self._next_check[key.id] = at
+            # A pending key (new upload) jumps the queue even if it had a schedule.
+            if (key.status or "pending") == "pending":
+                at = min(at, now)
+            if at <= now:
+                due.append((at, key))
+        due.sort(key=lambda item: item[0])
+
+        interval = max(1, int(settings.health_check_interval_seconds))
+        tick = max(1, int(settings.health_check_tick_seconds))
+        budget = max(
+            int(settings.health_check_concurrency),
+            math.ceil(len(keys) * tick / interval),
+        )
+        return [key for _, key in due[:budget]]
+
+    def mark_checked(self, keys: list[ApiKey], now: datetime | None = None) -> None:
+        now = now or datetime.utcnow()
+        for key in keys:
+            interval = self.interval_for(key, now)
+            # +-10% jitter keeps keys checked together from staying in lockstep.
+            jittered = interval * random.uniform(0.9, 1.1) if interval > 0 else max(1, settings.health_check_tick_seconds)
+            self._next_check[key.id] = now + timedelta(seconds=jittered)
+
+    def snapshot(self, now: datetime | None = None) -> dict:
+        now = now or datetime.utcnow()
+        return {
+            "scheduled": len(self._next_check),
+            "due": sum(1 for at in self._next_check.values() if at <= now),
+        }
+
+
+health_check_planner = HealthCheckPlanner()
@@ -0,0 +1,105 @@
+"""
+Decrypted upstream key cache.
+
+Decrypting a NovelAI key (base64 + AES-GCM) on every generation / health check is pure
+overhead for keys that rarely change. This bounded LRU keeps plaintext keys for a short TTL,
+keyed by `ApiKey.id` plus a fingerprint of the ciphertext (so a re-encrypted key is a miss).
+
+Plaintext is held in a `bytearray` and overwritten on eviction / invalidation. This is
+best-effort hygiene: `str` copies handed to callers are not wiped by Python.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from app.config import settings
+from app.services.crypto import decrypt_text
+
+
+@dataclass
+class _CachedKey:
+    fingerprint: bytes
+    plaintext: bytearray
+    expires_at: float
+
+
+def _fingerprint(key_encrypted: str) -> bytes:
+    return hashlib.blake2b(key_encrypted.encode("ascii"), digest_size=16).digest()
+
+
+def _wipe(item: _CachedKey) -> None:
+    for i in range(len(item.plaintext)):
+        item.plaintext[i] = 0
+
+
+class DecryptedKeyCache:
+    def __init__(self) -> None:
+        self._items: OrderedDict[int, _CachedKey] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _evict(self, key_id: int) -> None:
+        item = self._items.pop(key_id, None)
+        if item is not None:
+            _wipe(item)
+            self.evictions += 1
+
+    def _purge_expired(self, now: float) -> None:
+        for key_id in [k for k, item in self._items.items() if item.expires_at <= now]:
+            self._evict(key_id)
+
+    def get(self, key_id: int, key_encrypted: str) -> str:
+        """Return the plaintext key, decrypting (and caching) on a miss."""
+        max_entries = int(settings.key_cache_max_entries)
+        ttl = int(settings.key_cache_ttl_seconds)
+        if max_entries <= 0 or ttl <= 0:
+            self.misses += 1
+            return decrypt_text(key_encrypted)
+
+        now = time.monotonic()
+        fingerprint = _fingerprint(key_encrypted)
+        item = self._items.get(key_id)
+        if item is not None and item.fingerprint == fingerprint and item.expires_at > now:
+            self._items.move_to_end(key_id)
+            self.hits += 1
+            return item.plaintext.decode("utf-8")
+
+        self.misses += 1
+        self._evict(key_id)
+        self._purge_expired(now)
+        plaintext = decrypt_text(key_encrypted)
+        self._items[key_id] = _CachedKey(
+            fingerprint=fingerprint,
+            plaintext=bytearray(plaintext.encode("utf-8")),
+            expires_at=now + ttl,
+        )
+        while len(self._items) > max_entries:
+            self._evict(next(iter(self._items)))
+        return plaintext
+
+    def invalidate(self, key_id: int) -> None:
+        self._evict(key_id)
+
+    def clear(self) -> None:
+        for key_id in list(self._items):
+            self._evict(key_id)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_entries": settings.key_cache_max_entries,
+            "ttl_seconds": settings.key_cache_ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+decrypted_key_cache = DecryptedKeyCache()
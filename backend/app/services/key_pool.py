@@ -1,30 +1,124 @@
-from datetime import datetime, timedelta
-from typing import Optional, Tuple
-
-from sqlalchemy import select, asc
-from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple
 
 from app.config import settings
-from app.models import ApiKey
-from app.services.crypto import decrypt_text
-
-
-async def select_healthy_key(db: AsyncSession) -> Optional[Tuple[ApiKey, str]]:
-    now = datetime.utcnow()
-    cutoff = now - timedelta(seconds=settings.key_cooldown_seconds)
-    query = (
-        select(ApiKey)
-        .where(ApiKey.status == "healthy")
-        .where(ApiKey.is_enabled == True)
-        .where((ApiKey.cooldown_until == None) | (ApiKey.cooldown_until <= now))
-        .where((ApiKey.last_used_at == None) | (ApiKey.last_used_at <= cutoff))
-        .order_by(ApiKey.last_used_at.asc().nullsfirst(), ApiKey.id.asc())
-        .limit(1)
-    )
-    if settings.require_opus_tier:
-        query = query.where(ApiKey.tier == 3)
-    result = await db.execute(query)
-    key = result.scalar_one_or_none()
-    if not key:
+from app.services.key_cache import decrypted_key_cache
+from app.services.key_scheduler import KeyLease, key_scheduler
+from app.services.shared_state import get_shared_state, publish_until, release_soon, shared_call, touch_soon
+
+# A key whose cross-node lease is taken is skipped locally for this long.
+_BUSY_HOLD_SECONDS = 1.0
+_MAX_CLAIM_TRIES = 3
+_KEY_MARKER_PREFIX = "key:"
+
+# Local lease tokens that also hold a cross-node lease slot.
+_shared_tokens: set[int] = set()
+
+
+def select_healthy_key(exclude: Iterable[int] = ()) -> Optional[Tuple[KeyLease, str]]:
+    """
+    Lease the next eligible healthy key (other than `exclude`) from the in-memory scheduler.
+    The caller must `key_scheduler.release(lease, ...)` once the upstream call is done.
+    """
+    lease = key_scheduler.acquire(exclude=exclude)
+    if not lease:
         return None
-    return key, decrypt_text(key.key_encrypted)
+    try:
+        return lease, decrypted_key_cache.get(lease.key_id, lease.key_encrypted)
+    except Exception:
+        key_scheduler.release(lease)
+        raise
+
+
+def _lease_name(key_id: int) -> str:
+    return f"lease:key:{key_id}"
+
+
+async def claim_shared_key(
+    selected: Optional[Tuple[KeyLease, str]], exclude: Iterable[int] = ()
+) -> Optional[Tuple[KeyLease, str]]:
+    """
+    Take the cross-node lease slot for a locally leased key (no-op without a distributed shared
+    state). A key that is busy on another node is held back locally and the next one is tried.
+    """
+    state = get_shared_state()
+    if selected is None or not state.distributed:
+        return selected
+    limit = max(1, int(settings.key_max_concurrency))
+    ttl = max(1, int(settings.key_lease_ttl_seconds))
+    tried = set(exclude)
+    for _ in range(_MAX_CLAIM_TRIES):
+        lease = selected[0]
+        name = _lease_name(lease.key_id)
+        # Shielded: a timeout must not cancel a write that may already be committed.
+        acquire = asyncio.ensure_future(state.acquire(name, limit, ttl))
+        try:
+            claimed = await shared_call(asyncio.shield(acquire), None)
+        except BaseException:
+            # Cancelled (client went away): the caller never sees this lease.
+            _release_if_claimed(acquire, name)
+            key_scheduler.release(lease)
+            raise
+        if claimed is None:
+            # Shared state unavailable or slow: local leasing only. A slot the slow call
+            # still takes is given back when it completes.
+            _release_if_claimed(acquire, name)
+            return selected
+        if claimed:
+            _shared_tokens.add(lease.token)
+            return selected
+        tried.add(lease.key_id)
+        key_scheduler.hold(lease.key_id, datetime.utcnow() + timedelta(seconds=_BUSY_HOLD_SECONDS))
+        key_scheduler.release(lease)
+        selected = select_healthy_key(exclude=tried)
+        if selected is None:
+            return None
+    key_scheduler.release(selected[0])
+    return None
+
+
+def _release_if_claimed(acquire: asyncio.Future, name: str) -> None:
+    """Give back the slot an abandoned acquire took (now, or whenever it completes)."""
+
+    def _done(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is None and future.result():
+            release_soon(name)
+
+    acquire.add_done_callback(_done)
+
+
+def _release_shared(lease: KeyLease) -> None:
+    if lease.token in _shared_tokens:
+        _shared_tokens.discard(lease.token)
+        release_soon(_lease_name(lease.key_id))
+
+
+def lease_renew_interval() -> float:
+    return max(1, int(settings.key_lease_ttl_seconds)) / 3
+
+
+def renew_lease(lease: KeyLease) -> None:
+    """Keep a lease (and its cross-node slot) alive past KEY_LEASE_TTL_SECONDS while still in use."""
+    if key_scheduler.renew(lease) and lease.token in _shared_tokens:
+        touch_soon(_lease_name(lease.key_id), max(1, int(settings.key_lease_ttl_seconds)))
+
+
+def install_shared_leases() -> None:
+    key_scheduler.on_release = _release_shared
+
+
+def publish_key_cooldown(key_id: int, until: datetime) -> None:
+    """Tell other nodes about a key cooldown (naive UTC `until`)."""
+    publish_until(f"{_KEY_MARKER_PREFIX}{key_id}", until.replace(tzinfo=timezone.utc).timestamp())
+
+
+def apply_remote_key_cooldowns(markers: dict[str, float]) -> None:
+    for name, until in markers.items():
+        if not name.startswith(_KEY_MARKER_PREFIX):
+            continue
+        try:
+            key_id = int(name[len(_KEY_MARKER_PREFIX):])
+        except ValueError:
+            continue
+        key_scheduler.hold(key_id, datetime.fromtimestamp(until, timezone.utc).replace(tzinfo=None))
@@ -0,0 +1,352 @@
+"""
+In-process upstream key scheduler.
+
+Keeps every contributed key in memory and a min-heap of selectable keys ordered by their
+next eligible time (`last_used_at + key_cooldown_seconds`, `cooldown_until`). Selection is an
+O(log n) heap pop with no DB round trip.
+
+Each pick takes an in-flight lease; a key with `key_max_concurrency` leases in flight is out of
+the heap until one is released, so concurrent requests do not trigger upstream 409/429s on the
+same key. `last_used_at` is stamped at acquire time. Leases not released within
+`key_lease_ttl_seconds` (e.g. a lost task) are reclaimed. `hold()` keeps a key out of selection
+for a while without touching its persisted state (busy or cooling down on another node).
+
+The DB stays the source of truth: the scheduler is loaded at startup, kept current by the
+proxy / health check / key management paths, and periodically resynced from the DB.
+"""
+
+from __future__ import annotations
+
+import heapq
+import itertools
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import ApiKey
+
+
+@dataclass
+class KeyEntry:
+    id: int
+    user_id: int
+    key_encrypted: str
+    status: str
+    tier: int | None
+    is_enabled: bool
+    fail_streak: int = 0
+    last_used_at: datetime | None = None
+    cooldown_until: datetime | None = None
+    last_error: str | None = None
+    in_flight: int = 0
+    version: int = 0
+    # Set from other nodes' state (services/shared_state.py); never written to the DB.
+    held_until: datetime | None = None
+
+
+@dataclass(frozen=True)
+class KeyLease:
+    key_id: int
+    key_encrypted: str
+    token: int
+
+
+class KeyScheduler:
+    def __init__(self) -> None:
+        self._entries: dict[int, KeyEntry] = {}
+        self._heap: list[tuple[datetime, int, int]] = []
+        self._tokens = itertools.count(1)
+        # lease token -> (lease, monotonic expiry)
+        self._leases: dict[int, tuple[KeyLease, float]] = {}
+        self._next_reclaim = 0.0
+        self.reclaimed = 0
+        self.loaded = False
+        # Called when a key may have become selectable (lease released, key updated).
+        self.on_available: Callable[[], None] | None = None
+        # Called for every lease that ends (released, reclaimed or its key removed).
+        self.on_release: Callable[[KeyLease], None] | None = None
+
+    def _notify(self) -> None:
+        if self.on_available is not None:
+            self.on_available()
+
+    def _ended(self, lease: KeyLease) -> None:
+        if self.on_release is not None:
+            self.on_release(lease)
+
+    @staticmethod
+    def _is_selectable(entry: KeyEntry) -> bool:
+        return entry.status == "healthy" and bool(entry.is_enabled)
+
+    @staticmethod
+    def _max_concurrency() -> int:
+        return max(1, int(settings.key_max_concurrency))
+
+    def _has_capacity(self, entry: KeyEntry) -> bool:
+        return entry.in_flight < self._max_concurrency()
+
+    @staticmethod
+    def _next_eligible_at(entry: KeyEntry) -> datetime:
+        at = datetime.min
+        if entry.last_used_at is not None:
+            at = entry.last_used_at + timedelta(seconds=settings.key_cooldown_seconds)
+        if entry.cooldown_until is not None and entry.cooldown_until > at:
+            at = entry.cooldown_until
+        if entry.held_until is not None and entry.held_until > at:
+            at = entry.held_until
+        return at
+
+    def _push(self, entry: KeyEntry) -> None:
+        # Heap items are invalidated lazily via the entry version.
+        entry.version += 1
+        if not self._has_capacity(entry) or not self._is_selectable(entry):
+            return
+        heapq.heappush(self._heap, (self._next_eligible_at(entry), entry.id, entry.version))
+        if len(self._heap) > 4 * len(self._entries) + 64:
+            self._compact()
+
+    def _compact(self) -> None:
+        live = []
+        for _, key_id, version in self._heap:
+            entry = self._entries.get(key_id)
+            if entry is not None and entry.version == version:
+                live.append((self._next_eligible_at(entry), key_id, version))
+        heapq.heapify(live)
+        self._heap = live
+
+    @staticmethod
+    def _apply(entry: KeyEntry, key: ApiKey) -> None:
+        entry.user_id = key.user_id
+        entry.key_encrypted = key.key_encrypted
+        entry.status = key.status or "pending"
+        entry.tier = key.tier
+        entry.is_enabled = bool(key.is_enabled)
+        entry.fail_streak = key.fail_streak or 0
+        entry.last_used_at = key.last_used_at
+        entry.cooldown_until = key.cooldown_until
+        entry.last_error = key.last_error
+
+    def upsert(self, key: ApiKey) -> None:
+        entry = self._entries.get(key.id)
+        if entry is None:
+            entry = KeyEntry(
+                id=key.id,
+                user_id=key.user_id,
+                key_encrypted=key.key_encrypted,
+                status=key.status or "pending",
+                tier=key.tier,
+                is_enabled=bool(key.is_enabled),
+            )
+            self._entries[key.id] = entry
+        self._apply(entry, key)
+        self._push(entry)
+        if self._is_selectable(entry):
+            self._notify()
+
+    def get(self, key_id: int) -> KeyEntry | None:
+        return self._entries.get(key_id)
+
+    def entries(self) -> list[KeyEntry]:
+        return list(self._entries.values())
+
+    def upsert_many(self, keys: Iterable[ApiKey]) -> None:
+        for key in keys:
+            self.upsert(key)
+
+    def apply_health(self, keys: Iterable[ApiKey]) -> None:
+        """
+        Apply health check results. Only the probe-owned fields are taken from the rows; usage
+        recorded since they were read (last_used_at, a newer cooldown) is kept.
+        """
+        for key in keys:
+            entry = self._entries.get(key.id)
+            if entry is None:
+                self.upsert(key)
+                continue
+            entry.status = key.status or "pending"
+            entry.tier = key.tier
+            entry.last_error = key.last_error
+            if key.last_error is not None or entry.status != "healthy":
+                entry.fail_streak = max(entry.fail_streak, key.fail_streak or 0)
+            if key.cooldown_until is not None and (
+                entry.cooldown_until is None or key.cooldown_until > entry.cooldown_until
+            ):
+                entry.cooldown_until = key.cooldown_until
+            self._push(entry)
+            if self._is_selectable(entry):
+                self._notify()
+
+    def remove(self, key_id: int) -> None:
+        self._entries.pop(key_id, None)
+        for token in [t for t, (lease, _) in self._leases.items() if lease.key_id == key_id]:
+            lease, _ = self._leases.pop(token)
+            self._ended(lease)
+
+    def hold(self, key_id: int, until: datetime) -> None:
+        """Keep a key out of selection until `until` (only ever extends)."""
+        entry = self._entries.get(key_id)
+        if entry is None or (entry.held_until is not None and entry.held_until >= until):
+            return
+        entry.held_until = until
+        self._push(entry)
+
+    def renew(self, lease: KeyLease) -> bool:
+        """Restart a held lease's TTL (long streams); False if it already ended."""
+        if lease.token not in self._leases:
+            return False
+        self._leases[lease.token] = (lease, time.monotonic() + max(1, int(settings.key_lease_ttl_seconds)))
+        return True
+
+    def in_flight(self, key_id: int) -> int:
+        entry = self._entries.get(key_id)
+        return entry.in_flight if entry is not None else 0
+
+    def reclaim_expired(self, now: float | None = None) -> int:
+        """Drop leases older than KEY_LEASE_TTL_SECONDS (their holders never released them)."""
+        now = time.monotonic() if now is None else now
+        expired = [token for token, (_, expires_at) in self._leases.items() if expires_at <= now]
+        for token in expired:
+            lease, _ = self._leases.pop(token)
+            self._ended(lease)
+            entry = self._return(lease.key_id)
+            if entry is not None:
+                self._push(entry)
+        self.reclaimed += len(expired)
+        self._next_reclaim = now + max(1.0, int(settings.key_lease_ttl_seconds) / 4)
+        if expired:
+            self._notify()
+        return len(expired)
+
+    def _return(self, key_id: int) -> KeyEntry | None:
+        entry = self._entries.get(key_id)
+        if entry is None:
+            return None
+        entry.in_flight = max(0, entry.in_flight - 1)
+        return entry
+
+    async def load(self, db: AsyncSession, unsaved: Callable[[], Iterable[int]] | None = None) -> int:
+        """
+        (Re)load all keys from the DB, keeping in-flight leases. Keys that are in flight or listed
+        by `unsaved` (usage not written yet; evaluated after the read) keep their local usage state.
+        """
+        result = await db.execute(select(ApiKey))
+        keys = result.scalars().all()
+        seen = {key.id for key in keys}
+        for key_id in list(self._entries):
+            if key_id not in seen:
+                self.remove(key_id)
+        keep = set(unsaved()) if unsaved is not None else set()
+        self._heap = []
+        for key in keys:
+            entry = self._entries.get(key.id)
+            if entry is not None and (entry.in_flight or key.id in keep):
+                self._merge(entry, key)
+            else:
+                self.upsert(key)
+        self.loaded = True
+        return len(keys)
+
+    def _merge(self, entry: KeyEntry, key: ApiKey) -> None:
+        """Take identity fields from a possibly stale row; usage times only ever move forward."""
+        entry.user_id = key.user_id
+        entry.key_encrypted = key.key_encrypted
+        entry.tier = key.tier
+        entry.is_enabled = bool(key.is_enabled)
+        if key.last_used_at is not None and (entry.last_used_at is None or key.last_used_at > entry.last_used_at):
+            entry.last_used_at = key.last_used_at
+        if key.cooldown_until is not None and (
+            entry.cooldown_until is None or key.cooldown_until > entry.cooldown_until
+        ):
+            entry.cooldown_until = key.cooldown_until
+        self._push(entry)
+        if self._is_selectable(entry):
+            self._notify()
+
+    def acquire(self, now: datetime | None = None, exclude: Iterable[int] = ()) -> KeyLease | None:
+        """Lease the next eligible key; `exclude` skips keys (e.g. already tried by a failover)."""
+        now = now or datetime.utcnow()
+        exclude = set(exclude)
+        if self._leases and time.monotonic() >= self._next_reclaim:
+            self.reclaim_expired()
+        skipped: list[KeyEntry] = []
+        lease = None
+        while self._heap:
+            at, key_id, version = self._heap[0]
+            entry = self._entries.get(key_id)
+            if (
+                entry is None
+                or entry.version != version
+                or not self._has_capacity(entry)
+                or not self._is_selectable(entry)
+            ):
+                heapq.heappop(self._heap)
+                continue
+            actual = self._next_eligible_at(entry)
+            if actual > now:
+                if actual > at:
+                    # Cooldown settings grew since this entry was pushed; re-key it.
+                    heapq.heappop(self._heap)
+                    self._push(entry)
+                    continue
+                break
+            heapq.heappop(self._heap)
+            if entry.id in exclude or (settings.require_opus_tier and entry.tier != 3):
+                skipped.append(entry)
+                continue
+            entry.in_flight += 1
+            entry.last_used_at = now
+            lease = KeyLease(key_id=entry.id, key_encrypted=entry.key_encrypted, token=next(self._tokens))
+            ttl = max(1, int(settings.key_lease_ttl_seconds))
+            self._leases[lease.token] = (lease, time.monotonic() + ttl)
+            # Still has capacity: back in the heap, paced by the new last_used_at.
+            self._push(entry)
+            break
+        for entry in skipped:
+            self._push(entry)
+        return lease
+
+    def release(self, lease: KeyLease, key: ApiKey | None = None) -> None:
+        """Return a leased key to the pool, refreshing its state from `key` when given."""
+        if self._leases.pop(lease.token, None) is None:
+            # Already released, reclaimed by TTL, or the key was removed.
+            return
+        self._ended(lease)
+        entry = self._return(lease.key_id)
+        if entry is None:
+            return
+        if key is not None:
+            self._apply(entry, key)
+        self._push(entry)
+        self._notify()
+
+    def next_eligible_at(self) -> datetime | None:
+        """Earliest time an idle, selectable key comes out of cooldown (O(n); used by waiters)."""
+        times = [
+            self._next_eligible_at(entry)
+            for entry in self._entries.values()
+            if self._has_capacity(entry)
+            and self._is_selectable(entry)
+            and not (settings.require_opus_tier and entry.tier != 3)
+        ]
+        return min(times) if times else None
+
+    def snapshot(self) -> dict:
+        counts: dict[str, int] = {}
+        for entry in self._entries.values():
+            counts[entry.status] = counts.get(entry.status, 0) + 1
+        return {
+            "loaded": self.loaded,
+            "total": len(self._entries),
+            "leased": len(self._leases),
+            "max_concurrency": self._max_concurrency(),
+            "reclaimed": self.reclaimed,
+            "by_status": counts,
+        }
+
+
+key_scheduler = KeyScheduler()
@@ -0,0 +1,196 @@
+"""
+Write-behind ApiKey usage counters.
+
+Each upstream call used to mutate and commit the key row (`total_requests`, `fail_streak`,
+`last_used_at`, `cooldown_until`, ...), so hot keys were updated on every request. Results are
+now applied to the in-memory scheduler entry (same `_update_key_from_upstream` semantics) and
+accumulated here as counter deltas plus the latest health fields, then written in periodic
+batched UPDATEs. Status transitions (e.g. healthy -> invalid) trigger an immediate flush.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import bindparam, update
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import ApiKey
+from app.services.key_scheduler import KeyEntry
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingKeyUsage:
+    total: int = 0
+    success: int = 0
+    fail: int = 0
+    last_used_at: datetime | None = None
+    # Latest health fields; None when a health check has since written the row.
+    state: dict | None = None
+
+
+_COUNTER_PARAMS = {
+    "total_requests": ApiKey.total_requests + bindparam("d_total"),
+    "success_requests": ApiKey.success_requests + bindparam("d_success"),
+    "fail_requests": ApiKey.fail_requests + bindparam("d_fail"),
+    "last_used_at": bindparam("v_last_used_at"),
+}
+_STATE_PARAMS = {
+    "status": bindparam("v_status"),
+    "fail_streak": bindparam("v_fail_streak"),
+    "cooldown_until": bindparam("v_cooldown_until"),
+    "last_error": bindparam("v_last_error"),
+}
+
+
+class KeyUsageAccumulator:
+    def __init__(self) -> None:
+        self._pending: dict[int, PendingKeyUsage] = {}
+        # Keys taken by a flush that has not committed yet.
+        self._flushing: set[int] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._lock: asyncio.Lock | None = None
+        self._stopping = False
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed = 0
+
+    def record(self, entry: KeyEntry, *, success: bool, status_changed: bool = False) -> None:
+        pending = self._pending.setdefault(entry.id, PendingKeyUsage())
+        pending.total += 1
+        if success:
+            pending.success += 1
+        else:
+            pending.fail += 1
+        pending.last_used_at = entry.last_used_at
+        pending.state = {
+            "status": entry.status,
+            "fail_streak": entry.fail_streak,
+            "cooldown_until": entry.cooldown_until,
+            "last_error": entry.last_error,
+        }
+        if status_changed:
+            self._request_flush()
+
+    def forget_state(self, key_id: int) -> None:
+        """Keep counter deltas but drop health fields (the row was just written elsewhere)."""
+        pending = self._pending.get(key_id)
+        if pending is not None:
+            pending.state = None
+
+    def unsaved_key_ids(self) -> set[int]:
+        """Keys whose latest usage may not be in the DB yet (pending or mid-flush)."""
+        return set(self._pending) | self._flushing
+
+    def _request_flush(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            # Let the loop finish an in-progress flush instead of cancelling it mid-write.
+            self._stopping = True
+            self._request_flush()
+            await task
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        lock = self._lock or asyncio.Lock()
+        async with lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            self._flushing = set(pending)
+            try:
+                await self._write(pending)
+            finally:
+                self._flushing = set()
+
+    async def _write(self, pending: dict[int, PendingKeyUsage]) -> None:
+        counters_only = []
+        with_state = []
+        for key_id, item in pending.items():
+            params = {
+                "b_id": key_id,
+                "d_total": item.total,
+                "d_success": item.success,
+                "d_fail": item.fail,
+                "v_last_used_at": item.last_used_at,
+            }
+            if item.state is None:
+                counters_only.append(params)
+            else:
+                params.update({f"v_{k}": v for k, v in item.state.items()})
+                with_state.append(params)
+        try:
+            async with AsyncSessionLocal() as db:
+                base = update(ApiKey).where(ApiKey.id == bindparam("b_id"))
+                conn = await db.connection()
+                if counters_only:
+                    await conn.execute(base.values(**_COUNTER_PARAMS), counters_only)
+                if with_state:
+                    await conn.execute(base.values(**_COUNTER_PARAMS, **_STATE_PARAMS), with_state)
+                await db.commit()
+        except Exception as exc:
+            self.failed += len(pending)
+            log.warning("Failed to flush usage for %s keys: %s", len(pending), exc)
+            # Put the deltas back so they are retried on the next flush.
+            for key_id, item in pending.items():
+                current = self._pending.get(key_id)
+                if current is None:
+                    self._pending[key_id] = item
+                    continue
+                current.total += item.total
+                current.success += item.success
+                current.fail += item.fail
+            return
+        self.flushes += 1
+        self.rows_written += len(pending)
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while not self._stopping:
+            interval = max(50, int(settings.key_usage_flush_interval_ms)) / 1000
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as exc:
+                log.warning("Key usage flush failed: %s", exc)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "pending_keys": len(self._pending),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failed": self.failed,
+        }
+
+
+key_usage = KeyUsageAccumulator()
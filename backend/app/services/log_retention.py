@@ -0,0 +1,230 @@
+"""
+Retention for the append-only tables (`request_logs`, `auth_attempts`).
+
+Nothing used to delete old rows, so the tables (and the indexes behind the 60-second rate-limit
+COUNTs) grew without bound. A periodic job (`tasks/scheduler.log_retention_loop`, leader node
+only in multi-node mode) deletes rows older than the retention window in small batches, one
+commit per batch with a short pause in between, so no single statement holds a long write lock.
+
+On Postgres, REQUEST_LOG_PARTITIONING creates `request_logs` range-partitioned by day when the
+table does not exist yet. The job then keeps a few future partitions ready and drops expired
+ones wholesale; the batched DELETE only has to clean up the default partition. An existing
+non-partitioned table is left alone (batched deletes only).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, inspect, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.database import Base
+from app.models import ApiKey, AuthAttempt, RequestLog, User
+
+log = logging.getLogger(__name__)
+
+_PARTITION_PREFIX = "request_logs_p"
+
+_PARTITIONED_REQUEST_LOGS_DDL = (
+    """
+    CREATE TABLE request_logs (
+        id SERIAL,
+        user_id INTEGER NOT NULL REFERENCES users (id),
+        api_key_id INTEGER REFERENCES api_keys (id),
+        action VARCHAR(50),
+        ip_address VARCHAR(64),
+        width INTEGER,
+        height INTEGER,
+        steps INTEGER,
+        samples INTEGER,
+        status VARCHAR(20),
+        status_code INTEGER,
+        latency_ms DOUBLE PRECISION,
+        reject_reason VARCHAR(200),
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at)
+    """,
+    "CREATE TABLE request_logs_default PARTITION OF request_logs DEFAULT",
+    "CREATE INDEX ix_request_logs_user_id ON request_logs (user_id)",
+    "CREATE INDEX ix_request_logs_api_key_id ON request_logs (api_key_id)",
+    "CREATE INDEX ix_request_logs_created_at ON request_logs (created_at)",
+)
+
+
+def _partition_name(day: date) -> str:
+    return f"{_PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def _create_partition_sql(day: date) -> str:
+    return (
+        f"CREATE TABLE {_partition_name(day)} PARTITION OF request_logs "
+        f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+    )
+
+
+def _upcoming_days() -> list[date]:
+    today = datetime.utcnow().date()
+    return [today + timedelta(days=n) for n in range(max(1, int(settings.request_log_partition_days_ahead)) + 1)]
+
+
+def partitioning_requested(dialect_name: str) -> bool:
+    return bool(settings.request_log_partitioning) and dialect_name == "postgresql"
+
+
+def create_partitioned_request_logs(conn: Connection) -> None:
+    """Startup hook (run_sync): create a day-partitioned request_logs if it does not exist yet."""
+    if not partitioning_requested(conn.dialect.name):
+        return
+    if inspect(conn).has_table(RequestLog.__tablename__):
+        return
+    # Referenced tables first; create_all skips everything that already exists afterwards.
+    Base.metadata.create_all(conn, tables=[User.__table__, ApiKey.__table__])
+    for statement in _PARTITIONED_REQUEST_LOGS_DDL:
+        conn.execute(text(statement))
+    # Today's partition must exist before rows arrive, or they land in the default partition.
+    for day in _upcoming_days():
+        conn.execute(text(_create_partition_sql(day)))
+    log.info("Created request_logs partitioned by day")
+
+
+@dataclass
+class RetentionProgress:
+    started_at: datetime = field(default_factory=datetime.utcnow)
+    finished_at: datetime | None = None
+    running: bool = True
+    request_logs_deleted: int = 0
+    auth_attempts_deleted: int = 0
+    partitions_created: int = 0
+    partitions_dropped: int = 0
+    batches: int = 0
+    batch_limit_hit: bool = False
+    error: str | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "running": self.running,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "request_logs_deleted": self.request_logs_deleted,
+            "auth_attempts_deleted": self.auth_attempts_deleted,
+            "partitions_created": self.partitions_created,
+            "partitions_dropped": self.partitions_dropped,
+            "batches": self.batches,
+            "batch_limit_hit": self.batch_limit_hit,
+            "error": self.error,
+        }
+
+
+_last_run: RetentionProgress | None = None
+
+
+def get_retention_progress() -> dict | None:
+    return _last_run.as_dict() if _last_run is not None else None
+
+
+async def _is_partitioned(db: AsyncSession) -> bool:
+    if db.bind.dialect.name != "postgresql":
+        return False
+    result = await db.execute(
+        text(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = 'request_logs' AND pg_table_is_visible(c.oid)"
+        )
+    )
+    return result.first() is not None
+
+
+async def _maintain_partitions(db: AsyncSession, cutoff: datetime, progress: RetentionProgress) -> None:
+    for day in _upcoming_days():
+        name = _partition_name(day)
+        exists = await db.execute(text("SELECT to_regclass(:name)"), {"name": name})
+        if exists.scalar_one_or_none() is not None:
+            continue
+        try:
+            await db.execute(text(_create_partition_sql(day)))
+            await db.commit()
+            progress.partitions_created += 1
+        except Exception as exc:
+            # e.g. rows for that day already sit in the default partition.
+            await db.rollback()
+            log.warning("Could not create partition %s: %s", name, exc)
+
+    result = await db.execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'request_logs'"
+        )
+    )
+    for (name,) in result.all():
+        if not name.startswith(_PARTITION_PREFIX):
+            continue
+        try:
+            day = datetime.strptime(name[len(_PARTITION_PREFIX):], "%Y%m%d").date()
+        except ValueError:
+            continue
+        # Only whole days entirely before the cutoff.
+        if datetime.combine(day + timedelta(days=1), datetime.min.time()) > cutoff:
+            continue
+        await db.execute(text(f"DROP TABLE {name}"))
+        await db.commit()
+        progress.partitions_dropped += 1
+        log.info("Dropped expired request_logs partition %s", name)
+
+
+async def _delete_batches(db: AsyncSession, model, cutoff: datetime, progress: RetentionProgress) -> int:
+    """Delete expired rows of one table; each table gets its own LOG_RETENTION_MAX_BATCHES budget."""
+    batch_size = max(1, int(settings.log_retention_batch_size))
+    pause = max(0, int(settings.log_retention_batch_pause_ms)) / 1000
+    deleted = 0
+    batches = 0
+    while True:
+        if batches >= max(1, int(settings.log_retention_max_batches)):
+            # Leave the rest for the next run rather than hogging the database.
+            progress.batch_limit_hit = True
+            return deleted
+        ids = select(model.id).where(model.created_at < cutoff).limit(batch_size)
+        result = await db.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False))
+        await db.commit()
+        batches += 1
+        progress.batches += 1
+        count = result.rowcount or 0
+        deleted += count
+        if count < batch_size:
+            return deleted
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def prune_logs(db: AsyncSession, progress: RetentionProgress | None = None) -> RetentionProgress:
+    """One retention pass over request_logs and auth_attempts."""
+    global _last_run
+    progress = progress or RetentionProgress()
+    _last_run = progress
+    now = datetime.utcnow()
+    try:
+        log_days = int(settings.log_retention_days)
+        if log_days > 0:
+            cutoff = now - timedelta(days=log_days)
+            if await _is_partitioned(db):
+                await _maintain_partitions(db, cutoff, progress)
+            progress.request_logs_deleted = await _delete_batches(db, RequestLog, cutoff, progress)
+        auth_days = int(settings.auth_attempt_retention_days)
+        if auth_days > 0:
+            cutoff = now - timedelta(days=auth_days)
+            progress.auth_attempts_deleted = await _delete_batches(db, AuthAttempt, cutoff, progress)
+    except Exception as exc:
+        await db.rollback()
+        progress.error = str(exc)[:300]
+        raise
+    finally:
+        progress.running = False
+        progress.finished_at = datetime.utcnow()
+    return progress
@@ -0,0 +1,229 @@
+"""
+Asynchronous batched RequestLog writer.
+
+`generate_image` used to `db.add(RequestLog(...)); await db.commit()` inline, so every response
+waited on a log commit (and on SQLite, on the global write lock). Logs are now put on a bounded
+asyncio queue and a background task bulk-inserts them in batches (size- or time-triggered),
+flushing whatever is left on shutdown.
+
+Overflow policy when the queue is full (`REQUEST_LOG_OVERFLOW_POLICY`):
+- inline: write the row directly (old behavior, never loses logs)
+- block: wait for queue space (backpressure)
+- drop_newest / drop_oldest: drop a row and count it
+
+`flush()` (log listings, read-your-writes) waits only for rows queued before the call, bounded
+by REQUEST_LOG_FLUSH_WAIT_MS, so it returns under steady traffic too.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal
+from app.models import RequestLog
+
+log = logging.getLogger(__name__)
+
+_COLUMNS = [c for c in RequestLog.__table__.columns if c.key != "id"]
+
+
+def _row_from_log(item: RequestLog) -> dict:
+    # Bulk inserts need a uniform key set, so fill scalar column defaults explicitly.
+    row = {}
+    for column in _COLUMNS:
+        value = getattr(item, column.key, None)
+        if value is None and column.default is not None and column.default.is_scalar:
+            value = column.default.arg
+        row[column.key] = value
+    if row.get("created_at") is None:
+        row["created_at"] = datetime.utcnow()
+    return row
+
+
+class RequestLogWriter:
+    def __init__(self) -> None:
+        self._queue: asyncio.Queue[dict | None] | None = None
+        self._task: asyncio.Task | None = None
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.inline_writes = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.last_flush_ms: float | None = None
+        self.max_flush_ms = 0.0
+        self._flush_ms_total = 0.0
+        # Rows are handled in queue order: `_done` rows handled out of `_queued` put so far.
+        self._queued = 0
+        self._done = 0
+        self._waiters: list[tuple[int, asyncio.Future]] = []
+        self.flush_timeouts = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        if self.running or not settings.request_log_async_enabled:
+            return
+        self._queue = asyncio.Queue(maxsize=max(1, int(settings.request_log_queue_max_size)))
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        task, self._task = self._task, None
+        if task is not None and not task.done() and self._queue is not None:
+            # Sentinel: the writer flushes its current batch and exits.
+            await self._queue.put(None)
+            try:
+                await asyncio.wait_for(task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+        queue = self._queue
+        if queue is not None and not queue.empty():
+            rows = []
+            while not queue.empty():
+                row = queue.get_nowait()
+                queue.task_done()
+                if row is not None:
+                    rows.append(row)
+            await self._write(rows)
+        self._advance(self._queued - self._done)
+
+    async def submit(self, item: RequestLog) -> None:
+        row = _row_from_log(item)
+        queue = self._queue
+        if not self.running or queue is None:
+            await self._write_inline(row)
+            return
+        if queue.full():
+            policy = (settings.request_log_overflow_policy or "inline").strip().lower()
+            if policy == "drop_newest":
+                self.dropped += 1
+                return
+            if policy == "drop_oldest":
+                if queue.get_nowait() is not None:
+                    self._advance(1)
+                queue.task_done()
+                self.dropped += 1
+            elif policy != "block":
+                await self._write_inline(row)
+                return
+        await queue.put(row)
+        self._queued += 1
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, queue.qsize())
+
+    def _advance(self, rows: int) -> None:
+        self._done += rows
+        if not self._waiters:
+            return
+        pending = []
+        for target, future in self._waiters:
+            if target <= self._done:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                pending.append((target, future))
+        self._waiters = pending
+
+    async def flush(self, timeout: float | None = None) -> bool:
+        """
+        Wait until the rows queued before this call are written (read-your-writes for log
+        listings); rows queued meanwhile are not waited for. False if the wait timed out.
+        """
+        target = self._queued
+        if not self.running or self._done >= target:
+            return True
+        if timeout is None:
+            timeout = max(0, int(settings.request_log_flush_wait_ms)) / 1000
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((target, future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.flush_timeouts += 1
+            return False
+        finally:
+            self._waiters = [(t, f) for t, f in self._waiters if f is not future]
+
+    async def _write_inline(self, row: dict) -> None:
+        self.inline_writes += 1
+        await self._write([row])
+
+    async def _write(self, rows: list[dict]) -> None:
+        if not rows:
+            return
+        start = time.perf_counter()
+        try:
+            async with AsyncSessionLocal() as db:
+                await db.execute(insert(RequestLog), rows)
+                await db.commit()
+        except Exception as exc:
+            self.failed += len(rows)
+            log.warning("Failed to write %s request logs: %s", len(rows), exc)
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.written += len(rows)
+        self.batches += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._flush_ms_total += elapsed_ms
+
+    async def _run(self) -> None:
+        queue = self._queue
+        assert queue is not None
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch = [await queue.get()]
+            batch_size = max(1, int(settings.request_log_batch_size))
+            deadline = loop.time() + max(0, int(settings.request_log_flush_interval_ms)) / 1000
+            while len(batch) < batch_size and batch[-1] is not None:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            stopping = batch[-1] is None
+            rows = [row for row in batch if row is not None]
+            try:
+                await self._write(rows)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+                self._advance(len(rows))
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_max_size": settings.request_log_queue_max_size,
+            "max_depth": self.max_depth,
+            "overflow_policy": settings.request_log_overflow_policy,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "inline_writes": self.inline_writes,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "flush_timeouts": self.flush_timeouts,
+            "batches": self.batches,
+            "last_flush_ms": round(self.last_flush_ms, 2) if self.last_flush_ms is not None else None,
+            "avg_flush_ms": round(self._flush_ms_total / self.batches, 2) if self.batches else None,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+
+request_log_writer = RequestLogWriter()
@@ -0,0 +1,344 @@
+"""
+In-process Prometheus-style metrics (text exposition format 0.0.4) served at `/metrics`.
+
+Deliberately tiny instead of depending on `prometheus_client`: counters and histograms are
+plain dict updates on the event loop thread, and gauges are computed from the in-memory
+scheduler / proxy pool / queues only when scraped. Values are per process, so in multi-node
+deployments scrape every node directly (not through the load balancer).
+"""
+
+from __future__ import annotations
+
+import bisect
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Callable, Iterable, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STAGE_BUCKETS = DB_BUCKETS + (5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Computed at scrape time by `collect()`, which returns (label values, value) pairs."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Iterable[str] = (),
+        collect: Callable[[], Iterable[tuple[LabelValues, float]]] | None = None,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def samples(self) -> list[str]:
+        if self.collect is None:
+            return []
+        return [f"{self.name}{_labels(self.labelnames, k)} {_fmt(v)}" for k, v in self.collect()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self._series: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = ([0] * (len(self.buckets) + 1), [0.0])
+            self._series[key] = series
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_fmt(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(total[0])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+M = TypeVar("M", bound=_Metric)
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A broken collector must not take the whole scrape down.
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+GENERATE_DURATION = registry.register(
+    Histogram(
+        "novelai_pool_generate_duration_seconds",
+        "generate-image handler latency until the response starts",
+        ["status_code"],
+    )
+)
+UPSTREAM_DURATION = registry.register(
+    Histogram(
+        "novelai_pool_upstream_duration_seconds",
+        "Upstream generate-image call latency per attempt (including a streamed body)",
+        ["status_code"],
+    )
+)
+GENERATE_REQUESTS = registry.register(
+    Counter(
+        "novelai_pool_generate_requests_total",
+        "Final generate-image outcomes",
+        ["status", "status_code", "model"],
+    )
+)
+GENERATE_REJECTIONS = registry.register(
+    Counter(
+        "novelai_pool_generate_rejections_total",
+        "Rejected or failed generate-image requests by reason",
+        ["reason"],
+    )
+)
+GENERATE_STAGE_DURATION = registry.register(
+    Histogram(
+        "novelai_pool_generate_stage_seconds",
+        "generate-image time per stage (auth, rate_limit, quota, validate, key, upstream, stream, log)",
+        ["stage"],
+        buckets=STAGE_BUCKETS,
+    )
+)
+UPSTREAM_RETRIES = registry.register(
+    Counter(
+        "novelai_pool_upstream_retries_total",
+        "Upstream attempts that failed and were retried on another key",
+        ["status_code"],
+    )
+)
+DB_QUERY_DURATION = registry.register(
+    Histogram(
+        "novelai_pool_db_query_duration_seconds",
+        "Database statement execution time",
+        ["statement"],
+        buckets=DB_BUCKETS,
+    )
+)
+DB_CONNECT_DURATION = registry.register(
+    Histogram(
+        "novelai_pool_db_connect_seconds",
+        "Time spent opening a new DB connection for the pool",
+        buckets=DB_BUCKETS + (5.0, 10.0, 30.0),
+    )
+)
+# Observed by app.database.TimedQueuePool (queue pools only; SQLite checkouts never wait).
+DB_POOL_CHECKOUT_WAIT = registry.register(
+    Histogram(
+        "novelai_pool_db_pool_checkout_wait_seconds",
+        "Time spent waiting for a pooled DB connection (including opening a new one)",
+        buckets=DB_BUCKETS + (5.0, 10.0, 30.0),
+    )
+)
+
+
+def _collect_keys() -> list[tuple[LabelValues, float]]:
+    from app.services.key_scheduler import key_scheduler
+
+    now = datetime.utcnow()
+    counts: dict[str, int] = {}
+    for entry in key_scheduler.entries():
+        state = entry.status
+        if state == "healthy" and entry.cooldown_until is not None and entry.cooldown_until > now:
+            state = "cooling"
+        counts[state] = counts.get(state, 0) + 1
+    return [((state,), count) for state, count in sorted(counts.items())]
+
+
+def _collect_in_flight() -> list[tuple[LabelValues, float]]:
+    from app.services.key_scheduler import key_scheduler
+
+    return [((), key_scheduler.snapshot()["leased"])]
+
+
+def _collect_proxies() -> list[tuple[LabelValues, float]]:
+    from app.services.upstream_proxy_pool import UpstreamProxyPool
+
+    return [((p["proxy"],), p["fail_streak"]) for p in UpstreamProxyPool.snapshot()]
+
+
+def _collect_queues() -> list[tuple[LabelValues, float]]:
+    from app.services.admission import admission_queue
+    from app.services.log_writer import request_log_writer
+
+    return [
+        (("admission",), admission_queue.depth),
+        (("request_log",), request_log_writer.stats()["queue_depth"]),
+    ]
+
+
+registry.register(
+    Gauge("novelai_pool_keys", "Upstream keys by state (cooling = healthy but in cooldown)", ["state"], _collect_keys)
+)
+registry.register(
+    Gauge("novelai_pool_upstream_in_flight", "Upstream requests currently holding a key lease", (), _collect_in_flight)
+)
+registry.register(
+    Gauge("novelai_pool_proxy_fail_streak", "Upstream proxy consecutive failures", ["proxy"], _collect_proxies)
+)
+# Connections currently checked out of the engine's pool (any pool class), via pool events.
+_db_checked_out = 0
+
+
+def db_connections_checked_out() -> int:
+    return _db_checked_out
+
+
+def _collect_db_pool() -> list[tuple[LabelValues, float]]:
+    from app.database import engine
+
+    pool = engine.sync_engine.pool
+    samples: list[tuple[LabelValues, float]] = [(("checked_out",), _db_checked_out)]
+    # Queue pools also report idle connections and their size (SQLite uses null / static pools);
+    # checked_out reaching size + max_overflow means checkouts are waiting.
+    if hasattr(pool, "checkedin"):
+        samples.append((("idle",), pool.checkedin()))
+        samples.append((("size",), pool.size()))
+    return samples
+
+
+registry.register(Gauge("novelai_pool_queue_depth", "In-process queue depths", ["queue"], _collect_queues))
+registry.register(Gauge("novelai_pool_db_connections", "DB connection pool usage", ["state"], _collect_db_pool))
+
+
+def _statement_kind(statement: str) -> str:
+    head = statement.lstrip().split(None, 1)
+    kind = head[0].upper() if head else ""
+    return kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER"
+
+
+def install_db_metrics(engine: AsyncEngine) -> None:
+    """Time every DB statement and new pool connection, and count checkouts, via SQLAlchemy events."""
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("_metrics_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("_metrics_query_start")
+        if starts:
+            DB_QUERY_DURATION.observe(time.perf_counter() - starts.pop(), statement=_statement_kind(statement))
+
+    @event.listens_for(engine.sync_engine, "do_connect")
+    def _before_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info["_metrics_connect_start"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        start = connection_record.info.pop("_metrics_connect_start", None)
+        if start is not None:
+            DB_CONNECT_DURATION.observe(time.perf_counter() - start)
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        global _db_checked_out
+        _db_checked_out += 1
+
+    @event.listens_for(engine.sync_engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        global _db_checked_out
+        _db_checked_out = max(0, _db_checked_out - 1)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _error(context):
+        # after_cursor_execute does not fire for failed statements; drop their start time.
+        starts = context.connection.info.get("_metrics_query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
@@ -1,52 +1,261 @@
+import time
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from sqlalchemy import select, func
+
+from sqlalchemy import case, select, func
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
 from app.models import ApiKey, RequestLog, User
+from app.services.auth_cache import AuthPrincipal
+from app.services.shared_state import get_shared_state, shared_call
+
+WINDOW_SECONDS = 60
+# Non-final failover attempts are logged with this action and do not count against the RPM.
+RETRY_LOG_ACTION = "generate-image-retry"
+_SWEEP_THRESHOLD = 10_000
+
+
+@dataclass(frozen=True)
+class UserQuota:
+    contributed_count: int
+    healthy_count: int
+    rpm: int  # auto-quota RPM; `manual_rpm` / global overrides are applied by get_user_rpm
+
+
+class QuotaCache:
+    """
+    Per-user key counts and derived auto-quota RPM.
+    Invalidated when a user's keys are uploaded, deleted, toggled or change health status,
+    and cleared on config changes. The TTL bounds staleness for changes made by other nodes.
+    """
+
+    def __init__(self) -> None:
+        self._items: dict[int, tuple[UserQuota, float]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> UserQuota | None:
+        item = self._items.get(user_id)
+        if item is None or item[1] <= time.monotonic():
+            return None
+        return item[0]
+
+    def set(self, user_id: int, quota: UserQuota) -> None:
+        ttl = max(0, int(settings.quota_cache_ttl_seconds))
+        if ttl > 0:
+            self._items[user_id] = (quota, time.monotonic() + ttl)
+
+    def invalidate(self, user_id: int) -> None:
+        self._items.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "ttl_seconds": settings.quota_cache_ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+        }
+
+
+quota_cache = QuotaCache()
+
+
+def _compute_auto_rpm(contributed_count: int, healthy_count: int) -> int:
+    if settings.base_rpm_contributor_only and contributed_count <= 0:
+        return 0
+    rpm = settings.base_rpm + healthy_count * settings.per_key_rpm
+    rpm = min(rpm, settings.max_rpm) if settings.max_rpm > 0 else rpm
+    return max(0, rpm)
 
 
-async def get_user_rpm(db: AsyncSession, user: User) -> int:
+async def get_user_quota(db: AsyncSession, user_id: int) -> UserQuota:
+    cached = quota_cache.get(user_id)
+    if cached is not None:
+        quota_cache.hits += 1
+        return cached
+    quota_cache.misses += 1
+    result = await db.execute(
+        select(
+            func.count(ApiKey.id),
+            func.coalesce(func.sum(case((ApiKey.status == "healthy", 1), else_=0)), 0),
+        )
+        .where(ApiKey.user_id == user_id)
+        .where(ApiKey.is_enabled == True)
+    )
+    contributed_count, healthy_count = result.one()
+    contributed_count = int(contributed_count or 0)
+    healthy_count = int(healthy_count or 0)
+    quota = UserQuota(
+        contributed_count=contributed_count,
+        healthy_count=healthy_count,
+        rpm=_compute_auto_rpm(contributed_count, healthy_count),
+    )
+    quota_cache.set(user_id, quota)
+    return quota
+
+
+async def get_user_rpm(db: AsyncSession, user: User | AuthPrincipal) -> int:
     if user.manual_rpm is not None:
         return max(0, user.manual_rpm)
 
     if not settings.auto_quota_enabled:
         return max(0, settings.manual_global_rpm)
 
-    if settings.base_rpm_contributor_only:
-        contributed = await db.execute(
-            select(func.count(ApiKey.id))
-            .where(ApiKey.user_id == user.id)
-            .where(ApiKey.is_enabled == True)
+    quota = await get_user_quota(db, user.id)
+    return quota.rpm
+
+
+class DbRateLimiter:
+    """Counts `request_logs` rows in the window. Consistent across nodes sharing one DB."""
+
+    name = "db"
+
+    async def count(self, db: AsyncSession, user_id: int) -> int:
+        window_start = datetime.utcnow() - timedelta(seconds=WINDOW_SECONDS)
+        result = await db.execute(
+            select(func.count(RequestLog.id))
+            .where(RequestLog.user_id == user_id)
+            .where(RequestLog.created_at >= window_start)
+            .where(RequestLog.action != RETRY_LOG_ACTION)
         )
-        contributed_count = contributed.scalar() or 0
-        if contributed_count <= 0:
+        return result.scalar() or 0
+
+
+class InMemoryRateLimiter:
+    """
+    Per-user sliding window of request timestamps (one deque per user).
+    Every logged request is recorded, so the count matches the `request_logs` semantics
+    (rejected requests count too). Warmed from the DB once so a restart does not reset quotas.
+    """
+
+    name = "memory"
+
+    def __init__(self) -> None:
+        self._hits: dict[int, deque[float]] = {}
+        self._warmed = False
+
+    def _prune(self, user_id: int, now: float) -> deque[float] | None:
+        hits = self._hits.get(user_id)
+        if hits is None:
+            return None
+        # Same edge as DbRateLimiter (`created_at >= now - window`).
+        cutoff = now - WINDOW_SECONDS
+        while hits and hits[0] < cutoff:
+            hits.popleft()
+        if not hits:
+            self._hits.pop(user_id, None)
+            return None
+        return hits
+
+    def record(self, user_id: int, at: float | None = None) -> None:
+        now = time.monotonic()
+        self._hits.setdefault(user_id, deque()).append(now if at is None else at)
+        if len(self._hits) > _SWEEP_THRESHOLD:
+            for uid in list(self._hits):
+                self._prune(uid, now)
+
+    async def warm(self, db: AsyncSession) -> None:
+        if self._warmed:
+            return
+        self._warmed = True
+        now_utc = datetime.utcnow()
+        now = time.monotonic()
+        result = await db.execute(
+            select(RequestLog.user_id, RequestLog.created_at)
+            .where(RequestLog.created_at >= now_utc - timedelta(seconds=WINDOW_SECONDS))
+            .where(RequestLog.action != RETRY_LOG_ACTION)
+            .order_by(RequestLog.created_at.asc())
+        )
+        # Runs once at startup, before the async log writer has queued anything in this process,
+        # so the DB holds every logged request of the window; later ones are recorded in memory.
+        hits: dict[int, deque[float]] = {}
+        for user_id, created_at in result.all():
+            hits.setdefault(user_id, deque()).append(now - (now_utc - created_at).total_seconds())
+        self._hits = hits
+
+    async def count(self, db: AsyncSession, user_id: int) -> int:
+        await self.warm(db)
+        hits = self._prune(user_id, time.monotonic())
+        return len(hits) if hits else 0
+
+
+class SharedRateLimiter:
+    """
+    Two fixed one-minute counters in the shared state (services/shared_state.py), the previous
+    one weighted by how much of it still overlaps the sliding window. The request is counted
+    when it is checked, in one atomic increment, so all nodes see the same number at once.
+    Falls back to the in-memory window when the shared state is unreachable.
+    """
+
+    name = "shared"
+
+    def __init__(self) -> None:
+        # user id -> (window, count): a finished window no longer changes, so it is read once.
+        self._previous: dict[int, tuple[int, int]] = {}
+
+    async def _previous_count(self, user_id: int, window: int) -> int:
+        cached = self._previous.get(user_id)
+        if cached is not None and cached[0] == window:
+            return cached[1]
+        value = await shared_call(get_shared_state().get(f"rl:{user_id}:{window}"), None)
+        if value is None:
             return 0
+        if len(self._previous) > 10000:
+            self._previous = {uid: item for uid, item in self._previous.items() if item[0] >= window}
+        self._previous[user_id] = (window, value)
+        return value
 
-    result = await db.execute(
-        select(func.count(ApiKey.id))
-        .where(ApiKey.user_id == user.id)
-        .where(ApiKey.status == "healthy")
-        .where(ApiKey.is_enabled == True)
-    )
-    healthy_count = result.scalar() or 0
+    async def count(self, db: AsyncSession, user_id: int) -> int:
+        """Requests in the window before this one; also counts this one."""
+        now = time.time()
+        window = int(now // WINDOW_SECONDS)
+        state = get_shared_state()
+        current = await shared_call(state.incr(f"rl:{user_id}:{window}", 2 * WINDOW_SECONDS), None)
+        if current is None:
+            return await _memory_limiter.count(db, user_id)
+        previous = await self._previous_count(user_id, window - 1)
+        overlap = 1 - (now % WINDOW_SECONDS) / WINDOW_SECONDS
+        return int(previous * overlap) + current - 1
+
+
+_memory_limiter = InMemoryRateLimiter()
+_db_limiter = DbRateLimiter()
+_shared_limiter = SharedRateLimiter()
 
-    rpm = settings.base_rpm + healthy_count * settings.per_key_rpm
-    rpm = min(rpm, settings.max_rpm) if settings.max_rpm > 0 else rpm
-    return max(0, rpm)
 
+def get_rate_limiter() -> InMemoryRateLimiter | DbRateLimiter | SharedRateLimiter:
+    backend = (settings.rate_limit_backend or "auto").strip().lower()
+    if backend == "auto":
+        if not settings.multi_node_enabled:
+            backend = "memory"
+        else:
+            backend = "shared" if get_shared_state().distributed else "db"
+    if backend == "shared":
+        return _shared_limiter
+    return _db_limiter if backend == "db" else _memory_limiter
 
-async def enforce_rate_limit(db: AsyncSession, user: User) -> None:
+
+async def warm_rate_limiter(db: AsyncSession) -> None:
+    await _memory_limiter.warm(db)
+
+
+def record_request(user_id: int) -> None:
+    """Record a logged request. Always tracked in memory so switching backends is seamless."""
+    _memory_limiter.record(user_id)
+
+
+async def enforce_rate_limit(db: AsyncSession, user: User | AuthPrincipal) -> None:
     rpm = await get_user_rpm(db, user)
     if rpm <= 0:
         raise PermissionError("No quota available")
 
-    window_start = datetime.utcnow() - timedelta(seconds=60)
-    result = await db.execute(
-        select(func.count(RequestLog.id))
-        .where(RequestLog.user_id == user.id)
-        .where(RequestLog.created_at >= window_start)
-    )
-    used = result.scalar() or 0
+    used = await get_rate_limiter().count(db, user.id)
     if used >= rpm:
         raise PermissionError(f"Rate limit exceeded ({used}/{rpm} per minute)")
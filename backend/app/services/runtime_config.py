@@ -0,0 +1,171 @@
+"""
+Compiled, immutable view of the settings read on the generate-image hot path.
+
+`settings` holds raw values (comma-separated lists, plain ints) and is changed in place by
+`/admin/config` and the SystemConfig watcher. Handlers read `runtime_config()` instead: model
+sets are pre-split, backoff tables precomputed, the proxy list parsed and numeric limits
+validated once per change. A change builds a new `RuntimeConfig` and publishes it with a single
+reference assignment, so a request that grabbed the snapshot sees one consistent version.
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Mapping
+
+from app.config import settings
+
+log = logging.getLogger(__name__)
+
+# Key backoff doubles up to 2^4 (see RuntimeConfig.key_backoff).
+_KEY_BACKOFF_STEPS = 5
+# Proxy backoff tables stop here; any sane max cooldown is reached long before.
+_PROXY_BACKOFF_STEPS = 32
+
+# Must be >= 0: a negative limit or cooldown is a typo, not a setting.
+_NON_NEGATIVE = (
+    "opus_max_pixels",
+    "opus_max_steps",
+    "opus_max_samples",
+    "health_check_fail_threshold",
+    "cooldown_max_seconds",
+    "cooldown_402_base_seconds",
+    "cooldown_409_base_seconds",
+    "cooldown_429_base_seconds",
+    "cooldown_5xx_base_seconds",
+    "upstream_proxy_cooldown_seconds",
+    "upstream_proxy_cooldown_429_seconds",
+    "upstream_proxy_cooldown_5xx_seconds",
+    "upstream_proxy_cooldown_error_seconds",
+    "upstream_proxy_max_cooldown_seconds",
+    "upstream_proxy_failure_threshold",
+    "upstream_proxy_fail_streak_cap",
+    "upstream_retry_max_attempts",
+    "upstream_retry_deadline_seconds",
+    "upstream_proxy_keepalive_timeout_seconds",
+)
+
+
+def _split(raw: str | None) -> tuple[str, ...]:
+    return tuple(p.strip() for p in (raw or "").split(",") if p.strip())
+
+
+def _backoff_table(base: int, max_seconds: int | None, steps: int) -> tuple[int, ...]:
+    """Cooldown for fail streak 1..n (base * 2^(streak-1), capped); longer streaks use the last."""
+    if base <= 0:
+        return (0,)
+    table = []
+    for i in range(steps):
+        seconds = base * 2**i
+        if max_seconds is not None and seconds >= max_seconds:
+            table.append(max_seconds)
+            break
+        table.append(seconds)
+    return tuple(table)
+
+
+def backoff(table: tuple[int, ...], fail_streak: int) -> int:
+    return table[min(max(1, int(fail_streak or 1)), len(table)) - 1]
+
+
+@dataclass(frozen=True)
+class RuntimeConfig:
+    models: tuple[str, ...]
+    model_set: frozenset[str]
+    default_model: str
+    generate_image_url: str
+    opus_max_pixels: int
+    opus_max_steps: int
+    opus_max_samples: int
+    log_request_ip: bool
+    server_timing_header: bool
+    streaming_enabled: bool
+    retry_max_attempts: int
+    retry_deadline_seconds: int
+    health_check_fail_threshold: int
+    dynamic_cooldown: bool
+    # Key backoff tables by upstream status class: "402", "409", "429", "5xx" (unknown 4xx use "409").
+    key_backoff: Mapping[str, tuple[int, ...]]
+    proxy_pool_enabled: bool
+    proxies: tuple[str, ...]
+    proxy_strategy: str
+    proxy_sticky_salt: str
+    proxy_handle_429: bool
+    proxy_handle_5xx: bool
+    proxy_handle_network_errors: bool
+    proxy_failure_threshold: int
+    proxy_fail_streak_cap: int
+    # Proxy backoff tables by failure class: "429", "5xx", "error" (network), "other".
+    proxy_backoff: Mapping[str, tuple[int, ...]]
+    proxy_keepalive_url: str
+    proxy_keepalive_timeout_seconds: float
+
+
+def build_runtime_config(source: Any = settings) -> RuntimeConfig:
+    """Compile `source` (the settings, or a candidate copy of them); ValueError if it is invalid."""
+    for name in _NON_NEGATIVE:
+        if int(getattr(source, name)) < 0:
+            raise ValueError(f"{name} must be >= 0")
+    models = _split(source.novelai_models)
+    key_max = int(source.cooldown_max_seconds) or None
+    proxy_max = int(source.upstream_proxy_max_cooldown_seconds)
+    proxies = _split(source.upstream_proxies)
+    return RuntimeConfig(
+        models=models,
+        model_set=frozenset(models),
+        default_model=source.novelai_default_model,
+        generate_image_url=source.novelai_image_base_url.rstrip("/") + "/ai/generate-image",
+        opus_max_pixels=int(source.opus_max_pixels),
+        opus_max_steps=int(source.opus_max_steps),
+        opus_max_samples=int(source.opus_max_samples),
+        log_request_ip=bool(source.log_request_ip),
+        server_timing_header=bool(source.server_timing_header_enabled),
+        streaming_enabled=bool(source.upstream_streaming_enabled),
+        retry_max_attempts=max(1, int(source.upstream_retry_max_attempts)),
+        retry_deadline_seconds=max(1, int(source.upstream_retry_deadline_seconds)),
+        health_check_fail_threshold=int(source.health_check_fail_threshold),
+        dynamic_cooldown=bool(source.dynamic_cooldown_enabled),
+        key_backoff=MappingProxyType({
+            kind: _backoff_table(int(getattr(source, f"cooldown_{kind}_base_seconds")), key_max, _KEY_BACKOFF_STEPS)
+            for kind in ("402", "409", "429", "5xx")
+        }),
+        proxy_pool_enabled=source.upstream_proxy_mode == "proxy_pool" and bool(proxies),
+        proxies=proxies,
+        proxy_strategy=source.upstream_proxy_strategy,
+        proxy_sticky_salt=source.upstream_proxy_sticky_salt or "",
+        proxy_handle_429=bool(source.upstream_proxy_handle_429),
+        proxy_handle_5xx=bool(source.upstream_proxy_handle_5xx),
+        proxy_handle_network_errors=bool(source.upstream_proxy_handle_network_errors),
+        proxy_failure_threshold=max(1, int(source.upstream_proxy_failure_threshold)),
+        proxy_fail_streak_cap=int(source.upstream_proxy_fail_streak_cap),
+        proxy_backoff=MappingProxyType({
+            kind: _backoff_table(int(getattr(source, name)), proxy_max, _PROXY_BACKOFF_STEPS)
+            for kind, name in (
+                ("429", "upstream_proxy_cooldown_429_seconds"),
+                ("5xx", "upstream_proxy_cooldown_5xx_seconds"),
+                ("error", "upstream_proxy_cooldown_error_seconds"),
+                ("other", "upstream_proxy_cooldown_seconds"),
+            )
+        }),
+        proxy_keepalive_url=source.upstream_proxy_keepalive_url or "https://api.novelai.net/",
+        proxy_keepalive_timeout_seconds=float(source.upstream_proxy_keepalive_timeout_seconds),
+    )
+
+
+_current: RuntimeConfig = build_runtime_config()
+
+
+def runtime_config() -> RuntimeConfig:
+    return _current
+
+
+def refresh_runtime_config() -> RuntimeConfig:
+    """Recompile from `settings` after they changed; an invalid change keeps the previous snapshot."""
+    global _current
+    try:
+        _current = build_runtime_config()
+    except ValueError as exc:
+        log.warning("Invalid runtime config, keeping the previous one: %s", exc)
+    return _current
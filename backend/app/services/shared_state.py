@@ -0,0 +1,543 @@
+"""
+Cross-node shared state: counters, leases and TTL markers.
+
+In multi-node mode each node used to keep its own view: proxy cooldowns lived in a per-process
+class attribute, key cooldowns and in-flight leases in the local key scheduler, and rate limits
+were counted from `request_logs` (behind the write-behind log queue). Nodes kept sending traffic
+to proxies and keys another node had just seen fail, or that were busy on another node.
+
+`SharedState` has three primitives:
+- counters with a fixed expiry (`incr` / `get`): the shared rate limiter's windows;
+- bounded leases (`acquire` / `release` / `touch`): cross-node key concurrency. A lease counter
+  expires `ttl` after its last acquire or touch, so a crashed node cannot hold a key forever;
+- "until" markers (`set_until` / `active_until`): proxy and key cooldowns. The later expiry wins.
+
+Backends (SHARED_STATE_BACKEND): `memory` (in-process, single node), `db` (the `shared_state`
+table, one `INSERT ... ON CONFLICT DO UPDATE` per write) and `redis` (any Redis-protocol server,
+spoken directly over asyncio, no client library). `auto` is memory on a single node and db in
+multi-node mode.
+
+Cooldowns go through an outbox that `tasks/scheduler.shared_state_sync_loop` pushes and pulls,
+so the request path only talks to the backend for the rate-limit window and the key lease.
+Backend errors fail open (local state only) and are counted in `stats()`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, TypeVar
+from urllib.parse import unquote, urlparse
+
+from sqlalchemy import case, delete, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.config import settings
+from app.database import AsyncSessionLocal, engine
+from app.models import SharedStateEntry
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+UNTIL_PREFIX = "until:"
+# TTL for a Redis lease counter that a late release recreated without one.
+_ORPHAN_TTL_MS = 60_000
+
+
+class SharedState(ABC):
+    name = "base"
+    # False when the state only lives in this process (nothing to share or sync).
+    distributed = True
+
+    @abstractmethod
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        """Increment a counter; a new (or expired) counter starts at 1 and expires after the TTL."""
+
+    @abstractmethod
+    async def get(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    async def acquire(self, key: str, limit: int, ttl_seconds: float) -> bool:
+        """Take one of `limit` lease slots; refreshes the TTL."""
+
+    @abstractmethod
+    async def release(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def touch(self, key: str, ttl_seconds: float) -> None:
+        """Extend a live lease counter's TTL (a lease held longer than the TTL, e.g. a long stream)."""
+
+    @abstractmethod
+    async def set_until(self, name: str, until: float) -> None:
+        """Publish a marker valid until `until` (epoch seconds); never shortens a later one."""
+
+    @abstractmethod
+    async def active_until(self) -> dict[str, float]:
+        ...
+
+    async def purge_expired(self) -> int:
+        return 0
+
+    async def close(self) -> None:
+        pass
+
+
+class MemorySharedState(SharedState):
+    name = "memory"
+    distributed = False
+
+    def __init__(self) -> None:
+        # key -> (value, expires_at)
+        self._values: dict[str, tuple[float, float]] = {}
+
+    def _live(self, key: str, now: float) -> float | None:
+        item = self._values.get(key)
+        if item is None:
+            return None
+        if item[1] <= now:
+            self._values.pop(key, None)
+            return None
+        return item[0]
+
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        now = time.time()
+        value = self._live(key, now)
+        if value is None:
+            self._values[key] = (1, now + ttl_seconds)
+            return 1
+        self._values[key] = (value + 1, self._values[key][1])
+        return int(value + 1)
+
+    async def get(self, key: str) -> int:
+        return int(self._live(key, time.time()) or 0)
+
+    async def acquire(self, key: str, limit: int, ttl_seconds: float) -> bool:
+        now = time.time()
+        value = self._live(key, now) or 0
+        if value >= limit:
+            return False
+        self._values[key] = (value + 1, now + ttl_seconds)
+        return True
+
+    async def release(self, key: str) -> None:
+        value = self._live(key, time.time())
+        if value:
+            self._values[key] = (value - 1, self._values[key][1])
+
+    async def touch(self, key: str, ttl_seconds: float) -> None:
+        now = time.time()
+        value = self._live(key, now)
+        if value is not None:
+            self._values[key] = (value, now + ttl_seconds)
+
+    async def set_until(self, name: str, until: float) -> None:
+        key = UNTIL_PREFIX + name
+        current = self._live(key, time.time())
+        if current is None or until > current:
+            self._values[key] = (until, until)
+
+    async def active_until(self) -> dict[str, float]:
+        now = time.time()
+        return {
+            key[len(UNTIL_PREFIX):]: value
+            for key, (value, expires_at) in self._values.items()
+            if key.startswith(UNTIL_PREFIX) and expires_at > now
+        }
+
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [key for key, (_, expires_at) in self._values.items() if expires_at <= now]
+        for key in expired:
+            self._values.pop(key, None)
+        return len(expired)
+
+
+class DbSharedState(SharedState):
+    """Rows in `shared_state`; each write is a single upsert, so a busy lease costs one statement."""
+
+    name = "db"
+
+    @staticmethod
+    def _upsert(key: str, value: float, expires_at: float):
+        insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+        return insert(SharedStateEntry).values(key=key, value=value, expires_at=expires_at)
+
+    @staticmethod
+    async def _scalar(stmt) -> float | None:
+        async with AsyncSessionLocal() as db:
+            value = (await db.execute(stmt)).scalar_one_or_none()
+            await db.commit()
+            return value
+
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        now = time.time()
+        live = SharedStateEntry.expires_at > now
+        stmt = self._upsert(key, 1, now + ttl_seconds)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SharedStateEntry.key],
+            set_={
+                "value": case((live, SharedStateEntry.value + 1), else_=1),
+                "expires_at": case((live, SharedStateEntry.expires_at), else_=stmt.excluded.expires_at),
+            },
+        ).returning(SharedStateEntry.value)
+        return int(await self._scalar(stmt) or 0)
+
+    async def get(self, key: str) -> int:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(SharedStateEntry.value).where(
+                    SharedStateEntry.key == key, SharedStateEntry.expires_at > time.time()
+                )
+            )
+            return int(result.scalar_one_or_none() or 0)
+
+    async def acquire(self, key: str, limit: int, ttl_seconds: float) -> bool:
+        now = time.time()
+        live = SharedStateEntry.expires_at > now
+        stmt = self._upsert(key, 1, now + ttl_seconds)
+        # A full lease matches the conflict but not the WHERE: no row comes back.
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SharedStateEntry.key],
+            set_={
+                "value": case((live, SharedStateEntry.value + 1), else_=1),
+                "expires_at": stmt.excluded.expires_at,
+            },
+            where=or_(~live, SharedStateEntry.value < limit),
+        ).returning(SharedStateEntry.value)
+        return await self._scalar(stmt) is not None
+
+    async def release(self, key: str) -> None:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(SharedStateEntry)
+                .where(SharedStateEntry.key == key, SharedStateEntry.value > 0)
+                .values(value=SharedStateEntry.value - 1)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+    async def touch(self, key: str, ttl_seconds: float) -> None:
+        now = time.time()
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(SharedStateEntry)
+                .where(SharedStateEntry.key == key, SharedStateEntry.expires_at > now)
+                .values(expires_at=now + ttl_seconds)
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+
+    async def set_until(self, name: str, until: float) -> None:
+        stmt = self._upsert(UNTIL_PREFIX + name, until, until)
+        later = case(
+            (SharedStateEntry.value >= stmt.excluded.value, SharedStateEntry.value), else_=stmt.excluded.value
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SharedStateEntry.key], set_={"value": later, "expires_at": later}
+        )
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt)
+            await db.commit()
+
+    async def active_until(self) -> dict[str, float]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(SharedStateEntry.key, SharedStateEntry.value).where(
+                    SharedStateEntry.key.startswith(UNTIL_PREFIX), SharedStateEntry.expires_at > time.time()
+                )
+            )
+            return {key[len(UNTIL_PREFIX):]: value for key, value in result.all()}
+
+    async def purge_expired(self) -> int:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(delete(SharedStateEntry).where(SharedStateEntry.expires_at <= time.time()))
+            await db.commit()
+            return result.rowcount or 0
+
+
+class RespError(Exception):
+    """Error reply from the server (the connection itself is still usable)."""
+
+
+class _RespClient:
+    """Minimal RESP2 client: one connection; each call sends a pipeline of commands under a lock."""
+
+    def __init__(self, url: str) -> None:
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.tls = parsed.scheme == "rediss"
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(command: tuple) -> bytes:
+        parts = [b"*%d\r\n" % len(command)]
+        for arg in command:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            size = int(rest)
+            if size < 0:
+                return None
+            return (await self._reader.readexactly(size + 2))[:-2].decode()
+        if kind == b"*":
+            size = int(rest)
+            if size < 0:
+                return None
+            return [await self._read_reply() for _ in range(size)]
+        raise ConnectionError(f"Unexpected reply: {line[:50]!r}")
+
+    async def _roundtrip(self, commands: tuple[tuple, ...]) -> list:
+        self._writer.write(b"".join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        # Read every reply before raising so the connection stays in sync.
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    async def _connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, ssl=True if self.tls else None)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            await self._roundtrip(tuple(setup))
+
+    async def pipeline(self, *commands: tuple) -> list:
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._roundtrip(commands)
+            except RespError:
+                raise
+            except BaseException:
+                # Timeout / cancellation / network error: replies may be pending, start over.
+                self._close()
+                raise
+
+    def _close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def close(self) -> None:
+        async with self._lock:
+            self._close()
+
+
+class RedisSharedState(SharedState):
+    """Plain commands only (no Lua), so Redis-compatible stand-ins work too."""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str) -> None:
+        self.url = url
+        self.prefix = prefix
+        self._client = _RespClient(url)
+
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+
+    async def incr(self, key: str, ttl_seconds: float) -> int:
+        key = self._key(key)
+        _, value = await self._client.pipeline(
+            ("SET", key, 0, "PX", max(1, int(ttl_seconds * 1000)), "NX"), ("INCR", key)
+        )
+        return int(value)
+
+    async def get(self, key: str) -> int:
+        (value,) = await self._client.pipeline(("GET", self._key(key)))
+        return int(value or 0)
+
+    async def acquire(self, key: str, limit: int, ttl_seconds: float) -> bool:
+        key = self._key(key)
+        value, _ = await self._client.pipeline(("INCR", key), ("PEXPIRE", key, max(1, int(ttl_seconds * 1000))))
+        if value <= limit:
+            return True
+        await self._client.pipeline(("DECR", key))
+        return False
+
+    async def release(self, key: str) -> None:
+        key = self._key(key)
+        *_, (value, pttl) = await self._client.pipeline(("MULTI",), ("DECR", key), ("PTTL", key), ("EXEC",))
+        repair = []
+        if value < 0:
+            # The lease counter expired while held; do not leave it negative.
+            repair.append(("INCR", key))
+        if pttl == -1:
+            # ...and DECR recreated it without a TTL: let it expire (the next acquire resets it).
+            repair.append(("PEXPIRE", key, _ORPHAN_TTL_MS))
+        if repair:
+            await self._client.pipeline(*repair)
+
+    async def touch(self, key: str, ttl_seconds: float) -> None:
+        await self._client.pipeline(("PEXPIRE", self._key(key), max(1, int(ttl_seconds * 1000))))
+
+    async def set_until(self, name: str, until: float) -> None:
+        # Sorted set scored by expiry; GT keeps the later one when nodes disagree.
+        await self._client.pipeline(("ZADD", self._key("cooldowns"), "GT", repr(until), name))
+
+    async def active_until(self) -> dict[str, float]:
+        zset_key = self._key("cooldowns")
+        _, raw = await self._client.pipeline(
+            ("ZREMRANGEBYSCORE", zset_key, "-inf", repr(time.time())),
+            ("ZRANGEBYSCORE", zset_key, "(" + repr(time.time()), "+inf", "WITHSCORES"),
+        )
+        return {name: float(score) for name, score in zip(raw[::2], raw[1::2])}
+
+    async def close(self) -> None:
+        await self._client.close()
+
+
+_memory_state = MemorySharedState()
+_db_state = DbSharedState()
+_redis_state: RedisSharedState | None = None
+
+
+def shared_state_backend() -> str:
+    backend = (settings.shared_state_backend or "auto").strip().lower()
+    if backend == "auto":
+        backend = "db" if settings.multi_node_enabled else "memory"
+    return backend if backend in ("memory", "db", "redis") else "memory"
+
+
+def get_shared_state() -> SharedState:
+    global _redis_state
+    backend = shared_state_backend()
+    if backend == "redis":
+        if (
+            _redis_state is None
+            or _redis_state.url != settings.shared_state_redis_url
+            or _redis_state.prefix != settings.shared_state_key_prefix
+        ):
+            _redis_state = RedisSharedState(settings.shared_state_redis_url, settings.shared_state_key_prefix)
+        return _redis_state
+    return _db_state if backend == "db" else _memory_state
+
+
+class _Stats:
+    def __init__(self) -> None:
+        self.errors = 0
+        self.last_error: str | None = None
+        self.last_error_at = 0.0
+        self.last_sync_at: float | None = None
+        self.remote_markers = 0
+
+
+_stats = _Stats()
+
+
+def _timeout() -> float:
+    return max(1, int(settings.shared_state_timeout_ms)) / 1000
+
+
+async def shared_call(operation: Awaitable[T], default: T) -> T:
+    """Run one backend operation with SHARED_STATE_TIMEOUT_MS; on any error return `default`."""
+    try:
+        return await asyncio.wait_for(operation, timeout=_timeout())
+    except Exception as exc:
+        _stats.errors += 1
+        _stats.last_error = f"{type(exc).__name__}: {exc}"[:300]
+        now = time.monotonic()
+        if now - _stats.last_error_at >= 30:
+            log.warning("Shared state (%s) unavailable, using local state: %s", shared_state_backend(), exc)
+        _stats.last_error_at = now
+        return default
+
+
+# Markers published since the last sync (last write per name wins).
+_outbox: dict[str, float] = {}
+_background: set[asyncio.Task] = set()
+
+
+def publish_until(name: str, until: float) -> None:
+    """Queue a cooldown marker for other nodes (pushed by the sync loop)."""
+    if get_shared_state().distributed:
+        _outbox[name] = until
+
+
+def _in_background(operation: Awaitable[None]) -> None:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        operation.close()
+        return
+    task = loop.create_task(shared_call(operation, None))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def release_soon(key: str) -> None:
+    """Release a lease slot without making the (synchronous) caller wait for the backend."""
+    _in_background(get_shared_state().release(key))
+
+
+def touch_soon(key: str, ttl_seconds: float) -> None:
+    """Extend a lease slot's TTL in the background."""
+    _in_background(get_shared_state().touch(key, ttl_seconds))
+
+
+async def sync_until_markers() -> dict[str, float]:
+    """Push queued markers, then return every live marker (including other nodes')."""
+    state = get_shared_state()
+    pending = list(_outbox.items())
+    _outbox.clear()
+    for index, (name, until) in enumerate(pending):
+        try:
+            await asyncio.wait_for(state.set_until(name, until), _timeout())
+        except Exception:
+            # Keep what was not pushed (unless a newer value was queued meanwhile).
+            for name, until in pending[index:]:
+                _outbox.setdefault(name, until)
+            raise
+    markers = await asyncio.wait_for(state.active_until(), _timeout())
+    _stats.last_sync_at = time.time()
+    _stats.remote_markers = len(markers)
+    return markers
+
+
+async def close_shared_state() -> None:
+    if _redis_state is not None:
+        await _redis_state.close()
+
+
+def stats() -> dict:
+    state = get_shared_state()
+    return {
+        "backend": state.name,
+        "distributed": state.distributed,
+        "errors": _stats.errors,
+        "last_error": _stats.last_error,
+        "pending_markers": len(_outbox),
+        "live_markers": _stats.remote_markers,
+        "last_sync_at": _stats.last_sync_at,
+    }
@@ -0,0 +1,141 @@
+"""
+Per-stage latency breakdown for the proxy path.
+
+`RequestLog.latency_ms` only covers the upstream window. A `StageTimer` lives on
+`request.state` and accumulates wall time per stage (auth, rate_limit, quota, validate, key,
+upstream, log); when the request ends every stage is observed in the
+`novelai_pool_generate_stage_seconds` histogram, and slow or randomly sampled requests are kept
+in a small in-memory ring buffer (`GET /admin/traces`). The stages measured before the response
+starts are also sent to the client as a `Server-Timing` header.
+
+A stage is one `perf_counter()` pair and a dict update, so this stays on in production.
+"""
+
+from __future__ import annotations
+
+import random
+import time
+from collections import deque
+from datetime import datetime
+
+from fastapi import Request
+
+from app.config import settings
+from app.services import metrics
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer: "StageTimer", name: str) -> None:
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc) -> bool:
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+    # False for the no-op timer: nothing is measured, so there is no Server-Timing header either.
+    enabled = True
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        self.user_id: int | None = None
+        self.attempts = 0
+        # Set when a streaming response takes over and finishes the timer itself.
+        self.deferred = False
+        self._finished = False
+
+    def stage(self, name: str) -> _Stage:
+        return _Stage(self, name)
+
+    def add(self, name: str, seconds: float) -> None:
+        # Retries add to the same stage (e.g. two upstream calls).
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        return ", ".join(parts)
+
+    def finish(self, status_code: int) -> None:
+        if self._finished:
+            return
+        self._finished = True
+        total = time.perf_counter() - self.started
+        for name, seconds in self.stages.items():
+            metrics.GENERATE_STAGE_DURATION.observe(seconds, stage=name)
+        trace_sampler.offer(self, status_code, total)
+
+
+class _NullTimer(StageTimer):
+    """Used when stage timing is disabled; records nothing (one per request, like StageTimer)."""
+
+    enabled = False
+
+    def add(self, name: str, seconds: float) -> None:
+        pass
+
+    def finish(self, status_code: int) -> None:
+        pass
+
+
+def request_timer(request: Request) -> StageTimer:
+    """The request's timer, created on first use (the auth dependency runs first)."""
+    timer = getattr(request.state, "stage_timer", None)
+    if timer is None:
+        timer = StageTimer() if settings.stage_timing_enabled else _NullTimer()
+        request.state.stage_timer = timer
+    return timer
+
+
+class TraceSampler:
+    """Ring buffer of slow requests (always kept) plus a random sample of the rest."""
+
+    def __init__(self) -> None:
+        self._traces: deque[dict] = deque(maxlen=max(1, int(settings.trace_buffer_size)))
+        self.offered = 0
+        self.kept = 0
+
+    def offer(self, timer: StageTimer, status_code: int, total: float) -> None:
+        self.offered += 1
+        slow_ms = int(settings.trace_slow_ms)
+        total_ms = total * 1000
+        if not ((slow_ms > 0 and total_ms >= slow_ms) or random.random() < float(settings.trace_sample_rate)):
+            return
+        size = max(1, int(settings.trace_buffer_size))
+        if self._traces.maxlen != size:
+            self._traces = deque(self._traces, maxlen=size)
+        self.kept += 1
+        self._traces.append(
+            {
+                "time": datetime.utcnow(),
+                "user_id": timer.user_id,
+                "status_code": status_code,
+                "attempts": timer.attempts,
+                "total_ms": round(total_ms, 2),
+                "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in timer.stages.items()},
+            }
+        )
+
+    def recent(self, limit: int = 100) -> list[dict]:
+        return list(reversed(self._traces))[: max(0, limit)]
+
+    def stats(self) -> dict:
+        return {
+            "buffered": len(self._traces),
+            "buffer_size": settings.trace_buffer_size,
+            "sample_rate": settings.trace_sample_rate,
+            "slow_ms": settings.trace_slow_ms,
+            "offered": self.offered,
+            "kept": self.kept,
+        }
+
+
+trace_sampler = TraceSampler()
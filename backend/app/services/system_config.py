@@ -1,20 +1,33 @@
 """
 SystemConfig (DB-backed) loader.
 
-In multi-node mode, nodes periodically refresh allowed SystemConfig keys from the shared DB
-and apply them to in-process `settings`. Sensitive keys are blocked to avoid foot-guns.
+In multi-node mode, nodes apply allowed SystemConfig keys from the shared DB to in-process
+`settings`. Every write appends to `system_config_changes`, whose id is a monotonic config
+version: a background watcher (tasks/scheduler.py) polls `max(id)` (or is woken by Postgres
+LISTEN/NOTIFY) and re-reads only the keys changed since the version it applied, so no request
+ever waits on a refresh. Sensitive keys are blocked to avoid foot-guns.
 """
 
 from __future__ import annotations
 
+import asyncio
+import logging
 from datetime import datetime
 from typing import Any
 
-from sqlalchemy import func, select
+from sqlalchemy import delete, func, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.config import settings
-from app.models import SystemConfig
+from app.database import engine
+from app.models import SystemConfig, SystemConfigChange
+from app.services.runtime_config import build_runtime_config, refresh_runtime_config
+
+log = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "nai_pool_system_config"
+# pg_advisory_xact_lock id serializing config writers, so versions become visible in order.
+_WRITE_LOCK_ID = 0x6E616963
 
 
 FORBIDDEN_CONFIG_KEYS: set[str] = {
@@ -23,10 +36,18 @@ FORBIDDEN_CONFIG_KEYS: set[str] = {
     "encryption_key",
     "admin_password",
     "admin_username",
+    "metrics_token",
     # Runtime identity / deployment-critical
     "database_url",
     "node_id",
     "multi_node_enabled",
+    "request_log_partitioning",
+    "shared_state_backend",
+    "shared_state_redis_url",
+    "shared_state_key_prefix",
+    # Upstream keys are sent there
+    "novelai_image_base_url",
+    "novelai_api_base_url",
     # Prevent config-refresh self-mutation via DB
     "system_config_refresh_enabled",
     "system_config_refresh_interval_seconds",
@@ -57,11 +78,6 @@ def _cast_value(value: str | None, current: Any) -> Any:
     return value
 
 
-async def get_system_config_updated_at(db: AsyncSession) -> datetime | None:
-    result = await db.execute(select(func.max(SystemConfig.updated_at)))
-    return result.scalar_one_or_none()
-
-
 async def load_system_config_into_settings(db: AsyncSession) -> datetime | None:
     """
     Load SystemConfig from DB and apply to in-process settings.
@@ -78,4 +94,116 @@ async def load_system_config_into_settings(db: AsyncSession) -> datetime | None:
         if hasattr(settings, key):
             current = getattr(settings, key)
             setattr(settings, key, _cast_value(item.value, current))
-    return await get_system_config_updated_at(db)
+    refresh_runtime_config()
+    result = await db.execute(select(func.max(SystemConfig.updated_at)))
+    return result.scalar_one_or_none()
+
+
+async def record_config_change(db: AsyncSession, key: str) -> None:
+    """
+    Bump the config version for `key`. Call in the transaction that writes the SystemConfig row;
+    on Postgres the commit also notifies the watchers of other nodes.
+    """
+    postgres = db.bind.dialect.name == "postgresql"
+    if postgres:
+        # Without this, a version could commit after a higher one a watcher has already applied.
+        await db.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _WRITE_LOCK_ID})
+    # One row per key keeps the log as small as the config itself.
+    await db.execute(delete(SystemConfigChange).where(SystemConfigChange.key == key))
+    db.add(SystemConfigChange(key=key))
+    await db.flush()
+    if postgres:
+        await db.execute(text("SELECT pg_notify(:channel, '')"), {"channel": NOTIFY_CHANNEL})
+
+
+async def _current_version(db: AsyncSession) -> int:
+    result = await db.execute(select(func.max(SystemConfigChange.id)))
+    return int(result.scalar_one_or_none() or 0)
+
+
+class SystemConfigWatcher:
+    """Tracks the applied config version and applies newer changes to `settings`."""
+
+    def __init__(self) -> None:
+        self.version = 0
+        self.last_change_at: datetime | None = None
+        self._wake = asyncio.Event()
+        self._listener = None
+
+    @property
+    def listening(self) -> bool:
+        return self._listener is not None
+
+    async def load_all(self, db: AsyncSession) -> None:
+        # Version first: a change committed in between is applied again by the next poll.
+        version = await _current_version(db)
+        await load_system_config_into_settings(db)
+        self.version = version
+
+    async def apply_changes(self, db: AsyncSession) -> list[str]:
+        """Apply the keys changed since the last applied version; returns the changed keys."""
+        version = await _current_version(db)
+        if version <= self.version:
+            return []
+        keys = (
+            await db.execute(select(SystemConfigChange.key).where(SystemConfigChange.id > self.version).distinct())
+        ).scalars().all()
+        rows = (await db.execute(select(SystemConfig).where(SystemConfig.key.in_(keys)))).scalars().all()
+        updates: dict[str, Any] = {}
+        for item in rows:
+            key = (item.key or "").strip()
+            if not is_config_key_allowed(key) or not hasattr(settings, key):
+                continue
+            try:
+                updates[key] = _cast_value(item.value, getattr(settings, key))
+            except ValueError:
+                log.warning("Ignoring invalid SystemConfig value for %s: %r", key, item.value)
+        try:
+            build_runtime_config(settings.model_copy(update=updates))
+        except ValueError as exc:
+            log.warning("Ignoring invalid SystemConfig change (%s): %s", ", ".join(sorted(updates)), exc)
+            updates = {}
+        # No await from here on: a request sees either none or all of the new values.
+        for key, value in updates.items():
+            setattr(settings, key, value)
+        refresh_runtime_config()
+        self.version = version
+        self.last_change_at = datetime.utcnow()
+        return sorted(updates)
+
+    async def wait(self, timeout: float) -> None:
+        """Sleep until the next poll, or until a NOTIFY arrives."""
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    async def ensure_listening(self) -> None:
+        """Postgres: LISTEN on a dedicated connection (polling keeps working if this fails)."""
+        if self._listener is not None or engine.dialect.name != "postgresql":
+            return
+        try:
+            import asyncpg
+
+            dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+            conn = await asyncpg.connect(dsn)
+            await conn.add_listener(NOTIFY_CHANNEL, lambda *_: self._wake.set())
+            conn.add_termination_listener(self._on_listener_lost)
+            self._listener = conn
+        except Exception as exc:
+            log.warning("SystemConfig LISTEN unavailable, polling only: %s", exc)
+
+    def _on_listener_lost(self, *_: Any) -> None:
+        self._listener = None
+
+    async def close(self) -> None:
+        conn, self._listener = self._listener, None
+        if conn is not None:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+
+
+system_config_watcher = SystemConfigWatcher()
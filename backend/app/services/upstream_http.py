@@ -0,0 +1,196 @@
+"""
+Shared upstream HTTP clients.
+
+Opening a fresh `httpx.AsyncClient` per call pays a TCP + TLS handshake to NovelAI every time.
+This registry keeps one pooled client per upstream proxy URL (plus one for direct mode) for the
+lifetime of the application, so connections are reused across requests, health checks and
+proxy keepalive probes. When the configured proxy list changes, clients for proxies that are no
+longer listed are dropped and closed after a grace period (requests may still be streaming).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+import httpx
+
+from app.config import settings
+from app.services.runtime_config import RuntimeConfig, runtime_config
+
+log = logging.getLogger(__name__)
+
+DIRECT = "direct"
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+@dataclass
+class ClientStats:
+    created_at: float = field(default_factory=time.time)
+    requests: int = 0
+    # Requests sent and not yet closed (response body fully read or aborted).
+    in_flight: int = 0
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, stats: ClientStats) -> None:
+        self._stream = stream
+        self._stats = stats
+        self._open = True
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        if self._open:
+            self._open = False
+            self._stats.in_flight -= 1
+        await self._stream.aclose()
+
+
+class _TrackedTransport(httpx.AsyncBaseTransport):
+    """Counts requests in flight with the public transport API (httpx has no pool stats)."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, stats: ClientStats) -> None:
+        self._transport = transport
+        self._stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self._stats.requests += 1
+        self._stats.in_flight += 1
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._stats.in_flight -= 1
+            raise
+        response.stream = _TrackedStream(response.stream, self._stats)
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class UpstreamHttpClients:
+    """
+    Application-lifetime registry of pooled upstream clients.
+
+    Clients are keyed by proxy URL (`None` = direct). They are created lazily on first use,
+    pre-warmed at startup for the configured proxies, and closed on shutdown.
+    Per-call timeouts are passed by callers (`client.get(..., timeout=...)`).
+    """
+
+    _clients: dict[str | None, httpx.AsyncClient] = {}
+    _stats: dict[str | None, ClientStats] = {}
+    _http2_warned: bool = False
+    # Runtime config whose proxy list the registry was last checked against.
+    _config: RuntimeConfig | None = None
+
+    @classmethod
+    def _build_client(cls, proxy_url: str | None) -> httpx.AsyncClient:
+        http2 = bool(settings.upstream_http2_enabled)
+        if http2 and not _http2_available():
+            if not cls._http2_warned:
+                log.warning("UPSTREAM_HTTP2_ENABLED is set but 'h2' is not installed; using HTTP/1.1")
+                cls._http2_warned = True
+            http2 = False
+
+        stats = ClientStats()
+        limits = httpx.Limits(
+            max_connections=max(1, int(settings.upstream_max_connections)),
+            max_keepalive_connections=max(0, int(settings.upstream_max_keepalive_connections)),
+            keepalive_expiry=max(1, int(settings.upstream_keepalive_expiry_seconds)),
+        )
+        timeout = httpx.Timeout(60.0, connect=max(1, int(settings.upstream_connect_timeout_seconds)))
+        transport = httpx.AsyncHTTPTransport(http2=http2, limits=limits, proxy=proxy_url)
+        # Mounted rather than passed as `transport`, so direct mode still honours proxy env vars.
+        client = httpx.AsyncClient(
+            timeout=timeout,
+            proxy=proxy_url,
+            mounts={"all://": _TrackedTransport(transport, stats)},
+        )
+        cls._stats[proxy_url] = stats
+        return client
+
+    @classmethod
+    def get(cls, proxy_url: str | None = None) -> httpx.AsyncClient:
+        cfg = runtime_config()
+        if cfg is not cls._config:
+            cls._config = cfg
+            cls._retire(set(cfg.proxies) if cfg.proxy_pool_enabled else set())
+        client = cls._clients.get(proxy_url)
+        if client is None or client.is_closed:
+            client = cls._build_client(proxy_url)
+            cls._clients[proxy_url] = client
+        return client
+
+    @classmethod
+    def _retire(cls, proxy_urls: set[str]) -> None:
+        """Drop clients of proxies no longer configured; close them once their requests are done."""
+        stale = [url for url in cls._clients if url is not None and url not in proxy_urls]
+        if not stale:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        for url in stale:
+            client = cls._clients.pop(url)
+            cls._stats.pop(url, None)
+            if loop is not None:
+                loop.create_task(cls._close_later(client))
+        log.info("Retired %s upstream client(s) for removed proxies", len(stale))
+
+    @staticmethod
+    async def _close_later(client: httpx.AsyncClient) -> None:
+        # A retired client may still carry a long stream; leases bound how long one can last.
+        await asyncio.sleep(max(60, int(settings.key_lease_ttl_seconds)))
+        try:
+            await client.aclose()
+        except Exception as exc:
+            log.warning("Failed to close upstream client: %s", exc)
+
+    @classmethod
+    def startup(cls, proxy_urls: list[str] | None = None) -> None:
+        cls.get(None)
+        for url in proxy_urls or []:
+            cls.get(url)
+
+    @classmethod
+    async def aclose_all(cls) -> None:
+        clients = list(cls._clients.values())
+        cls._clients.clear()
+        cls._stats.clear()
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as exc:
+                log.warning("Failed to close upstream client: %s", exc)
+
+    @classmethod
+    def snapshot(cls) -> list[dict]:
+        # Imported lazily to avoid a cycle (the proxy pool uses this registry for keepalive).
+        from app.services.upstream_proxy_pool import UpstreamProxyPool
+
+        items = []
+        for proxy_url, client in list(cls._clients.items()):
+            stats = cls._stats.get(proxy_url) or ClientStats()
+            items.append(
+                {
+                    "proxy": UpstreamProxyPool.mask_proxy_url(proxy_url) if proxy_url else DIRECT,
+                    "is_closed": client.is_closed,
+                    "requests": stats.requests,
+                    "in_flight": stats.in_flight,
+                    "age_seconds": int(time.time() - stats.created_at),
+                }
+            )
+        return items
@@ -5,8 +5,9 @@ import time
 from dataclasses import dataclass
 from typing import Optional
 
-from app.config import settings
-import httpx
+from app.services.runtime_config import RuntimeConfig, backoff, runtime_config
+from app.services.shared_state import publish_until
+from app.services.upstream_http import UpstreamHttpClients
 
 
 @dataclass
@@ -19,25 +20,28 @@ class ProxyState:
 
 class UpstreamProxyPool:
     """
-    Single-process upstream proxy pool for *availability*.
+    Upstream proxy pool for *availability*.
 
     Design goals:
     - Distribute traffic across a fixed set of outbound proxies owned/controlled by the operator.
     - Fail over quickly when a proxy appears unhealthy.
     - Avoid aggressive "IP rotation" behaviors; default strategy is sticky-by-user.
+
+    Cooldowns are per process; with a distributed shared state they are also published to and
+    pulled from the other nodes (services/shared_state.py). Settings come from the compiled
+    runtime config snapshot (services/runtime_config.py).
     """
 
     _states: list[ProxyState] | None = None
-    _raw: str | None = None
+    _proxies: tuple[str, ...] | None = None
 
     @classmethod
-    def _load_states(cls) -> list[ProxyState]:
-        raw = getattr(settings, "upstream_proxies", "") or ""
-        if cls._states is not None and cls._raw == raw:
+    def _load_states(cls, cfg: RuntimeConfig | None = None) -> list[ProxyState]:
+        proxies = (cfg or runtime_config()).proxies
+        if cls._states is not None and cls._proxies == proxies:
             return cls._states
-        proxies = [p.strip() for p in raw.split(",") if p.strip()]
         cls._states = [ProxyState(url=p) for p in proxies]
-        cls._raw = raw
+        cls._proxies = proxies
         return cls._states
 
     @staticmethod
@@ -46,9 +50,27 @@ class UpstreamProxyPool:
 
     @classmethod
     def enabled(cls) -> bool:
-        return bool(getattr(settings, "upstream_proxy_mode", "direct") == "proxy_pool") and bool(
-            getattr(settings, "upstream_proxies", "").strip()
-        )
+        return runtime_config().proxy_pool_enabled
+
+    @classmethod
+    def proxy_urls(cls) -> list[str]:
+        if not cls.enabled():
+            return []
+        return [s.url for s in cls._load_states()]
+
+    @staticmethod
+    def shared_name(url: str) -> str:
+        # Hashed: the URL may carry credentials.
+        return "proxy:" + hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+
+    @classmethod
+    def apply_remote_cooldowns(cls, markers: dict[str, float]) -> None:
+        if not cls.enabled():
+            return
+        for state in cls._load_states():
+            until = markers.get(cls.shared_name(state.url))
+            if until is not None and until > state.cooldown_until:
+                state.cooldown_until = until
 
     @staticmethod
     def mask_proxy_url(url: str) -> str:
@@ -78,22 +100,24 @@ class UpstreamProxyPool:
         ]
 
     @classmethod
-    def get_proxy_for_user(cls, user_id: int) -> Optional[str]:
-        if not cls.enabled():
+    def get_proxy_for_user(cls, user_id: int, exclude: set[str] | None = None) -> Optional[str]:
+        """`exclude`: proxies a failover already tried; ignored if it would leave none."""
+        cfg = runtime_config()
+        if not cfg.proxy_pool_enabled:
             return None
-        states = cls._load_states()
+        states = cls._load_states(cfg)
         if not states:
             return None
 
         now = cls._now()
         available = [s for s in states if s.cooldown_until <= now]
+        if exclude:
+            available = [s for s in available if s.url not in exclude] or available
         if not available:
             return None
 
-        strategy = getattr(settings, "upstream_proxy_strategy", "sticky")
-        if strategy == "sticky":
-            salt = getattr(settings, "upstream_proxy_sticky_salt", "")
-            digest = hashlib.sha256(f"{user_id}:{salt}".encode("utf-8")).digest()
+        if cfg.proxy_strategy == "sticky":
+            digest = hashlib.sha256(f"{user_id}:{cfg.proxy_sticky_salt}".encode("utf-8")).digest()
             idx = int.from_bytes(digest[:4], "big") % len(available)
             return available[idx].url
 
@@ -104,9 +128,10 @@ class UpstreamProxyPool:
 
     @classmethod
     def report_result(cls, proxy_url: str | None, status_code: int | None = None, error: str | None = None) -> None:
-        if not cls.enabled() or not proxy_url:
+        cfg = runtime_config()
+        if not cfg.proxy_pool_enabled or not proxy_url:
             return
-        states = cls._load_states()
+        states = cls._load_states(cfg)
         state = next((s for s in states if s.url == proxy_url), None)
         if not state:
             return
@@ -118,32 +143,31 @@ class UpstreamProxyPool:
             return
 
         # Decide whether to treat this signal as proxy failure.
-        if status_code == 429 and not settings.upstream_proxy_handle_429:
+        if status_code == 429 and not cfg.proxy_handle_429:
             return
-        if status_code is not None and status_code >= 500 and not settings.upstream_proxy_handle_5xx:
+        if status_code is not None and status_code >= 500 and not cfg.proxy_handle_5xx:
             return
-        if status_code is None and not settings.upstream_proxy_handle_network_errors:
+        if status_code is None and not cfg.proxy_handle_network_errors:
             return
 
         # Failures & upstream overload
-        state.fail_streak = min(state.fail_streak + 1, settings.upstream_proxy_fail_streak_cap)
+        state.fail_streak = min(state.fail_streak + 1, cfg.proxy_fail_streak_cap)
         state.last_error = error or (f"HTTP {status_code}" if status_code is not None else "unknown error")
 
-        if state.fail_streak < max(1, settings.upstream_proxy_failure_threshold):
+        if state.fail_streak < cfg.proxy_failure_threshold:
             return
 
         if status_code == 429:
-            base = settings.upstream_proxy_cooldown_429_seconds
+            kind = "429"
         elif status_code is not None and status_code >= 500:
-            base = settings.upstream_proxy_cooldown_5xx_seconds
+            kind = "5xx"
         elif status_code is None:
-            base = settings.upstream_proxy_cooldown_error_seconds
+            kind = "error"
         else:
-            base = settings.upstream_proxy_cooldown_seconds
-
-        max_cd = settings.upstream_proxy_max_cooldown_seconds
-        cooldown = min(base * (2 ** (state.fail_streak - 1)), max_cd)
+            kind = "other"
+        cooldown = backoff(cfg.proxy_backoff[kind], state.fail_streak)
         state.cooldown_until = max(state.cooldown_until, cls._now() + cooldown)
+        publish_until(cls.shared_name(state.url), state.cooldown_until)
 
     @classmethod
     async def keepalive_probe_once(cls, proxy_url: str) -> None:
@@ -151,11 +175,10 @@ class UpstreamProxyPool:
         Best-effort probe for availability: make a lightweight request through the proxy.
         This is for operator-controlled proxies to detect broken routes early.
         """
-        url = getattr(settings, "upstream_proxy_keepalive_url", "https://api.novelai.net/") or "https://api.novelai.net/"
-        timeout_s = float(getattr(settings, "upstream_proxy_keepalive_timeout_seconds", 8))
+        cfg = runtime_config()
         try:
-            async with httpx.AsyncClient(timeout=timeout_s, proxy=proxy_url) as client:
-                resp = await client.get(url)
+            client = UpstreamHttpClients.get(proxy_url)
+            resp = await client.get(cfg.proxy_keepalive_url, timeout=cfg.proxy_keepalive_timeout_seconds)
             cls.report_result(proxy_url, status_code=resp.status_code)
         except Exception as exc:
             cls.report_result(proxy_url, status_code=None, error=str(exc))
@@ -0,0 +1,290 @@
+"""
+Incremental usage rollups.
+
+Per-user / per-key / per-day statistics used to mean scanning `request_logs` (or reading the
+cumulative counters on `ApiKey`). A periodic job (`tasks/scheduler.usage_rollup_loop`, one node
+in multi-node mode) folds new log rows into `usage_rollups` at minute and day granularity and
+advances a watermark (`rollup_watermarks`, last folded `request_logs.id`) in the same commit,
+so every row is counted once. Dashboards read only the rollups: O(buckets) instead of O(rows).
+
+Rows are folded in id order, stopping at the first row younger than USAGE_ROLLUP_SETTLE_SECONDS,
+so rows still sitting in the write-behind log queue are not skipped. Latency percentiles come
+from a small fixed histogram per bucket (approximate, interpolated within the bucket).
+"""
+
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.models import RequestLog, RollupWatermark, UsageRollup
+from app.services.rate_limit import RETRY_LOG_ACTION
+
+log = logging.getLogger(__name__)
+
+WATERMARK_NAME = "request_logs"
+GRANULARITIES = ("minute", "day")
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 3000, 5000, 8000, 12000, 20000, 30000, 60000)
+
+BucketKey = tuple[str, datetime, int, int]
+
+
+def bucket_start(granularity: str, ts: datetime) -> datetime:
+    if granularity == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+def _parse_histogram(value: str | None) -> list[int]:
+    counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    if value:
+        for i, part in enumerate(value.split(",")[: len(counts)]):
+            counts[i] = int(part or 0)
+    return counts
+
+
+def _latency_bucket(latency_ms: float) -> int:
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if latency_ms <= bound:
+            return i
+    return len(LATENCY_BUCKETS_MS)
+
+
+def _percentile(counts: list[int], q: float) -> float | None:
+    total = sum(counts)
+    if not total:
+        return None
+    target = q * total
+    cumulative = 0
+    lower = 0.0
+    for i, count in enumerate(counts):
+        if i >= len(LATENCY_BUCKETS_MS):
+            return float(LATENCY_BUCKETS_MS[-1])
+        upper = float(LATENCY_BUCKETS_MS[i])
+        if count and cumulative + count >= target:
+            return round(lower + (upper - lower) * (target - cumulative) / count, 1)
+        cumulative += count
+        lower = upper
+    return float(LATENCY_BUCKETS_MS[-1])
+
+
+@dataclass
+class _Agg:
+    requests: int = 0
+    successes: int = 0
+    failures: int = 0
+    rejected: int = 0
+    retries: int = 0
+    latency_sum_ms: float = 0.0
+    latency_count: int = 0
+    pixel_steps: int = 0
+    histogram: list[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+
+    def add_log(self, row) -> None:
+        if row.action == RETRY_LOG_ACTION:
+            # A failed attempt that was retried on another key: key usage, not a user request.
+            self.retries += 1
+        else:
+            self.requests += 1
+            if row.status == "success":
+                self.successes += 1
+            elif row.status == "rejected":
+                self.rejected += 1
+            else:
+                self.failures += 1
+        if row.latency_ms is not None:
+            self.latency_sum_ms += float(row.latency_ms)
+            self.latency_count += 1
+            self.histogram[_latency_bucket(float(row.latency_ms))] += 1
+        if row.status == "success" and row.width and row.height and row.steps:
+            self.pixel_steps += int(row.width) * int(row.height) * int(row.steps) * int(row.samples or 1)
+
+    def add_rollup(self, row: UsageRollup) -> None:
+        self.requests += row.requests or 0
+        self.successes += row.successes or 0
+        self.failures += row.failures or 0
+        self.rejected += row.rejected or 0
+        self.retries += row.retries or 0
+        self.latency_sum_ms += row.latency_sum_ms or 0.0
+        self.latency_count += row.latency_count or 0
+        self.pixel_steps += row.pixel_steps or 0
+        for i, count in enumerate(_parse_histogram(row.latency_histogram)):
+            self.histogram[i] += count
+
+    def apply_to(self, row: UsageRollup) -> None:
+        row.requests = (row.requests or 0) + self.requests
+        row.successes = (row.successes or 0) + self.successes
+        row.failures = (row.failures or 0) + self.failures
+        row.rejected = (row.rejected or 0) + self.rejected
+        row.retries = (row.retries or 0) + self.retries
+        row.latency_sum_ms = (row.latency_sum_ms or 0.0) + self.latency_sum_ms
+        row.latency_count = (row.latency_count or 0) + self.latency_count
+        row.pixel_steps = (row.pixel_steps or 0) + self.pixel_steps
+        merged = _parse_histogram(row.latency_histogram)
+        for i, count in enumerate(self.histogram):
+            merged[i] += count
+        row.latency_histogram = ",".join(str(c) for c in merged)
+
+    def as_dict(self) -> dict:
+        finished = self.successes + self.failures
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "retries": self.retries,
+            "success_rate": round(self.successes / finished, 4) if finished else None,
+            "avg_latency_ms": round(self.latency_sum_ms / self.latency_count, 1) if self.latency_count else None,
+            "p50_latency_ms": _percentile(self.histogram, 0.5),
+            "p95_latency_ms": _percentile(self.histogram, 0.95),
+            "pixel_steps": self.pixel_steps,
+        }
+
+
+async def _get_watermark(db: AsyncSession) -> RollupWatermark:
+    result = await db.execute(select(RollupWatermark).where(RollupWatermark.name == WATERMARK_NAME))
+    watermark = result.scalar_one_or_none()
+    if watermark is None:
+        watermark = RollupWatermark(name=WATERMARK_NAME, last_id=0)
+        db.add(watermark)
+    return watermark
+
+
+async def fold_batch(db: AsyncSession) -> tuple[int, bool]:
+    """
+    Fold the next batch of settled log rows into the rollups and advance the watermark.
+    Returns (rows folded, whether more settled rows may be waiting).
+    """
+    batch_size = max(1, int(settings.usage_rollup_batch_size))
+    settle_before = datetime.utcnow() - timedelta(seconds=max(0, int(settings.usage_rollup_settle_seconds)))
+    watermark = await _get_watermark(db)
+    result = await db.execute(
+        select(
+            RequestLog.id,
+            RequestLog.user_id,
+            RequestLog.api_key_id,
+            RequestLog.action,
+            RequestLog.status,
+            RequestLog.latency_ms,
+            RequestLog.width,
+            RequestLog.height,
+            RequestLog.steps,
+            RequestLog.samples,
+            RequestLog.created_at,
+        )
+        .where(RequestLog.id > (watermark.last_id or 0))
+        .order_by(RequestLog.id)
+        .limit(batch_size)
+    )
+    rows = result.all()
+    settled = []
+    for row in rows:
+        if row.created_at is not None and row.created_at >= settle_before:
+            break
+        settled.append(row)
+    if not settled:
+        await db.rollback()
+        return 0, False
+
+    aggregates: dict[BucketKey, _Agg] = {}
+    for row in settled:
+        created_at = row.created_at or settle_before
+        for granularity in GRANULARITIES:
+            key = (granularity, bucket_start(granularity, created_at), row.user_id, row.api_key_id or 0)
+            agg = aggregates.get(key)
+            if agg is None:
+                agg = aggregates[key] = _Agg()
+            agg.add_log(row)
+
+    for granularity in GRANULARITIES:
+        keys = [k for k in aggregates if k[0] == granularity]
+        starts = {k[1] for k in keys}
+        existing = await db.execute(
+            select(UsageRollup).where(
+                UsageRollup.granularity == granularity,
+                UsageRollup.bucket_start >= min(starts),
+                UsageRollup.bucket_start <= max(starts),
+                UsageRollup.user_id.in_({k[2] for k in keys}),
+            )
+        )
+        by_key = {(r.granularity, r.bucket_start, r.user_id, r.api_key_id): r for r in existing.scalars().all()}
+        for key in keys:
+            row = by_key.get(key)
+            if row is None:
+                row = UsageRollup(granularity=key[0], bucket_start=key[1], user_id=key[2], api_key_id=key[3])
+                db.add(row)
+            aggregates[key].apply_to(row)
+
+    watermark.last_id = settled[-1].id
+    await db.commit()
+    return len(settled), len(settled) == batch_size
+
+
+async def fold_new_logs(db: AsyncSession) -> int:
+    """Fold everything settled (bounded per run); returns the number of log rows folded."""
+    total = 0
+    for _ in range(max(1, int(settings.usage_rollup_max_batches))):
+        folded, more = await fold_batch(db)
+        total += folded
+        if not more:
+            break
+    return total
+
+
+async def prune_minute_rollups(db: AsyncSession) -> int:
+    hours = int(settings.usage_rollup_minute_retention_hours)
+    if hours <= 0:
+        return 0
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    result = await db.execute(
+        delete(UsageRollup).where(UsageRollup.granularity == "minute", UsageRollup.bucket_start < cutoff)
+    )
+    await db.commit()
+    return result.rowcount or 0
+
+
+def usage_since(granularity: str, days: int, hours: int) -> datetime:
+    """Start of the requested window; minute buckets are only kept for a short time anyway."""
+    if granularity not in GRANULARITIES:
+        raise ValueError("granularity must be minute or day")
+    if granularity == "minute":
+        return bucket_start("minute", datetime.utcnow() - timedelta(hours=min(max(1, hours), 48)))
+    return bucket_start("day", datetime.utcnow() - timedelta(days=min(max(1, days), 400) - 1))
+
+
+async def query_usage(
+    db: AsyncSession,
+    granularity: str,
+    since: datetime,
+    group_by: str = "bucket",
+    user_id: int | None = None,
+    api_key_id: int | None = None,
+) -> list[dict]:
+    """Read aggregates from the rollups only, grouped by `bucket`, `user` or `key`."""
+    stmt = select(UsageRollup).where(UsageRollup.granularity == granularity, UsageRollup.bucket_start >= since)
+    if user_id is not None:
+        stmt = stmt.where(UsageRollup.user_id == user_id)
+    if api_key_id is not None:
+        stmt = stmt.where(UsageRollup.api_key_id == api_key_id)
+    result = await db.execute(stmt)
+
+    groups: dict = {}
+    for row in result.scalars().all():
+        if group_by == "user":
+            group = row.user_id
+        elif group_by == "key":
+            group = row.api_key_id
+        else:
+            group = row.bucket_start
+        agg = groups.get(group)
+        if agg is None:
+            agg = groups[group] = _Agg()
+        agg.add_rollup(row)
+
+    name = {"user": "user_id", "key": "api_key_id"}.get(group_by, "bucket_start")
+    return [{name: group, **agg.as_dict()} for group, agg in sorted(groups.items(), key=lambda item: item[0])]
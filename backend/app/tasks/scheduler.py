@@ -1,7 +1,8 @@
 """
 Background loops scheduler.
 
-This module owns the lifecycle of long-running background tasks (health checks, proxy keepalive).
+This module owns the lifecycle of long-running background tasks (health checks, proxy keepalive,
+key scheduler resync, log retention, usage rollups, shared state sync, SystemConfig watch).
 It supports toggling tasks on/off at runtime (reconcile) and multi-node leader-only gating.
 """
 
@@ -10,7 +11,15 @@ import logging
 
 from app.config import settings
 from app.database import AsyncSessionLocal
-from app.services.health_check import check_all_keys
+from app.services.health_check import check_due_keys
+from app.services.key_pool import apply_remote_key_cooldowns
+from app.services.key_scheduler import key_scheduler
+from app.services.key_usage import key_usage
+from app.services.log_retention import prune_logs
+from app.services.rate_limit import quota_cache
+from app.services.shared_state import get_shared_state, sync_until_markers
+from app.services.system_config import system_config_watcher
+from app.services.usage_rollup import fold_new_logs, prune_minute_rollups
 from app.services.upstream_proxy_pool import UpstreamProxyPool
 
 log = logging.getLogger(__name__)
@@ -53,21 +62,71 @@ def _should_run_upstream_proxy_keepalive() -> bool:
     return True
 
 
+def _should_run_log_retention() -> bool:
+    if not settings.log_retention_enabled:
+        return False
+    # Deletes are global, so a single node runs them in multi-node mode.
+    if settings.multi_node_enabled and settings.node_id != settings.log_retention_leader_node_id:
+        log.info(
+            "Skip log retention on node %s (leader=%s)",
+            settings.node_id,
+            settings.log_retention_leader_node_id,
+        )
+        return False
+    return True
+
+
+def _should_run_usage_rollup() -> bool:
+    if not settings.usage_rollup_enabled:
+        return False
+    # The watermark is shared, so a single node folds logs in multi-node mode.
+    if settings.multi_node_enabled and settings.node_id != settings.usage_rollup_leader_node_id:
+        log.info(
+            "Skip usage rollup on node %s (leader=%s)",
+            settings.node_id,
+            settings.usage_rollup_leader_node_id,
+        )
+        return False
+    return True
+
+
+def _should_watch_system_config() -> bool:
+    return bool(settings.multi_node_enabled and settings.system_config_refresh_enabled)
+
+
 async def health_check_loop() -> None:
     if not _should_run_health_check():
         return
+    # Ticks check only due keys (see services/health_schedule.py), spreading the work.
     while True:
         try:
             async with AsyncSessionLocal() as db:
-                total = await check_all_keys(db)
-                log.info("Health check completed for %s keys", total)
+                checked, total = await check_due_keys(db)
+                if checked:
+                    log.info("Health check completed for %s/%s keys", checked, total)
         except Exception as exc:
             log.warning("Health check failed: %s", exc)
         try:
-            await asyncio.sleep(settings.health_check_interval_seconds)
+            await asyncio.sleep(max(1, settings.health_check_tick_seconds))
         except asyncio.CancelledError:
             return
 
+async def key_scheduler_resync_loop() -> None:
+    # Picks up changes made by other nodes (or directly in the DB).
+    while settings.key_scheduler_resync_seconds > 0:
+        try:
+            await asyncio.sleep(settings.key_scheduler_resync_seconds)
+        except asyncio.CancelledError:
+            return
+        try:
+            # Flush write-behind usage first; results recorded meanwhile stay local.
+            await key_usage.flush()
+            async with AsyncSessionLocal() as db:
+                await key_scheduler.load(db, unsaved=key_usage.unsaved_key_ids)
+        except Exception as exc:
+            log.warning("Key scheduler resync failed: %s", exc)
+
+
 async def upstream_proxy_keepalive_loop() -> None:
     if not _should_run_upstream_proxy_keepalive():
         return
@@ -82,10 +141,93 @@ async def upstream_proxy_keepalive_loop() -> None:
             return
 
 
+async def log_retention_loop() -> None:
+    if not _should_run_log_retention():
+        return
+    # First run after one interval: nothing is urgent at startup.
+    while True:
+        try:
+            await asyncio.sleep(max(60, settings.log_retention_interval_seconds))
+        except asyncio.CancelledError:
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                progress = await prune_logs(db)
+            if progress.request_logs_deleted or progress.auth_attempts_deleted or progress.partitions_dropped:
+                log.info(
+                    "Log retention: deleted %s request logs, %s auth attempts, dropped %s partitions",
+                    progress.request_logs_deleted,
+                    progress.auth_attempts_deleted,
+                    progress.partitions_dropped,
+                )
+        except Exception as exc:
+            log.warning("Log retention failed: %s", exc)
+
+
+async def usage_rollup_loop() -> None:
+    if not _should_run_usage_rollup():
+        return
+    while True:
+        try:
+            await asyncio.sleep(max(5, settings.usage_rollup_interval_seconds))
+        except asyncio.CancelledError:
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                await fold_new_logs(db)
+                await prune_minute_rollups(db)
+        except Exception as exc:
+            log.warning("Usage rollup failed: %s", exc)
+
+
+async def shared_state_sync_loop() -> None:
+    # Pushes this node's proxy / key cooldowns and applies the ones other nodes published.
+    last_purge = 0.0
+    while get_shared_state().distributed:
+        try:
+            await asyncio.sleep(max(100, settings.shared_state_sync_interval_ms) / 1000)
+        except asyncio.CancelledError:
+            return
+        try:
+            markers = await sync_until_markers()
+            UpstreamProxyPool.apply_remote_cooldowns(markers)
+            apply_remote_key_cooldowns(markers)
+            now = asyncio.get_running_loop().time()
+            if now - last_purge >= 300:
+                last_purge = now
+                await get_shared_state().purge_expired()
+        except Exception as exc:
+            log.warning("Shared state sync failed: %s", exc)
+
+
+async def system_config_watch_loop() -> None:
+    # Applies SystemConfig changes made on other nodes, off the request path.
+    while _should_watch_system_config():
+        await system_config_watcher.ensure_listening()
+        try:
+            await system_config_watcher.wait(max(1, settings.system_config_refresh_interval_seconds))
+        except asyncio.CancelledError:
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                changed = await system_config_watcher.apply_changes(db)
+            if changed:
+                log.info("SystemConfig changed: %s", ", ".join(changed))
+                quota_cache.clear()
+                reconcile_background_tasks(asyncio.get_running_loop())
+        except Exception as exc:
+            log.warning("SystemConfig watch failed: %s", exc)
+
+
 def reconcile_background_tasks(loop: asyncio.AbstractEventLoop) -> None:
     desired = {
         "health_check": _should_run_health_check(),
         "upstream_proxy_keepalive": _should_run_upstream_proxy_keepalive(),
+        "key_scheduler_resync": settings.key_scheduler_resync_seconds > 0,
+        "log_retention": _should_run_log_retention(),
+        "usage_rollup": _should_run_usage_rollup(),
+        "shared_state_sync": get_shared_state().distributed,
+        "system_config_watch": _should_watch_system_config(),
     }
 
     for name, should_run in desired.items():
@@ -96,6 +238,16 @@ def reconcile_background_tasks(loop: asyncio.AbstractEventLoop) -> None:
                 _TASKS[name] = loop.create_task(health_check_loop())
             elif name == "upstream_proxy_keepalive":
                 _TASKS[name] = loop.create_task(upstream_proxy_keepalive_loop())
+            elif name == "key_scheduler_resync":
+                _TASKS[name] = loop.create_task(key_scheduler_resync_loop())
+            elif name == "log_retention":
+                _TASKS[name] = loop.create_task(log_retention_loop())
+            elif name == "usage_rollup":
+                _TASKS[name] = loop.create_task(usage_rollup_loop())
+            elif name == "shared_state_sync":
+                _TASKS[name] = loop.create_task(shared_state_sync_loop())
+            elif name == "system_config_watch":
+                _TASKS[name] = loop.create_task(system_config_watch_loop())
         if not should_run and task_alive:
             task.cancel()
             _TASKS.pop(name, None)
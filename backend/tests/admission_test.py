@@ -0,0 +1,162 @@
+import asyncio
+import base64
+import os
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_admission_memdb?mode=memory&cache=shared&uri=true"
+    os.environ.setdefault("ADMIN_PASSWORD", "admin123")
+
+
+def run():
+    _set_env()
+    from app.config import settings
+    from app.models import ApiKey
+    from app.services.admission import AdmissionQueue, AdmissionRejected
+    from app.services.crypto import encrypt_text
+    from app.services.key_scheduler import key_scheduler
+
+    settings.key_cooldown_seconds = 0
+    settings.key_max_concurrency = 1
+    settings.require_opus_tier = True
+    settings.admission_max_wait_ms = 2000
+    settings.admission_queue_max_size = 200
+    settings.admission_queue_per_user_max = 4
+
+    def add_key(key_id):
+        key_scheduler.upsert(
+            ApiKey(
+                id=key_id,
+                user_id=1,
+                key_encrypted=encrypt_text(f"key-{key_id}"),
+                status="healthy",
+                tier=3,
+                is_enabled=True,
+                fail_streak=0,
+            )
+        )
+
+    async def settle():
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    async def fair_order():
+        # One key, held: waiters are served by finish tag, max(virtual time, user's last) + 1/weight.
+        queue = AdmissionQueue()
+        key_scheduler.on_available = queue.notify
+        held = await queue.acquire(1)
+        served = []
+
+        async def wait(user_id, weight):
+            selected = await queue.acquire(user_id, weight=weight)
+            served.append(user_id)
+            await asyncio.sleep(0)
+            key_scheduler.release(selected[0])
+
+        tasks = []
+        for user_id, weight in [(10, 1), (10, 1), (10, 1), (20, 2), (20, 2), (20, 2)]:
+            tasks.append(asyncio.create_task(wait(user_id, weight)))
+            await settle()
+        assert queue.depth == 6, queue.depth
+        key_scheduler.release(held[0])
+        await asyncio.gather(*tasks)
+        # Tags: user 10 -> 1, 2, 3; user 20 (weight 2) -> 0.5, 1, 1.5; ties go to the earlier waiter.
+        assert served == [20, 10, 20, 20, 10, 10], served
+        assert queue.depth == 0 and queue.admitted_queued == 6
+
+    async def limits():
+        settings.admission_queue_per_user_max = 2
+        settings.admission_queue_max_size = 3
+        queue = AdmissionQueue()
+        key_scheduler.on_available = queue.notify
+        held = await queue.acquire(1)
+        tasks = [asyncio.create_task(queue.acquire(10)) for _ in range(2)]
+        await settle()
+        try:
+            await queue.acquire(10)
+            raise AssertionError("per-user limit not enforced")
+        except AdmissionRejected as exc:
+            assert exc.status_code == 429
+        tasks.append(asyncio.create_task(queue.acquire(20)))
+        await settle()
+        try:
+            await queue.acquire(30)
+            raise AssertionError("queue size limit not enforced")
+        except AdmissionRejected as exc:
+            assert exc.status_code == 503
+        assert queue.rejected_user == 1 and queue.rejected_full == 1
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert queue.depth == 0 and queue.stats()["users_waiting"] == 0
+        key_scheduler.release(held[0])
+        settings.admission_queue_per_user_max = 4
+        settings.admission_queue_max_size = 200
+
+    async def timeout_and_cancel():
+        queue = AdmissionQueue()
+        key_scheduler.on_available = queue.notify
+        held = await queue.acquire(1)
+
+        # ADMISSION_MAX_WAIT_MS: the waiter gives up with None and leaves the queue.
+        settings.admission_max_wait_ms = 50
+        assert await queue.acquire(10) is None
+        assert queue.timeouts == 1 and queue.depth == 0
+        settings.admission_max_wait_ms = 2000
+
+        # A cancelled waiter (client gone) leaves the queue and never keeps a key.
+        waiter = asyncio.create_task(queue.acquire(10))
+        await settle()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert queue.depth == 0 and queue.stats()["users_waiting"] == 0
+
+        # Cancelled right after the key was handed over: the key goes back to the pool.
+        waiter = asyncio.create_task(queue.acquire(10))
+        await settle()
+        key_scheduler.release(held[0])
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert key_scheduler.in_flight(1) == 0, key_scheduler.in_flight(1)
+        assert queue.depth == 0
+        again = await queue.acquire(10)
+        assert again is not None and again[0].key_id == 1
+        key_scheduler.release(again[0])
+
+    async def excluded_keys():
+        # A retry excluding the only free key is passed over but keeps its place.
+        add_key(2)
+        queue = AdmissionQueue()
+        key_scheduler.on_available = queue.notify
+        first = await queue.acquire(1)
+        second = await queue.acquire(1)
+        retry = asyncio.create_task(queue.acquire(10, exclude=[first[0].key_id]))
+        await settle()
+        other = asyncio.create_task(queue.acquire(20))
+        await settle()
+        key_scheduler.release(first[0])
+        got = await other
+        assert got[0].key_id == first[0].key_id and not retry.done()
+        key_scheduler.release(second[0])
+        got_retry = await retry
+        assert got_retry[0].key_id == second[0].key_id
+        key_scheduler.release(got[0])
+        key_scheduler.release(got_retry[0])
+
+    add_key(1)
+    asyncio.run(fair_order())
+    asyncio.run(limits())
+    asyncio.run(timeout_and_cancel())
+    asyncio.run(excluded_keys())
+    key_scheduler.on_available = None
+
+    print("Admission test passed.")
+
+
+if __name__ == "__main__":
+    run()
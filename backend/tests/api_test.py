@@ -94,6 +94,30 @@ def run():
 
         resp = client.post("/v1/novelai/generate-image", headers=user_headers, json={})
         assert resp.status_code == 429, resp.text
+        resp = client.post("/v1/novelai/generate-image", headers=user_headers, json={})
+        assert resp.status_code == 429, resp.text
+
+        # Request logs: filters + keyset pagination
+        params = {"username": "user1", "status": "rejected", "limit": 1}
+        resp = client.get("/admin/logs", headers=admin_headers, params=params)
+        assert resp.status_code == 200, resp.text
+        first = resp.json()
+        assert len(first) == 1 and first[0]["status_code"] == 429, resp.text
+        cursor = resp.headers.get("X-Next-Cursor")
+        assert cursor, resp.headers
+        resp = client.get("/admin/logs", headers=admin_headers, params={**params, "cursor": cursor})
+        assert resp.status_code == 200, resp.text
+        assert resp.json()[0]["id"] < first[0]["id"], resp.text
+        resp = client.get("/admin/logs/export", headers=admin_headers, params={"username": "nobody", "format": "csv"})
+        assert resp.status_code == 200 and resp.text.count("\n") == 1, resp.text
+
+        resp = client.get("/admin/upstream-clients", headers=admin_headers)
+        assert resp.status_code == 200, resp.text
+        assert any(item["proxy"] == "direct" for item in resp.json()["items"]), resp.text
+
+        resp = client.get("/admin/caches", headers=admin_headers)
+        assert resp.status_code == 200, resp.text
+        assert "decrypted_keys" in resp.json(), resp.text
 
         # Admin config read/update
         resp = client.get("/admin/config", headers=admin_headers)
@@ -106,12 +130,42 @@ def run():
         )
         assert resp.status_code == 200, resp.text
 
+        # Another node's watcher picks up only the changed key, once.
+        from app.config import settings
+        from app.database import AsyncSessionLocal
+        from app.services.system_config import SystemConfigWatcher
+
+        async def apply_changes(watcher):
+            async with AsyncSessionLocal() as db:
+                return await watcher.apply_changes(db)
+
+        other_node = SystemConfigWatcher()
+        settings.base_rpm = 1
+        assert client.portal.call(apply_changes, other_node) == ["base_rpm"]
+        assert settings.base_rpm == 2 and other_node.version > 0
+        assert client.portal.call(apply_changes, other_node) == []
+
+        # Invalid values are rejected before they are stored; valid ones swap the runtime snapshot.
+        resp = client.post("/admin/config", headers=admin_headers, json={"key": "opus_max_steps", "value": "-1"})
+        assert resp.status_code == 400, resp.text
+        resp = client.post("/admin/config", headers=admin_headers, json={"key": "opus_max_steps", "value": "x"})
+        assert resp.status_code == 400, resp.text
+        from app.services.runtime_config import runtime_config
+
+        before = runtime_config()
+        resp = client.post(
+            "/admin/config", headers=admin_headers, json={"key": "novelai_models", "value": "m-a, m-b"}
+        )
+        assert resp.status_code == 200, resp.text
+        assert runtime_config().model_set == {"m-a", "m-b"} and before.model_set != {"m-a", "m-b"}
+
         # Generate a client API key and call models with it (no JWT)
         resp = client.post("/client-keys", headers=user_headers, json={"name": "cli", "rotate": True})
         assert resp.status_code == 200, resp.text
         api_key = resp.json()["api_key"]
         resp = client.get("/v1/novelai/models", headers={"Authorization": f"Bearer {api_key}"})
         assert resp.status_code == 200, resp.text
+        assert resp.json()["models"] == ["m-a", "m-b"], resp.text
 
         # Disable then re-enable client key
         keys = client.get("/client-keys", headers=user_headers).json()
@@ -143,6 +197,35 @@ def run():
         resp = client.get("/v1/novelai/models", headers={"Authorization": f"Bearer {api_key}"})
         assert resp.status_code == 401, resp.text
 
+        # The proxy caches authenticated callers; key rotation and user changes drop them at once.
+        from app.services.auth_cache import auth_cache
+
+        def proxy_status(token):
+            return client.get("/v1/novelai/models", headers={"Authorization": f"Bearer {token}"}).status_code
+
+        def cached(token):
+            hits = auth_cache.hits
+            assert proxy_status(token) == 200
+            return auth_cache.hits > hits
+
+        old_key = client.post("/client-keys", headers=user_headers, json={"name": "old"}).json()["api_key"]
+        proxy_status(old_key)
+        assert cached(old_key)
+        resp = client.post("/client-keys", headers=user_headers, json={"name": "new", "rotate": True})
+        assert resp.status_code == 200, resp.text
+        new_key = resp.json()["api_key"]
+        assert proxy_status(old_key) == 401
+        proxy_status(new_key)
+        proxy_status(user_token)
+        assert cached(new_key) and cached(user_token)
+
+        resp = client.patch(f"/admin/users/{user_row['id']}", headers=admin_headers, json={"is_active": False})
+        assert resp.status_code == 200, resp.text
+        assert proxy_status(new_key) == 403 and proxy_status(user_token) == 403
+        resp = client.patch(f"/admin/users/{user_row['id']}", headers=admin_headers, json={"is_active": True})
+        assert resp.status_code == 200, resp.text
+        assert proxy_status(new_key) == 200 and proxy_status(user_token) == 200
+
     print("API test passed.")
 
 
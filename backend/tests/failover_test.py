@@ -0,0 +1,131 @@
+import base64
+import os
+
+import httpx
+from fastapi.testclient import TestClient
+
+PROXIES = ["http://proxy-a:8080", "http://proxy-b:8080", "http://proxy-c:8080"]
+PAYLOAD = {"input": "x", "model": "nai-diffusion-4-5-full", "width": 512, "height": 512, "steps": 20, "n_samples": 1}
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.update(
+        ENVIRONMENT="test",
+        SECRET_KEY="test-secret",
+        ENCRYPTION_KEY=key,
+        DATABASE_URL="sqlite+aiosqlite:///file:novelai_failover_memdb?mode=memory&cache=shared&uri=true",
+        ALLOW_REGISTRATION="true",
+        BASE_RPM="0",
+        PER_KEY_RPM="100",
+        MAX_RPM="1000",
+        HEALTH_CHECK_ENABLED="false",
+        HEALTH_CHECK_FAIL_THRESHOLD="100",
+        KEY_COOLDOWN_SECONDS="0",
+        DYNAMIC_COOLDOWN_ENABLED="false",
+        ADMISSION_MAX_WAIT_MS="200",
+        UPSTREAM_PROXY_MODE="proxy_pool",
+        UPSTREAM_PROXIES=",".join(PROXIES),
+        UPSTREAM_PROXY_FAILURE_THRESHOLD="100",
+        UPSTREAM_RETRY_MAX_ATTEMPTS="3",
+        UPSTREAM_STREAMING_ENABLED="false",
+    )
+
+
+def run():
+    _set_env()
+    from sqlalchemy import select
+
+    from app.config import settings
+    from app.database import AsyncSessionLocal
+    from app.main import app
+    from app.models import RequestLog
+    from app.services.log_writer import request_log_writer
+    from app.services.rate_limit import RETRY_LOG_ACTION
+    from app.services.upstream_http import UpstreamHttpClients
+
+    # Upstream replies for generate-image calls, in order; each call records (key, proxy).
+    script: list = []
+    calls: list[tuple[str, str | None]] = []
+
+    def mock_client(proxy_url):
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path == "/user/subscription":
+                return httpx.Response(200, json={"tier": 3})
+            calls.append((request.headers["authorization"], proxy_url))
+            reply = script.pop(0) if script else 200
+            if reply == "network":
+                raise httpx.ConnectError("connection refused", request=request)
+            if reply == 200:
+                return httpx.Response(200, content=b"PK\x03\x04", headers={"content-type": "application/zip"})
+            return httpx.Response(reply, json={"message": f"upstream {reply}"})
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    UpstreamHttpClients._build_client = classmethod(lambda cls, proxy_url: mock_client(proxy_url))
+
+    async def logs_since(last_id):
+        await request_log_writer.flush()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(RequestLog).where(RequestLog.id > last_id).order_by(RequestLog.id))
+            return [(row.id, row.action, row.status_code) for row in result.scalars().all()]
+
+    with TestClient(app) as client:
+        client.post("/auth/register", json={"username": "failover", "password": "pass1234"})
+        resp = client.post("/auth/login", json={"username": "failover", "password": "pass1234"})
+        headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+        for i in range(4):
+            resp = client.post("/keys", headers=headers, json={"api_key": f"key-{i}", "verify_now": True})
+            assert resp.status_code == 200, resp.text
+        last_id = max([0] + [row[0] for row in client.portal.call(logs_since, 0)])
+
+        def generate(replies):
+            nonlocal last_id
+            script[:] = replies
+            calls.clear()
+            resp = client.post("/v1/novelai/generate-image", headers=headers, json=PAYLOAD)
+            logs = client.portal.call(logs_since, last_id)
+            last_id = logs[-1][0] if logs else last_id
+            return resp, list(calls), [(action, status) for _, action, status in logs]
+
+        # Transient failures move to another key and another proxy; only the last attempt counts.
+        resp, tried, logs = generate([429, 500])
+        assert resp.status_code == 200, resp.text
+        assert len(tried) == 3, tried
+        assert len({key for key, _ in tried}) == 3, tried
+        assert len({proxy for _, proxy in tried}) == 3, tried
+        assert logs == [(RETRY_LOG_ACTION, 429), (RETRY_LOG_ACTION, 500), ("generate-image", 200)], logs
+
+        resp, tried, logs = generate(["network", 200])
+        assert resp.status_code == 200 and len(tried) == 2, tried
+        assert tried[0][0] != tried[1][0] and tried[0][1] != tried[1][1], tried
+        assert logs[0][0] == RETRY_LOG_ACTION and logs[1] == ("generate-image", 200), logs
+
+        # The attempt limit (UPSTREAM_RETRY_MAX_ATTEMPTS) ends the loop with the last failure.
+        resp, tried, logs = generate([409, 503, 502, 200])
+        assert resp.status_code == 502, resp.text
+        assert len(tried) == 3, tried
+        assert [action for action, _ in logs] == [RETRY_LOG_ACTION, RETRY_LOG_ACTION, "generate-image"], logs
+
+        # Client errors are never retried: another key would fail the same way.
+        for status in (400, 402, 403, 401):
+            resp, tried, logs = generate([status])
+            assert resp.status_code == status, (status, resp.text)
+            assert len(tried) == 1, (status, tried)
+            assert logs == [("generate-image", status)], (status, logs)
+
+        # Server-Timing reports measured stages only: nothing is sent while stage timing is off.
+        assert "Server-Timing" in generate([200])[0].headers
+        settings.stage_timing_enabled = False
+        try:
+            for replies in ([200], [400]):
+                resp, _, _ = generate(replies)
+                assert "Server-Timing" not in resp.headers, resp.headers
+        finally:
+            settings.stage_timing_enabled = True
+
+    print("Failover test passed.")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,163 @@
+import asyncio
+import base64
+import os
+import time
+from datetime import datetime, timedelta
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_sched_memdb?mode=memory&cache=shared&uri=true"
+    os.environ.setdefault("ADMIN_PASSWORD", "admin123")
+
+
+def run():
+    _set_env()
+    from app.config import settings
+    from app.models import ApiKey
+    from app.services.key_scheduler import KeyScheduler
+
+    settings.key_cooldown_seconds = 3
+    settings.require_opus_tier = True
+    now = datetime.utcnow()
+
+    def make_key(key_id, **kwargs):
+        fields = dict(
+            id=key_id,
+            user_id=1,
+            key_encrypted=f"enc-{key_id}",
+            status="healthy",
+            tier=3,
+            is_enabled=True,
+            fail_streak=0,
+            last_used_at=None,
+            cooldown_until=None,
+        )
+        fields.update(kwargs)
+        return ApiKey(**fields)
+
+    scheduler = KeyScheduler()
+    scheduler.upsert_many(
+        [
+            make_key(1, last_used_at=now - timedelta(seconds=10)),
+            make_key(2),
+            make_key(3, cooldown_until=now + timedelta(seconds=60)),
+            make_key(4, tier=1),
+            make_key(5, status="invalid"),
+        ]
+    )
+
+    # Never-used key first, then the least recently used one.
+    first = scheduler.acquire(now)
+    assert first and first.key_id == 2, first
+    second = scheduler.acquire(now)
+    assert second and second.key_id == 1, second
+    # Leased keys are not handed out twice; cooling / non-Opus / invalid keys are skipped.
+    assert scheduler.acquire(now) is None
+
+    # Release applies the cooldown from last_used_at.
+    scheduler.release(first, make_key(2, last_used_at=now))
+    assert scheduler.acquire(now) is None
+    again = scheduler.acquire(now + timedelta(seconds=4))
+    assert again and again.key_id == 2, again
+
+    # Releasing with a stale lease is a no-op.
+    scheduler.release(first)
+    assert scheduler.acquire(now + timedelta(seconds=4)) is None
+
+    # Disabled keys drop out; re-enabling brings them back.
+    scheduler.release(again)
+    scheduler.upsert(make_key(2, is_enabled=False))
+    assert scheduler.acquire(now + timedelta(seconds=4)) is None
+    scheduler.upsert(make_key(2))
+    assert scheduler.acquire(now + timedelta(seconds=4)).key_id == 2
+
+    settings.require_opus_tier = False
+    scheduler.remove(2)
+    assert scheduler.acquire(now).key_id == 4
+
+    # Per-key concurrency: a key is handed out up to key_max_concurrency times at once.
+    settings.key_cooldown_seconds = 0
+    settings.key_max_concurrency = 2
+    scheduler = KeyScheduler()
+    scheduler.upsert(make_key(7))
+    a, b = scheduler.acquire(now), scheduler.acquire(now)
+    assert a and b and a.key_id == b.key_id == 7 and a.token != b.token
+    assert scheduler.acquire(now) is None
+    assert scheduler.in_flight(7) == 2
+    scheduler.release(a)
+    scheduler.release(a)  # double release is a no-op
+    assert scheduler.in_flight(7) == 1
+    c = scheduler.acquire(now)
+    assert c and c.key_id == 7
+
+    # Leases that are never released are reclaimed after the TTL.
+    assert scheduler.reclaim_expired(time.monotonic() + settings.key_lease_ttl_seconds + 1) == 2
+    assert scheduler.in_flight(7) == 0
+    scheduler.release(b)
+    assert scheduler.in_flight(7) == 0
+    settings.key_max_concurrency = 1
+
+    # Held keys (busy / cooling on another node) are skipped; every ended lease is reported.
+    ended = []
+    scheduler = KeyScheduler()
+    scheduler.on_release = ended.append
+    scheduler.upsert(make_key(8))
+    scheduler.hold(8, now + timedelta(seconds=5))
+    assert scheduler.acquire(now) is None
+    lease = scheduler.acquire(now + timedelta(seconds=6))
+    assert lease and lease.key_id == 8
+    scheduler.release(lease)
+    scheduler.release(lease)
+    assert ended == [lease], ended
+
+    # Health results only update probe-owned fields: usage recorded after the row was read stays.
+    scheduler = KeyScheduler()
+    scheduler.upsert(make_key(9))
+    used = scheduler.acquire(now)
+    scheduler.release(used, make_key(9, last_used_at=now, cooldown_until=now + timedelta(seconds=30), fail_streak=2))
+    stale = make_key(9, status="unhealthy", tier=3, last_error="HTTP 500", fail_streak=1)
+    scheduler.apply_health([stale])
+    entry = scheduler.get(9)
+    assert entry.status == "unhealthy" and entry.last_error == "HTTP 500"
+    assert entry.fail_streak == 2 and entry.last_used_at == now, entry
+    assert entry.cooldown_until == now + timedelta(seconds=30), entry
+
+    # A resync does not roll back usage recorded after the flush (or held by an in-flight lease).
+    class _Rows:
+        def __init__(self, rows):
+            self.rows = rows
+
+        def scalars(self):
+            return self
+
+        def all(self):
+            return self.rows
+
+    class _Db:
+        def __init__(self, rows):
+            self.rows = rows
+
+        async def execute(self, _stmt):
+            return _Rows(self.rows)
+
+    scheduler = KeyScheduler()
+    scheduler.upsert_many([make_key(10), make_key(11)])
+    for key_id in (10, 11):
+        used = scheduler.acquire(now, exclude=[k for k in (10, 11) if k != key_id])
+        cooling = now + timedelta(seconds=30)
+        scheduler.release(used, make_key(key_id, last_used_at=now, cooldown_until=cooling, fail_streak=1))
+    stale = [make_key(10, tier=1), make_key(11)]
+    asyncio.run(scheduler.load(_Db(stale), unsaved=lambda: {10}))
+    assert scheduler.get(10).fail_streak == 1 and scheduler.get(10).cooldown_until == cooling
+    assert scheduler.get(10).tier == 1
+    assert scheduler.get(11).fail_streak == 0 and scheduler.get(11).cooldown_until is None
+
+    print("Key scheduler test passed.")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import os
+from datetime import datetime, timedelta
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_retention_memdb?mode=memory&cache=shared&uri=true"
+    os.environ.setdefault("ADMIN_PASSWORD", "admin123")
+
+
+def run():
+    _set_env()
+    from sqlalchemy import func, select
+
+    from app.config import settings
+    from app.database import AsyncSessionLocal, Base, engine
+    from app.models import AuthAttempt, RequestLog, User
+    from app.services.log_retention import get_retention_progress, prune_logs
+
+    settings.log_retention_days = 30
+    settings.auth_attempt_retention_days = 7
+    settings.log_retention_batch_size = 3
+    settings.log_retention_batch_pause_ms = 0
+    settings.log_retention_max_batches = 10
+
+    async def seed(db, logs_age_days, logs, attempts_age_days, attempts):
+        created = datetime.utcnow() - timedelta(days=logs_age_days)
+        db.add_all([RequestLog(user_id=1, created_at=created) for _ in range(logs)])
+        created = datetime.utcnow() - timedelta(days=attempts_age_days)
+        db.add_all([AuthAttempt(action="login", created_at=created) for _ in range(attempts)])
+        await db.commit()
+
+    async def counts(db):
+        logs = await db.execute(select(func.count(RequestLog.id)))
+        attempts = await db.execute(select(func.count(AuthAttempt.id)))
+        return logs.scalar(), attempts.scalar()
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSessionLocal() as db:
+            db.add(User(id=1, username="retention", hashed_password="x"))
+            await db.commit()
+
+            # More expired rows than one batch in both tables, plus rows inside each window.
+            await seed(db, 40, 7, 8, 6)
+            await seed(db, 29, 2, 6, 2)
+            progress = await prune_logs(db)
+            assert (progress.request_logs_deleted, progress.auth_attempts_deleted) == (7, 6), progress
+            # request_logs: 3 + 3 + 1 (a short batch ends the table); auth_attempts: 3 + 3 + 0.
+            assert progress.batches == 6 and not progress.batch_limit_hit, progress
+            assert await counts(db) == (2, 2)
+            assert get_retention_progress()["running"] is False and progress.error is None
+
+            # LOG_RETENTION_MAX_BATCHES is per table: request_logs stops after two batches and
+            # leaves the rest for the next run, auth_attempts still gets its own budget.
+            settings.log_retention_max_batches = 2
+            await seed(db, 40, 10, 8, 4)
+            progress = await prune_logs(db)
+            assert (progress.request_logs_deleted, progress.auth_attempts_deleted) == (6, 4), progress
+            assert progress.batches == 4 and progress.batch_limit_hit, progress
+            assert await counts(db) == (6, 2)
+
+            settings.log_retention_max_batches = 10
+            progress = await prune_logs(db)
+            assert (progress.request_logs_deleted, progress.auth_attempts_deleted) == (4, 0), progress
+            assert not progress.batch_limit_hit and await counts(db) == (2, 2)
+
+            # A retention of 0 days keeps that table forever.
+            settings.log_retention_days = 0
+            await seed(db, 400, 1, 8, 1)
+            progress = await prune_logs(db)
+            assert (progress.request_logs_deleted, progress.auth_attempts_deleted) == (0, 1), progress
+            assert await counts(db) == (3, 2)
+            settings.log_retention_days = 30
+
+    asyncio.run(scenario())
+    print("Log retention test passed.")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,127 @@
+import asyncio
+import base64
+import os
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_logwriter_memdb?mode=memory&cache=shared&uri=true"
+    os.environ.setdefault("ADMIN_PASSWORD", "admin123")
+
+
+def run():
+    _set_env()
+    from sqlalchemy import func, select
+
+    from app.config import settings
+    from app.database import AsyncSessionLocal, Base, engine
+    from app.models import RequestLog, User
+    from app.services.log_writer import RequestLogWriter
+
+    class SlowWriter(RequestLogWriter):
+        """Each batch write takes `delay` seconds; `gate` (when set) holds background writes back."""
+
+        def __init__(self, delay: float = 0.0) -> None:
+            super().__init__()
+            self.delay = delay
+            self.gate: asyncio.Event | None = None
+
+        async def _write(self, rows):
+            if self.gate is not None and asyncio.current_task() is self._task:
+                await self.gate.wait()
+            if rows and self.delay:
+                await asyncio.sleep(self.delay)
+            await super()._write(rows)
+
+    async def count_rows(action):
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(func.count(RequestLog.id)).where(RequestLog.action == action))
+            return result.scalar()
+
+    def entry(action, user_id=1):
+        return RequestLog(user_id=user_id, action=action, status="success", status_code=200)
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSessionLocal() as db:
+            db.add(User(id=1, username="writer", hashed_password="x"))
+            await db.commit()
+
+        settings.request_log_batch_size = 20
+        settings.request_log_flush_interval_ms = 10
+        settings.request_log_queue_max_size = 10000
+        settings.request_log_overflow_policy = "inline"
+
+        # Steady traffic (~200 rows/s, 20 ms per batch write): flush() waits only for the rows
+        # queued before it was called, and returns while newer rows keep arriving.
+        writer = SlowWriter(delay=0.02)
+        writer.start()
+        stop = asyncio.Event()
+
+        async def produce():
+            while not stop.is_set():
+                await writer.submit(entry("steady"))
+                await asyncio.sleep(0.005)
+
+        producer = asyncio.create_task(produce())
+        await asyncio.sleep(0.3)
+        before = writer.enqueued
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await writer.flush(timeout=5.0)
+        assert loop.time() - started < 1.0, loop.time() - started
+        assert await count_rows("steady") >= before
+        stop.set()
+        await producer
+        await writer.stop()
+        assert await count_rows("steady") == writer.enqueued == writer.written
+
+        # The wait is bounded: a writer stuck on the DB times out instead of hanging the listing.
+        writer = SlowWriter()
+        writer.gate = asyncio.Event()
+        writer.start()
+        await writer.submit(entry("stuck"))
+        assert await writer.flush(timeout=0.05) is False and writer.flush_timeouts == 1
+        writer.gate.set()
+        assert await writer.flush(timeout=1.0)
+        await writer.stop()
+
+        # Overflow policies with a full queue (the writer is held back, its first row in hand).
+        for policy, expect_dropped, expect_inline in (("drop_newest", 1, 0), ("drop_oldest", 1, 0), ("inline", 0, 1)):
+            settings.request_log_queue_max_size = 2
+            settings.request_log_batch_size = 1
+            settings.request_log_overflow_policy = policy
+            writer = SlowWriter()
+            writer.gate = asyncio.Event()
+            writer.start()
+            for _ in range(4):
+                await writer.submit(entry(f"overflow-{policy}"))
+                await asyncio.sleep(0)
+            assert (writer.dropped, writer.inline_writes) == (expect_dropped, expect_inline), (policy, writer.stats())
+            writer.gate.set()
+            # Shutdown drains everything still queued.
+            await writer.stop()
+            assert await count_rows(f"overflow-{policy}") == 4 - expect_dropped, policy
+        settings.request_log_queue_max_size = 10000
+        settings.request_log_batch_size = 20
+        settings.request_log_overflow_policy = "inline"
+
+        # A failed batch is counted, not retried, and does not stop the writer.
+        writer = RequestLogWriter()
+        writer.start()
+        await writer.submit(entry("bad", user_id=None))
+        assert await writer.flush(timeout=1.0)
+        await writer.submit(entry("good"))
+        await writer.stop()
+        assert writer.failed == 1 and writer.written == 1, writer.stats()
+
+    asyncio.run(scenario())
+    print("Log writer test passed.")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,151 @@
+"""
+Per-request overhead of the response-header middleware: the pure ASGI `ResponseHeadersMiddleware`
+vs. the former three `BaseHTTPMiddleware` classes (replicated below), on `/healthz` and on
+`/v1/novelai/generate-image` against a mocked upstream. Runs in-process (httpx ASGITransport),
+so the numbers are application overhead only.
+
+    cd backend && python tests/middleware_bench.py [requests per run]
+"""
+
+import asyncio
+import base64
+import os
+import sys
+import time
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_benchdb?mode=memory&cache=shared&uri=true"
+    os.environ["BASE_RPM"] = "1000000"
+    os.environ["BASE_RPM_CONTRIBUTOR_ONLY"] = "false"
+    os.environ["MAX_RPM"] = "0"
+    os.environ["KEY_COOLDOWN_SECONDS"] = "0"
+    os.environ["KEY_MAX_CONCURRENCY"] = "1000"
+    os.environ["HEALTH_CHECK_ENABLED"] = "false"
+    os.environ["LOG_RETENTION_ENABLED"] = "false"
+    os.environ["USAGE_ROLLUP_ENABLED"] = "false"
+    os.environ["STAGE_TIMING_ENABLED"] = "false"
+
+
+def _legacy_middleware():
+    from starlette.middleware import Middleware
+    from starlette.middleware.base import BaseHTTPMiddleware
+
+    from app.config import settings
+
+    class NodeIdHeaderMiddleware(BaseHTTPMiddleware):
+        async def dispatch(self, request, call_next):
+            response = await call_next(request)
+            if settings.node_id:
+                response.headers["X-NovelAIPool-Node"] = str(settings.node_id)
+            return response
+
+    class SecurityHeadersMiddleware(BaseHTTPMiddleware):
+        async def dispatch(self, request, call_next):
+            response = await call_next(request)
+            response.headers.setdefault("X-Content-Type-Options", "nosniff")
+            response.headers.setdefault("X-Frame-Options", "DENY")
+            response.headers.setdefault("Referrer-Policy", "no-referrer")
+            response.headers.setdefault(
+                "Content-Security-Policy",
+                "default-src 'self'; img-src 'self' data: blob:; "
+                "connect-src 'self'; script-src 'self'; style-src 'self' 'unsafe-inline';",
+            )
+            return response
+
+    class SystemConfigRefreshMiddleware(BaseHTTPMiddleware):
+        async def dispatch(self, request, call_next):
+            # Single node: the refresh branch is skipped, as in the benchmark of the new one.
+            return await call_next(request)
+
+    # Same order as the old add_middleware calls (outermost first).
+    return [
+        Middleware(SystemConfigRefreshMiddleware),
+        Middleware(SecurityHeadersMiddleware),
+        Middleware(NodeIdHeaderMiddleware),
+    ]
+
+
+def _use_stack(app, legacy: bool) -> None:
+    from app.main import ResponseHeadersMiddleware
+
+    if not hasattr(app.state, "_bench_user_middleware"):
+        app.state._bench_user_middleware = list(app.user_middleware)
+    stack = []
+    for item in app.state._bench_user_middleware:
+        if item.cls is ResponseHeadersMiddleware and legacy:
+            stack.extend(_legacy_middleware())
+        else:
+            stack.append(item)
+    app.user_middleware = stack
+    app.middleware_stack = app.build_middleware_stack()
+
+
+async def _time(client, method: str, url: str, n: int, **kwargs) -> float:
+    for _ in range(min(50, n)):
+        await client.request(method, url, **kwargs)
+    started = time.perf_counter()
+    for _ in range(n):
+        resp = await client.request(method, url, **kwargs)
+        assert resp.status_code == 200, resp.text
+    return (time.perf_counter() - started) / n * 1_000_000
+
+
+async def main(n: int) -> None:
+    _set_env()
+    import httpx
+
+    from app.main import app
+    from app.services.upstream_http import UpstreamHttpClients
+
+    class Body(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield b"PK\x03\x04" + b"x" * 4096
+
+    def upstream(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/user/subscription":
+            return httpx.Response(200, json={"tier": 3})
+        return httpx.Response(200, stream=Body(), headers={"content-type": "application/zip"})
+
+    build = UpstreamHttpClients._build_client.__func__
+    UpstreamHttpClients._build_client = classmethod(
+        lambda cls, proxy_url: httpx.AsyncClient(
+            transport=httpx.MockTransport(upstream), event_hooks=build(cls, proxy_url).event_hooks
+        )
+    )
+
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/auth/register", json={"username": "bench", "password": "pass1234"})
+            token = (await client.post("/auth/login", json={"username": "bench", "password": "pass1234"})).json()[
+                "access_token"
+            ]
+            headers = {"Authorization": f"Bearer {token}"}
+            resp = await client.post("/keys", headers=headers, json={"api_key": "bench-key", "verify_now": True})
+            assert resp.status_code == 200, resp.text
+            payload = {"input": "x", "width": 512, "height": 512, "steps": 20, "n_samples": 1}
+
+            print(f"{'endpoint':<34}{'legacy us/req':>15}{'asgi us/req':>15}{'saved':>10}")
+            for label, method, url, kwargs in (
+                ("GET /healthz", "GET", "/healthz", {}),
+                ("POST /v1/novelai/generate-image", "POST", "/v1/novelai/generate-image", {"json": payload, "headers": headers}),
+            ):
+                results = {}
+                # Interleave runs to even out warm-up / GC effects.
+                for legacy in (True, False, True, False):
+                    _use_stack(app, legacy)
+                    results.setdefault(legacy, []).append(await _time(client, method, url, n, **kwargs))
+                old, new = min(results[True]), min(results[False])
+                print(f"{label:<34}{old:>15.1f}{new:>15.1f}{(old - new) / old:>10.1%}")
+    finally:
+        await app.router.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
@@ -0,0 +1,103 @@
+import asyncio
+import base64
+import os
+from datetime import datetime, timedelta
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_ratelimit_memdb?mode=memory&cache=shared&uri=true"
+    os.environ.setdefault("ADMIN_PASSWORD", "admin123")
+
+
+class _Clock:
+    """Stands in for the `time` module inside services/rate_limit.py."""
+
+    def __init__(self, now: float) -> None:
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def run():
+    _set_env()
+    from app.config import settings
+    from app.database import AsyncSessionLocal, Base, engine
+    from app.models import RequestLog, User
+    from app.services import rate_limit
+    from app.services.rate_limit import (
+        RETRY_LOG_ACTION,
+        DbRateLimiter,
+        InMemoryRateLimiter,
+        SharedRateLimiter,
+    )
+
+    settings.shared_state_backend = "memory"
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with AsyncSessionLocal() as db:
+            db.add(User(id=1, username="rl", hashed_password="x"))
+            await db.commit()
+
+        async def log_at(db, seconds_ago, action="generate-image"):
+            db.add(RequestLog(user_id=1, action=action, created_at=datetime.utcnow() - timedelta(seconds=seconds_ago)))
+            await db.commit()
+
+        async with AsyncSessionLocal() as db:
+            # Just outside and just inside the window edge, one mid-window, and a retry (never counted).
+            await log_at(db, 60.5)
+            await log_at(db, 59.5)
+            await log_at(db, 30)
+            await log_at(db, 10, action=RETRY_LOG_ACTION)
+
+            # Warm-up rebuilds the in-memory window from the logs: same count as the DB query.
+            memory = InMemoryRateLimiter()
+            assert await memory.count(db, 1) == await DbRateLimiter().count(db, 1) == 2
+
+            # Requests after warm-up are logged (asynchronously) and recorded in memory at once.
+            await log_at(db, 0)
+            memory.record(1)
+            assert await memory.count(db, 1) == await DbRateLimiter().count(db, 1) == 3
+
+            # The window edge matches `created_at >= now - 60s`: a hit exactly 60 s old still counts.
+            edge = InMemoryRateLimiter()
+            edge._warmed = True
+            clock = _Clock(1000.0)
+            real_time, rate_limit.time = rate_limit.time, clock
+            try:
+                edge.record(1, at=940.0)
+                edge.record(1, at=970.0)
+                assert await edge.count(db, 1) == 2
+                clock.now = 1000.001
+                assert await edge.count(db, 1) == 1
+
+                # Shared limiter: 3 requests early in one minute, checked 10 s into the next. The
+                # sliding window (DB semantics) holds the two at 30 s and 50 s; the weighted
+                # previous counter estimates int(3 * 50/60) = 2.
+                shared = SharedRateLimiter()
+                base = 600 * 60.0
+                counts = []
+                for offset in (5, 30, 50):
+                    clock.now = base + offset
+                    counts.append(await shared.count(db, 1))
+                assert counts == [0, 1, 2], counts
+                clock.now = base + 70
+                assert await shared.count(db, 1) == 2
+            finally:
+                rate_limit.time = real_time
+
+    asyncio.run(scenario())
+    print("Rate limit test passed.")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,161 @@
+import asyncio
+import base64
+import json
+import os
+
+import httpx
+from fastapi.testclient import TestClient
+
+PAYLOAD = {"input": "x", "model": "nai-diffusion-4-5-full", "width": 512, "height": 512, "steps": 20, "n_samples": 1}
+CHUNKS = [b"PK\x03\x04", b"a" * 4096, b"b" * 4096]
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.update(
+        ENVIRONMENT="test",
+        SECRET_KEY="test-secret",
+        ENCRYPTION_KEY=key,
+        DATABASE_URL="sqlite+aiosqlite:///file:novelai_streaming_memdb?mode=memory&cache=shared&uri=true",
+        ALLOW_REGISTRATION="true",
+        BASE_RPM="0",
+        PER_KEY_RPM="100",
+        MAX_RPM="1000",
+        HEALTH_CHECK_ENABLED="false",
+        KEY_COOLDOWN_SECONDS="0",
+        DYNAMIC_COOLDOWN_ENABLED="false",
+        ADMISSION_MAX_WAIT_MS="200",
+        UPSTREAM_PROXY_MODE="direct",
+        UPSTREAM_STREAMING_ENABLED="true",
+    )
+
+
+def run():
+    _set_env()
+    from sqlalchemy import select
+
+    from app.database import AsyncSessionLocal
+    from app.main import app
+    from app.models import RequestLog
+    from app.services.key_scheduler import key_scheduler
+    from app.services.log_writer import request_log_writer
+    from app.services.upstream_http import UpstreamHttpClients
+
+    # The upstream image body arrives in chunks; `stall` holds it after the first one.
+    stall: dict = {"event": None}
+
+    class Body(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            for i, chunk in enumerate(CHUNKS):
+                if i == 1 and stall["event"] is not None:
+                    await stall["event"].wait()
+                yield chunk
+
+    def mock_client(proxy_url):
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path == "/user/subscription":
+                return httpx.Response(200, json={"tier": 3})
+            return httpx.Response(200, stream=Body(), headers={"content-type": "application/zip"})
+
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    UpstreamHttpClients._build_client = classmethod(lambda cls, proxy_url: mock_client(proxy_url))
+
+    async def logs_since(last_id):
+        await request_log_writer.flush()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(RequestLog).where(RequestLog.id > last_id).order_by(RequestLog.id))
+            return [(row.id, row.action, row.status_code) for row in result.scalars().all()]
+
+    def leases_held():
+        return sum(key_scheduler.in_flight(key_id) for key_id in (1, 2))
+
+    with TestClient(app) as client:
+        client.post("/auth/register", json={"username": "streamer", "password": "pass1234"})
+        resp = client.post("/auth/login", json={"username": "streamer", "password": "pass1234"})
+        token = resp.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        for i in range(2):
+            resp = client.post("/keys", headers=headers, json={"api_key": f"key-{i}", "verify_now": True})
+            assert resp.status_code == 200, resp.text
+        last_id = max([0] + [row[0] for row in client.portal.call(logs_since, 0)])
+
+        def new_logs():
+            nonlocal last_id
+            logs = client.portal.call(logs_since, last_id)
+            last_id = logs[-1][0] if logs else last_id
+            return [(action, status) for _, action, status in logs]
+
+        # Completed stream: every byte forwarded, then one log row and the lease back.
+        resp = client.post("/v1/novelai/generate-image", headers=headers, json=PAYLOAD)
+        assert resp.status_code == 200 and resp.content == b"".join(CHUNKS), resp.status_code
+        assert resp.headers["content-type"] == "application/zip"
+        assert leases_held() == 0
+        assert new_logs() == [("generate-image", 200)]
+
+        # Client disconnect mid-stream, driven over raw ASGI so the disconnect arrives while the
+        # upstream body is still open: logged once as 499 (not the key's fault), lease released.
+        async def disconnect_midway():
+            stall["event"] = asyncio.Event()
+            first_chunk = asyncio.Event()
+            body = json.dumps(PAYLOAD).encode()
+            requested = False
+            sent: list[bytes] = []
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                await first_chunk.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                if message["type"] == "http.response.body" and message.get("body"):
+                    sent.append(message["body"])
+                    assert leases_held() == 1
+                    first_chunk.set()
+
+            scope = {
+                "type": "http",
+                "asgi": {"version": "3.0"},
+                "http_version": "1.1",
+                "method": "POST",
+                "scheme": "http",
+                "path": "/v1/novelai/generate-image",
+                "raw_path": b"/v1/novelai/generate-image",
+                "root_path": "",
+                "query_string": b"",
+                "headers": [
+                    (b"host", b"testserver"),
+                    (b"authorization", f"Bearer {token}".encode()),
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+                "client": ("127.0.0.1", 50000),
+                "server": ("testserver", 80),
+                "state": {},
+            }
+            try:
+                await asyncio.wait_for(app(scope, receive, send), timeout=5)
+            finally:
+                stall["event"].set()
+                stall["event"] = None
+            return sent
+
+        sent = client.portal.call(disconnect_midway)
+        assert sent == CHUNKS[:1], sent
+        assert leases_held() == 0
+        assert new_logs() == [("generate-image", 499)]
+        assert key_scheduler.get(1).fail_streak == 0 and key_scheduler.get(2).fail_streak == 0
+
+        # The key is free again for the next request.
+        resp = client.post("/v1/novelai/generate-image", headers=headers, json=PAYLOAD)
+        assert resp.status_code == 200 and leases_held() == 0
+        assert new_logs() == [("generate-image", 200)]
+
+    print("Streaming test passed.")
+
+
+if __name__ == "__main__":
+    run()
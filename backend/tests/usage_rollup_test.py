@@ -0,0 +1,119 @@
+import asyncio
+import base64
+import os
+from datetime import datetime, timedelta
+
+
+def _set_env():
+    key = base64.urlsafe_b64encode(b"2" * 32).decode("ascii")
+    os.environ.setdefault("ENVIRONMENT", "test")
+    os.environ.setdefault("SECRET_KEY", "test-secret")
+    os.environ.setdefault("ENCRYPTION_KEY", key)
+    os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///file:novelai_rollup_memdb?mode=memory&cache=shared&uri=true"
+    os.environ.setdefault("ADMIN_PASSWORD", "admin123")
+
+
+def run():
+    _set_env()
+    from sqlalchemy import select, update
+
+    from app.config import settings
+    from app.database import AsyncSessionLocal, Base, engine
+    from app.models import ApiKey, RequestLog, RollupWatermark, User
+    from app.services.rate_limit import RETRY_LOG_ACTION
+    from app.services.usage_rollup import WATERMARK_NAME, fold_new_logs, query_usage, usage_since
+
+    settings.usage_rollup_settle_seconds = 30
+    settings.usage_rollup_batch_size = 2
+    settings.usage_rollup_max_batches = 10
+
+    async def watermark(db):
+        result = await db.execute(select(RollupWatermark.last_id).where(RollupWatermark.name == WATERMARK_NAME))
+        return result.scalar()
+
+    async def totals(db, group_by):
+        since = usage_since("day", 2, 1)
+        return {
+            row["user_id" if group_by == "user" else "api_key_id"]: row
+            for row in await query_usage(db, "day", since, group_by=group_by)
+        }
+
+    async def scenario():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        old = datetime.utcnow().replace(second=5, microsecond=0) - timedelta(minutes=10)
+
+        def log(user_id, key_id, status, latency_ms, created_at=old, action="generate-image"):
+            return RequestLog(
+                user_id=user_id,
+                api_key_id=key_id,
+                action=action,
+                status=status,
+                latency_ms=latency_ms,
+                width=512,
+                height=512,
+                steps=20,
+                samples=1,
+                created_at=created_at,
+            )
+
+        async with AsyncSessionLocal() as db:
+            db.add_all([User(id=1, username="u1", hashed_password="x"), User(id=2, username="u2", hashed_password="x")])
+            db.add_all([ApiKey(id=i, user_id=1, key_encrypted=f"k{i}", key_hash=f"k{i}") for i in (1, 2)])
+            await db.flush()
+            # Settled rows: a success, a failure, a retried attempt (not a user request), a rejection
+            # (no key) and another user's success. Then an unsettled row (still in the write-behind
+            # queue window) followed by an old one committed late behind it.
+            db.add_all(
+                [
+                    log(1, 1, "success", 400),
+                    log(1, 1, "error", 3000),
+                    log(1, 2, "error", 100, action=RETRY_LOG_ACTION),
+                    log(1, None, "rejected", None),
+                    log(2, 1, "success", 800),
+                ]
+            )
+            await db.flush()
+            fresh = log(1, 1, "success", 600, created_at=datetime.utcnow())
+            db.add(fresh)
+            await db.flush()
+            db.add(log(2, 2, "success", 700))
+            await db.commit()
+            settled_last = fresh.id - 1
+
+        async with AsyncSessionLocal() as db:
+            # Batches of 2 until the first unsettled row; the late row behind it waits too.
+            assert await fold_new_logs(db) == 5
+            assert await watermark(db) == settled_last
+            by_user = await totals(db, "user")
+            # Running again folds nothing: every row is counted exactly once.
+            assert await fold_new_logs(db) == 0
+            assert await watermark(db) == settled_last
+            assert await totals(db, "user") == by_user
+
+            user1 = by_user[1]
+            assert (user1["requests"], user1["successes"], user1["failures"], user1["rejected"], user1["retries"]) == (
+                3, 1, 1, 1, 1,
+            ), user1
+            assert user1["pixel_steps"] == 512 * 512 * 20 and user1["success_rate"] == 0.5
+            assert by_user[2]["requests"] == 1 and by_user[2]["retries"] == 0
+            by_key = await totals(db, "key")
+            assert by_key[0]["rejected"] == 1 and by_key[2]["retries"] == 1 and by_key[1]["requests"] == 3, by_key
+            minute = await query_usage(db, "minute", usage_since("minute", 1, 1))
+            assert len(minute) == 1 and minute[0]["requests"] == 4, minute
+
+            # Once the row settles, it and the late row behind it are folded, once.
+            await db.execute(update(RequestLog).where(RequestLog.id == fresh.id).values(created_at=old))
+            await db.commit()
+            assert await fold_new_logs(db) == 2
+            assert await fold_new_logs(db) == 0
+            assert await watermark(db) == fresh.id + 1
+            by_user = await totals(db, "user")
+            assert by_user[1]["requests"] == 4 and by_user[2]["requests"] == 2, by_user
+
+    asyncio.run(scenario())
+    print("Usage rollup test passed.")
+
+
+if __name__ == "__main__":
+    run()